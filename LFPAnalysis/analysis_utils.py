@@ -13,100 +13,130 @@ from matplotlib.backends.backend_pdf import PdfPages
 import os
 import pycatch22
 import pkg_resources
+from LFPAnalysis import lfp_preprocess_utils
 
 
 
 # There are some things that MNE is not that good at, or simply does not do. Let's write our own code for these. 
-def select_rois_picks(elec_data, chan_name, manual_col='collapsed_manual'):
-    
+
+# ROI rules for the LeGui atlas labels, as (keyword, roi). BN246: the first matching rule wins. NMM: the last one wins.
+BN246_ROI_RULES = [('hipp', 'HPC'), 
+                   ('amyg', 'AMY'), 
+                   ('ins', 'INS'), 
+                   ('ifg', 'IFG'), 
+                   ('org', 'OFC'), 
+                   ('mfg', 'dlPFC'), 
+                   ('sfg', 'dmPFC')]
+
+NMM_ROI_RULES = [('hippocampus', 'HPC'), 
+                 ('amygdala', 'AMY'), 
+                 ('acgc', 'ACC'), 
+                 ('mcgc', 'MCC'), 
+                 ('ofc', 'OFC'), 
+                 ('mfg', 'dlPFC'), 
+                 ('sfg', 'dmPFC')]
+
+# lookup tables read from the package data, loaded once per session
+_ROI_TABLES = {}
+
+
+def load_yba_roi_table():
+    """
+    YBA ROI labels, custom assigned by Salman, as a Series {YBA long name (lower case, no spaces): custom ROI}. 
+    Read from the package data once per session.
+    """
+
+    if 'YBA' not in _ROI_TABLES:
+        # Get the path to the data directory
+        data_dir = pkg_resources.resource_filename('LFPAnalysis', '../data')
+        YBA_ROI_labels = pd.read_excel(os.path.join(data_dir, 'YBA_ROI_labelled.xlsx'))
+        YBA_ROI_labels['Long.name'] = YBA_ROI_labels['Long.name'].str.lower().str.replace(" ", "")
+        # the first entry wins for duplicated names
+        YBA_ROI_labels = YBA_ROI_labels.drop_duplicates(subset='Long.name', keep='first')
+        _ROI_TABLES['YBA'] = pd.Series(YBA_ROI_labels['Custom'].values, index=YBA_ROI_labels['Long.name'].values)
+
+    return _ROI_TABLES['YBA']
+
+
+def _match_roi_rules(labels, rules, last=False):
+    """
+    ROI of the first (or last) rule whose keyword is in each label, NaN if none. Rules are checked once per unique label.
     """
-    Grab specific roi for the channel you are looking at 
+
+    codes, uniques = pd.factorize(pd.Series(labels).astype(object))
+    hits = np.array([[(keyword in x) for keyword, _ in rules] for x in uniques], dtype=bool).reshape(len(uniques), len(rules))
+    rule_ix = (len(rules) - 1 - hits[:, ::-1].argmax(axis=1)) if last else hits.argmax(axis=1)
+    rois = np.where(hits.any(axis=1), np.array([roi for _, roi in rules], dtype=object)[rule_ix], np.nan)
+    rois = np.append(rois.astype(object), np.nan)
+
+    # (factorize codes missing labels as -1, which picks the trailing NaN)
+    return rois[codes]
+
+
+def assign_rois(elec_data, manual_col='collapsed_manual'):
     """
+    Assign an ROI to every electrode of an electrode dataframe at once. 
 
-    # Load the YBA ROI labels, custom assigned by Salman: 
-    # file_path = pkg_resources.resource_filename('LFPAnalysis', 'data/YBA_ROI_labelled.xlsx')
-    # Get the path to the data directory
-    data_dir = pkg_resources.resource_filename('LFPAnalysis', '../data')
+    Priority: the YBA label through the custom YBA ROI table (or, when YBA says 'unknown', the manual label: 
+    thalamus or its YBA ROI), then BN246, then NMM (entorhinal cortex, only in NMM, is kept unless overridden by 
+    the YBA/manual label). Channels that are still unlabelled are 'Unknown'. 
 
-    # Construct the full path to your file
-    file_path = os.path.join(data_dir, 'YBA_ROI_labelled.xlsx')
+    Parameters
+    ----------
+    elec_data : pandas df 
+        electrode dataframe with label, YBA_1, BN246, NMM and manual_col columns 
+    manual_col : str 
+        column with the manual labels 
 
-    print(file_path)
-    YBA_ROI_labels = pd.read_excel(file_path)
-    YBA_ROI_labels['Long.name'] = YBA_ROI_labels['Long.name'].str.lower().str.replace(" ", "")
+    Returns
+    -------
+    elec_data : pandas df 
+        copy of elec_data with a 'roi' column 
+    """
 
-    roi = np.nan
-    NMM_label = elec_data[elec_data.label==chan_name].NMM.str.lower().str.strip()
-    BN246_label = elec_data[elec_data.label==chan_name].BN246.str.lower().str.strip()
+    YBA_ROI_labels = load_yba_roi_table()
+    elec_data = elec_data.copy()
 
+    NMM_label = elec_data.NMM.str.lower().str.strip()
+    BN246_label = elec_data.BN246.str.lower().str.strip()
     # Account for individual differences in labelling: 
-    YBA_label = elec_data[elec_data.label==chan_name].YBA_1.str.lower().str.replace(" ", "")
-    manual_label = elec_data[elec_data.label==chan_name][manual_col].str.lower().str.replace(" ", "")
+    YBA_label = elec_data.YBA_1.str.lower().str.replace(" ", "")
+    manual_label = elec_data[manual_col].str.lower().str.replace(" ", "")
 
     # Only NMM assigns entorhinal cortex 
-    if NMM_label.str.contains('entorhinal').iloc[0]:
-        roi = 'EC'
-
-    # First priority: Use YBA labels if there is no manual label
-    if pd.isna(manual_label).iloc[0]:
-        try:
-            roi = YBA_ROI_labels[YBA_ROI_labels['Long.name']==YBA_label.values[0]].Custom.values[0]
-        except IndexError:
-            # This is probably white matter or out of brain, but not manually labelled as such
-            roi = np.nan
-    else:
-        # Now look at the manual labels: 
-        if YBA_label.str.contains('unknown').iloc[0]:
-            # prioritize thalamus labels! Which are not present in YBA for some reason
-            if (manual_label.str.contains('thalamus').iloc[0]):
-                roi = 'THAL'
-            else:
-                try:
-                    roi = YBA_ROI_labels[YBA_ROI_labels['Long.name']==manual_label.values[0]].Custom.values[0]
-                except IndexError: 
-                    # This is probably white matter or out of brain, and manually labelled as such
-                    roi = np.nan
-
-    # Next  use BN246 labels if still unlabeled
-    if pd.isna(roi):
-        # Just use the dumb BN246 label from LeGui, stripping out the hemisphere which we don't care too much about at the moment
-        if (BN246_label.str.contains('hipp').iloc[0]):
-            roi = 'HPC'
-        elif (BN246_label.str.contains('amyg').iloc[0]):
-            roi = 'AMY'
-        elif (BN246_label.str.contains('ins').iloc[0]):
-            roi = 'INS'
-        elif (BN246_label.str.contains('ifg').iloc[0]):
-            roi = 'IFG'
-        elif (BN246_label.str.contains('org').iloc[0]):
-            roi = 'OFC' 
-        elif (BN246_label.str.contains('mfg').iloc[0]):
-            roi = 'dlPFC'
-        elif (BN246_label.str.contains('sfg').iloc[0]):
-            roi = 'dmPFC'
-
-    if pd.isna(roi):
-        # Just use the dumb NMM label from LeGui, stripping out the hemisphere which we don't care too much about at the moment
-        if (NMM_label.str.contains('hippocampus').iloc[0]):
-            roi = 'HPC'
-        if (NMM_label.str.contains('amygdala').iloc[0]):
-            roi = 'AMY'
-        if (NMM_label.str.contains('acgc').iloc[0]):
-            roi = 'ACC'
-        if (NMM_label.str.contains('mcgc').iloc[0]):
-            roi = 'MCC'
-        if (NMM_label.str.contains('ofc').iloc[0]):
-            roi = 'OFC'
-        if (NMM_label.str.contains('mfg').iloc[0]):
-            roi = 'dlPFC'
-        if (NMM_label.str.contains('sfg').iloc[0]):
-            roi = 'dmPFC'  
-
-    if pd.isna(roi):
-        # This is mostly temporal gyrus
-        roi = 'Unknown'
-
-    return roi
+    roi = pd.Series(np.nan, index=elec_data.index, dtype=object)
+    roi[NMM_label.str.contains('entorhinal', na=False)] = 'EC'
+
+    # First priority: Use YBA labels if there is no manual label 
+    # (names missing from the table are probably white matter or out of brain)
+    no_manual = manual_label.isna()
+    roi[no_manual] = YBA_label[no_manual].map(YBA_ROI_labels)
+    # Otherwise look at the manual labels if YBA doesn't know the electrode, prioritizing thalamus labels! Which are not 
+    # present in YBA for some reason
+    yba_unknown = ~no_manual & YBA_label.str.contains('unknown', na=False)
+    thalamus = manual_label.str.contains('thalamus', na=False)
+    roi[yba_unknown & thalamus] = 'THAL'
+    roi[yba_unknown & ~thalamus] = manual_label[yba_unknown & ~thalamus].map(YBA_ROI_labels)
+
+    # Next use BN246 labels if still unlabeled, then NMM 
+    # (the dumb LeGui labels, stripping out the hemisphere which we don't care too much about at the moment)
+    roi = roi.fillna(pd.Series(_match_roi_rules(BN246_label, BN246_ROI_RULES), index=elec_data.index))
+    roi = roi.fillna(pd.Series(_match_roi_rules(NMM_label, NMM_ROI_RULES, last=True), index=elec_data.index))
+
+    # This is mostly temporal gyrus
+    elec_data['roi'] = roi.fillna('Unknown')
+
+    return elec_data
+
+
+def select_rois_picks(elec_data, chan_name, manual_col='collapsed_manual'):
+    
+    """
+    Grab specific roi for the channel you are looking at (see assign_rois to label all the channels at once)
+    """
+
+    return assign_rois(elec_data[elec_data.label==chan_name].iloc[:1], manual_col=manual_col)['roi'].iloc[0]
+
 
 def select_picks_rois(elec_data, roi=None):
     """
@@ -204,7 +234,7 @@ def plot_TFR(data, freqs, pre_win, post_win, sr, title):
 
 
 def detect_ripple_evs(mne_data, min_ripple_length=0.038, max_ripple_length=0.5, 
-                      smoothing_window_length=0.02, sd_upper_cutoff=9, sd_lower_cutoff=2.5):
+                      smoothing_window_length=0.02, sd_upper_cutoff=9, sd_lower_cutoff=2.5, envelopes=None):
     
     """
 
@@ -221,6 +251,9 @@ def detect_ripple_evs(mne_data, min_ripple_length=0.038, max_ripple_length=0.5,
         Upper cutoff for ripple detection
     sd_lower_cutoff : float
         Lower cutoff for ripple detection
+    envelopes : dict 
+        precomputed band envelopes of mne_data (see lfp_preprocess_utils.compute_band_envelopes). Must hold the ripple 
+        band signal ('ripple_signal', computed with signals=['ripple']), whose RMS is used. Computed here if None 
     
     Returns
     -------
@@ -238,28 +271,35 @@ def detect_ripple_evs(mne_data, min_ripple_length=0.038, max_ripple_length=0.5,
   
     """
 
-    if type(mne_data) == mne.epochs.Epochs:
+    if isinstance(mne_data, mne.BaseEpochs):
         data_type = 'epoch'
         raise ValueError('Continuous data required')
-    elif type(mne_data) in [mne.io.fiff.raw.Raw, mne.io.edf.edf.RawEDF]: 
+    elif isinstance(mne_data, mne.io.BaseRaw): 
         data_type = 'continuous'
     else: 
         data_type = 'continuous'
 
-    # Step 1: band-pass filter from 80 - 120 Hz (ripple band) 
-    ripple_band_data = mne_data.copy().filter(80, 120, n_jobs=-1)
+    # Step 1: band-pass filter from 80 - 120 Hz (ripple band), from the shared band-envelope pass (no copy of the data)
+    if envelopes is None:
+        envelopes = lfp_preprocess_utils.compute_band_envelopes(mne_data, bands={'ripple': lfp_preprocess_utils.ENVELOPE_BANDS['ripple']}, 
+                                                                signals=['ripple'])
+    if 'ripple_signal' not in envelopes:
+        raise ValueError("envelopes has no 'ripple_signal' - compute it with compute_band_envelopes(..., signals=['ripple'])")
+    ripple_power = envelopes['ripple_signal']
 
     # Step 2: Calculate the root mean square of the band-passed signal and smooth using a 20 ms window
 
     # Create an empty array to store the rolling RMS for each trial and time series
-    rolling_rms_array = np.zeros_like(ripple_band_data._data)
-
-    # Loop over each trial and each time series and calculate the rolling RMS
-    for i in range(ripple_band_data._data.shape[0]):
-        column_values = ['signal'] 
-        df = pd.DataFrame(data = ripple_band_data._data[i, :], columns = column_values)
-        smoothed_data = df['signal'].pow(2).rolling(round(smoothing_window_length * mne_data.info['sfreq']), min_periods=1).mean().apply(np.sqrt, raw=True)
-        rolling_rms_array[i, :] = smoothed_data.values
+    n_chans, n_times = ripple_power.shape
+    rolling_rms_array = np.zeros((n_chans, n_times))
+    window = round(smoothing_window_length * mne_data.info['sfreq'])
+
+    # trailing moving average (min_periods=1) of the squared signal, from a cumulative sum, one channel at a time
+    for i in range(n_chans):
+        cum_power = np.cumsum(ripple_power[i, :].astype(np.float64)**2)
+        rolling_rms_array[i, :window] = cum_power[:window] / np.arange(1, min(window, n_times) + 1)
+        rolling_rms_array[i, window:] = (cum_power[window:] - cum_power[:-window]) / window
+    rolling_rms_array = np.sqrt(np.maximum(rolling_rms_array, 0))
     
     # Step 3: mark ripple events [ripple start, ripple end] as periods of RMS amplitude above 2.5, but no greater than 9, standard deviations from the mean 
 
@@ -284,7 +324,7 @@ def detect_ripple_evs(mne_data, min_ripple_length=0.038, max_ripple_length=0.5,
     RPL_samps_dict = {f'{x}':np.nan for x in mne_data.ch_names}
     RPL_sec_dict = {f'{x}':np.nan for x in mne_data.ch_names}
         
-    for ch_ in range(ripple_band_data._data.shape[0]):
+    for ch_ in range(n_chans):
         ripple_ch = ripple_events_index[:, np.where(ripple_events_index[0]==ch_)[0]][1]
         ripple_events_differences = np.array([0] + np.diff(ripple_ch))
 
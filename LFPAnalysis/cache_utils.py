@@ -0,0 +1,253 @@
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+import pandas as pd
+import mne
+from scipy import sparse
+
+# Content-addressed cache for the preprocessing stages (ingest, reference, artifact detection, epoching, TFR).
+# Every stage result is stored under a key that hashes the stage name, the input files (path, size, modification time),
+# the parameters, the package version and the package source code, so changing any of them is a cache miss and nothing 
+# has to be invalidated by hand.
+
+CACHE_DIR_NAME = '.lfp_cache'
+
+# file suffix for each kind of cached object (mne wants its own naming conventions)
+CACHE_SUFFIX = {'pickle': '.pkl',
+                'raw': '_raw.fif',
+                'epochs': '-epo.fif',
+                'tfr': '-tfr.h5'}
+
+# hash of the package sources (see code_fingerprint)
+_CODE_FINGERPRINT = None
+
+
+def package_version():
+    """
+    Version of the installed LFPAnalysis package ('dev' if it isn't installed, e.g. running from a clone)
+    """
+
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+        return version('LFPAnalysis')
+    except Exception:
+        return 'dev'
+
+
+def code_fingerprint():
+    """
+    Hash of the source code of the package (every LFPAnalysis/*.py file), so that editing any stage invalidates its 
+    cached results even when the package version doesn't change (e.g. running from a clone). Computed once per session.
+    """
+
+    global _CODE_FINGERPRINT
+    if _CODE_FINGERPRINT is None:
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        h = hashlib.blake2b(digest_size=16)
+        for x in sorted(os.listdir(package_dir)):
+            if x.endswith('.py'):
+                h.update(x.encode())
+                with open(os.path.join(package_dir, x), 'rb') as f:
+                    h.update(f.read())
+        _CODE_FINGERPRINT = h.hexdigest()
+
+    return _CODE_FINGERPRINT
+
+
+def default_cache_dir(path):
+    """
+    Cache directory next to the data: {path}/.lfp_cache for a directory, {dirname(path)}/.lfp_cache for a file
+    """
+
+    if os.path.isdir(path):
+        return os.path.join(path, CACHE_DIR_NAME)
+
+    return os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR_NAME)
+
+
+def file_signature(path):
+    """
+    Cheap fingerprint of a file: absolute path, size and modification time. The signature of a directory is the list
+    of the signatures of the files directly inside it. None for paths that don't exist.
+    """
+
+    if path is None:
+        return None
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        return [file_signature(os.path.join(path, x)) for x in sorted(os.listdir(path))
+                if os.path.isfile(os.path.join(path, x))]
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def _hash_array(data):
+    # Hash the bytes of an array a chunk of rows at a time (no full copy for non-contiguous arrays)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((data.shape, data.dtype.str)).encode())
+    data = data.reshape(data.shape[0], -1) if data.ndim > 1 else data[None]
+    for start in range(0, data.shape[0], 16):
+        h.update(np.ascontiguousarray(data[start:start+16]).tobytes())
+
+    return h.hexdigest()
+
+
+def _to_jsonable(obj):
+    # Convert parameters (and in-memory inputs) into something json can serialize deterministically
+    if isinstance(obj, (mne.io.BaseRaw, mne.BaseEpochs)):
+        # hash the preloaded buffer directly (get_data would copy it)
+        data = obj._data if getattr(obj, 'preload', False) else obj.get_data()
+        return {'ch_names': obj.ch_names, 'bads': obj.info['bads'], 'sfreq': obj.info['sfreq'], 'data': _hash_array(data)}
+    if sparse.issparse(obj):
+        obj = obj.tocsr()
+        return [list(obj.shape), _hash_array(obj.data), _hash_array(obj.indices), _hash_array(obj.indptr)]
+    if isinstance(obj, dict):
+        return {str(k): _to_jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_to_jsonable(x) for x in obj]
+    if isinstance(obj, (set, frozenset)):
+        return sorted([_to_jsonable(x) for x in obj], key=str)
+    if isinstance(obj, (pd.Series, pd.Index)):
+        return _to_jsonable(obj.tolist())
+    if isinstance(obj, pd.DataFrame):
+        return _to_jsonable(obj.to_dict(orient='list'))
+    if isinstance(obj, np.ndarray):
+        return obj.tolist() if obj.size < 10000 else _hash_array(obj)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, float) and np.isnan(obj):
+        return 'nan'
+    if isinstance(obj, (str, int, float, bool)) or obj is None:
+        return obj
+
+    return repr(obj)
+
+
+def stage_key(stage, inputs=(), params=None):
+    """
+    Cache key of one run of a stage.
+
+    Parameters
+    ----------
+    stage : str
+        name of the stage, e.g. 'make_mne'
+    inputs : list
+        input file paths (hashed by file_signature) and/or in-memory inputs such as mne objects (hashed by content)
+    params : dict
+        parameters of the stage. Must be json serializable after conversion of numpy/pandas objects.
+
+    Returns
+    -------
+    key : str
+        hex digest
+    """
+
+    inputs = [file_signature(x) if isinstance(x, str) else _to_jsonable(x) for x in inputs]
+    desc = json.dumps({'stage': stage,
+                       'inputs': inputs,
+                       'params': _to_jsonable(params),
+                       'version': package_version(),
+                       'code': code_fingerprint()}, sort_keys=True, default=repr)
+
+    return hashlib.blake2b(desc.encode(), digest_size=16).hexdigest()
+
+
+def stage_path(cache_dir, stage, key, kind='pickle'):
+    """
+    Path of the cache entry of a stage
+    """
+
+    return os.path.join(cache_dir, f'{stage}-{key}{CACHE_SUFFIX[kind]}')
+
+
+def load_stage(cache_dir, stage, key, kind='pickle'):
+    """
+    Load a cached stage result. Returns None on a cache miss (or an unreadable entry).
+
+    Parameters
+    ----------
+    cache_dir : str
+        cache directory
+    stage : str
+        name of the stage
+    key : str
+        output of stage_key
+    kind : str
+        what was stored. options: ['pickle', 'raw', 'epochs', 'tfr']
+
+    Returns
+    -------
+    result : object
+        the cached result, or None
+    """
+
+    path = stage_path(cache_dir, stage, key, kind)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        if kind == 'pickle':
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+        elif kind == 'raw':
+            result = mne.io.read_raw_fif(path, preload=True)
+        elif kind == 'epochs':
+            result = mne.read_epochs(path, preload=True)
+        elif kind == 'tfr':
+            result = mne.time_frequency.read_tfrs(path)
+            if isinstance(result, list):
+                result = result[0]
+    except Exception as e:
+        print(f'Could not read cached {stage} ({e}) - recomputing')
+        return None
+
+    print(f'Loaded {stage} from cache: {path}')
+
+    return result
+
+
+def save_stage(result, cache_dir, stage, key, kind='pickle'):
+    """
+    Store a stage result in the cache (see load_stage). Returns the path of the entry.
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = stage_path(cache_dir, stage, key, kind)
+
+    if kind == 'pickle':
+        # write to a temporary file first so an interrupted run never leaves a truncated entry behind
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{path}.tmp', path)
+    elif kind in ['raw', 'epochs']:
+        # double precision, so a cache hit gives exactly what a fresh run would
+        result.save(path, fmt='double', overwrite=True)
+    elif kind == 'tfr':
+        result.save(path, overwrite=True)
+
+    return path
+
+
+def outputs_unchanged(manifest):
+    """
+    Check that the files a stage wrote (manifest: {path: file_signature}) are all still there, unmodified
+    """
+
+    return all([file_signature(path) == signature for path, signature in manifest.items()])
+
+
+def clear_cache(cache_dir, stage=None):
+    """
+    Delete the cache entries of a stage (or all of them)
+    """
+
+    if not os.path.isdir(cache_dir):
+        return
+    for x in os.listdir(cache_dir):
+        if (stage is None) or x.startswith(f'{stage}-'):
+            os.remove(os.path.join(cache_dir, x))
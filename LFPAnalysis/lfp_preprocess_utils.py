@@ -1,6 +1,7 @@
 import warnings
 import numpy as np
 import re
+from copy import deepcopy
 import difflib 
 from mne.preprocessing.bads import _find_outliers
 from scipy.stats import kurtosis, zscore
@@ -8,11 +9,17 @@ import neurodsp
 from neurodsp.spectral import compute_spectrum
 import mne
 from glob import glob
-from LFPAnalysis import nlx_utils, lfp_preprocess_utils, iowa_utils
+from LFPAnalysis import nlx_utils, lfp_preprocess_utils, iowa_utils, cache_utils
 import pandas as pd
 from mne.filter import next_fast_len
-from scipy.signal import hilbert, find_peaks, peak_widths, convolve
+from scipy.signal import hilbert, find_peaks, peak_widths, peak_prominences, convolve, resample_poly
+from scipy.spatial import cKDTree
+from scipy import sparse
+import scipy.fft
+from fractions import Fraction
 import Levenshtein as lev
+from rapidfuzz import process, fuzz
+from scipy.optimize import linear_sum_assignment
 import os
 import warnings
 import json
@@ -454,7 +461,135 @@ def baseline_TFR_permute(data=None, baseline_mne=None, mode='zscore', num_sample
 
 
 
-def wm_ref(mne_data=None, elec_path=None, bad_channels=None, unmatched_seeg=None, site='MSSM', average=False):
+def _read_chunk(mne_data, picks, start, stop, gradient=False):
+    """
+    Samples start:stop of some channels of an mne object (preloaded or not), or their time gradient. The gradient is 
+    computed with one sample of overlap on each side, so it is identical to np.gradient over the whole recording.
+    """
+
+    if not gradient:
+        if mne_data.preload:
+            return mne_data._data[picks, start:stop]
+        return mne_data.get_data(picks=picks, start=start, stop=stop)
+
+    pad_start, pad_stop = max(0, start - 1), min(mne_data.n_times, stop + 1)
+    chunk = _read_chunk(mne_data, picks, pad_start, pad_stop)
+    if chunk.shape[-1] < 2:
+        return np.zeros((len(picks), stop - start))
+
+    return np.gradient(chunk, axis=-1)[:, start - pad_start:stop - pad_start]
+
+
+def _streaming_moments(mne_data, picks, chunk_size=2**18, gradient=False):
+    """
+    Mean and (population) variance over time of a few channels of an mne object (or of their gradient), accumulated a 
+    chunk of samples at a time (Chan et al. pairwise update) so that only picks x chunk_size samples are ever copied. 
+
+    Parameters
+    ----------
+    mne_data : mne object 
+        raw data (preloaded or not) 
+    picks : list 
+        channel indices 
+    chunk_size : int 
+        number of samples per chunk 
+    gradient : bool 
+        moments of the time gradient of the signal instead 
+
+    Returns
+    -------
+    mean : np.ndarray, shape (n_picks,) 
+    var : np.ndarray, shape (n_picks,) 
+    """
+
+    picks = np.asarray(picks, dtype=int)
+    n = 0
+    mean = np.zeros(len(picks))
+    m2 = np.zeros(len(picks))
+    for start in range(0, mne_data.n_times, chunk_size):
+        stop = min(mne_data.n_times, start + chunk_size)
+        chunk = _read_chunk(mne_data, picks, start, stop, gradient=gradient)
+        n_chunk = stop - start
+        mean_chunk = chunk.mean(axis=1)
+        m2_chunk = ((chunk - mean_chunk[:, None])**2).sum(axis=1)
+        delta = mean_chunk - mean
+        mean = mean + delta * n_chunk / (n + n_chunk)
+        m2 = m2 + m2_chunk + delta**2 * n * n_chunk / (n + n_chunk)
+        n += n_chunk
+
+    return mean, m2 / max(n, 1)
+
+
+def _closest_wm_contacts(gm_locs, gm_hemi, wm_locs, wm_hemi, k=3):
+    """
+    Indices (into the white matter contacts) of the k white matter contacts closest to every grey matter contact, 
+    restricted to the same hemisphere. Uses one KD-tree per hemisphere. If a hemisphere has fewer than k white matter 
+    contacts, the closest ones from the other hemisphere fill in (with a warning). 
+
+    Returns
+    -------
+    closest : np.ndarray, shape (n_gm, k)
+        ordered by distance 
+    """
+
+    k = min(k, len(wm_locs))
+    closest = np.zeros((len(gm_locs), k), dtype=int)
+    for hemi in np.unique(gm_hemi):
+        gm_ix = np.where(gm_hemi==hemi)[0]
+        wm_ix = np.where(wm_hemi==hemi)[0]
+        if len(wm_ix) >= k:
+            _, nn = cKDTree(wm_locs[wm_ix]).query(gm_locs[gm_ix], k=k)
+            closest[gm_ix] = wm_ix[nn.reshape(len(gm_ix), k)]
+        else:
+            warnings.warn(f'Only {len(wm_ix)} white matter contacts in hemisphere "{hemi}" - using contacts from the other hemisphere to reference it')
+            # same-hemisphere contacts first, then the closest of the rest
+            dists = np.linalg.norm(gm_locs[gm_ix][:, None, :] - wm_locs[None, :, :], axis=-1)
+            dists[:, wm_hemi!=hemi] += np.nanmax(dists) + 1
+            closest[gm_ix] = np.argsort(dists, axis=1)[:, :k]
+
+    return closest
+
+
+def _plan_wm_reference(mne_data, labels, locs, wm_mask, gm_mask, k=3, average=False):
+    """
+    Pick the reference of every grey matter contact: the lowest variance contact among its k closest same-hemisphere 
+    white matter contacts. Variances are computed only for the white matter contacts that are candidates. 
+    With average=True, the reference is the mean of all k contacts instead (no variances needed). 
+
+    Returns
+    -------
+    anode_list : list 
+        grey matter contacts 
+    cathode_list : list 
+        their white matter reference (a list of k contacts per anode with average=True)
+    closest : np.ndarray, shape (n_gm, k) 
+        indices into the white matter contacts, ordered by distance 
+    """
+
+    hemis = np.array([x[0] for x in labels])
+    wm_labels = labels[wm_mask]
+    closest = _closest_wm_contacts(locs[gm_mask], hemis[gm_mask], locs[wm_mask], hemis[wm_mask], k=k)
+
+    if average:
+        return labels[gm_mask].tolist(), [wm_labels[x].tolist() for x in closest], closest
+
+    # variance of the candidate white matter channels only, read in chunks straight out of the data
+    candidates = np.unique(closest)
+    picks = [mne_data.ch_names.index(x) for x in wm_labels[candidates]]
+    _, candidate_vars = _streaming_moments(mne_data, picks)
+    wm_vars = np.full(len(wm_labels), np.nan)
+    wm_vars[candidates] = candidate_vars
+
+    # the lowest variance electrode of the closest ones
+    lowest = closest[np.arange(len(closest)), np.argmin(wm_vars[closest], axis=1)]
+
+    anode_list = labels[gm_mask].tolist()
+    cathode_list = wm_labels[lowest].tolist()
+
+    return anode_list, cathode_list, closest
+
+
+def wm_ref(mne_data=None, elec_path=None, bad_channels=None, unmatched_seeg=None, site='MSSM', average=False, n_wm=3):
     """
     Define a custom reference using the white matter electrodes. Originated here: https://doi.org/10.1016/j.neuroimage.2015.02.031
 
@@ -462,16 +597,15 @@ def wm_ref(mne_data=None, elec_path=None, bad_channels=None, unmatched_seeg=None
     
     Identify all white matter electrodes (based on the electrode names), and make sure they are not bad electrodes (based on the bad channels list).
 
-    1. iterate through each electrode, compute distance to all white matter electrodes 
-    2. find 3 closest wm electrodes, compute amplitude (rms) 
+    1. find the 3 closest wm electrodes of each electrode (same hemisphere, KD-tree per hemisphere)
+    2. compute their amplitude (variance), streaming over only those channels 
     3. lowest amplitude electrode = wm reference 
 
     Make sure it's the same hemisphere. 
     
-    TODO: implement average reference option, whereby the mean activity across all white matter electrodes is used as a reference [separate per hemi]... 
-    see: https://www.sciencedirect.com/science/article/pii/S1053811922005559#bib0349
-
-    TODO: this is SLOW; any vectorization to speed it up or parallelization?
+    With average=True, the reference is instead the mean of the n_wm closest same-hemisphere wm electrodes, see: 
+    https://www.sciencedirect.com/science/article/pii/S1053811922005559#bib0349
+    This can't be expressed with mne.set_bipolar_reference - use ref_mne(..., average=True) or make_reref_operator to apply it.
 
     Parameters
     ----------
@@ -487,209 +621,186 @@ def wm_ref(mne_data=None, elec_path=None, bad_channels=None, unmatched_seeg=None
         hospital where the recording took place 
     average : bool 
         should we construct an average white matter reference instead of a default? 
+    n_wm : int 
+        number of closest wm electrodes to consider (and to average, with average=True)
 
     Returns
     -------
     anode_list : list 
         list of channels to subtract from
     cathode_list : list 
-        list of channels to subtract
+        list of channels to subtract (with average=True, a list of the channels to average for every anode)
     drop_wm_channels : list 
         list of white matter channels which were not used for reference and now serve no purpose 
+    oob_channels : list 
+        list of out-of-brain channels (always empty for UI)
 
     """
 
     elec_data = load_elec(elec_path, site=site)
+    bad_channels = bad_channels if bad_channels is not None else []
 
     if site == 'MSSM': 
         # Drop the micros and unmatched seeg from here for now....
-        drop_from_locs = []
-        for ind, data in elec_data['label'].str.lower().items(): 
-            if data in unmatched_seeg:
-                drop_from_locs.append(ind)
-            elif data[0] == 'u':
-                drop_from_locs.append(ind)
-
-        elec_data = elec_data.drop(index=drop_from_locs).reset_index(drop=True)
-
-        # get the white matter electrodes and make sure they are note in the bad channel list
-        wm_elec_ix_manual = [] 
-        wm_elec_ix_auto = []
-        oob_elec_ix_manual = [] 
-        oob_elec_ix_auto = []
-        false_negatives = [] 
+        labels = elec_data['label'].str.lower()
+        drop_from_locs = labels.isin(unmatched_seeg if unmatched_seeg is not None else []) | (labels.str[0] == 'u')
+        elec_data = elec_data[~drop_from_locs.values].reset_index(drop=True)
+        labels = elec_data['label'].str.lower()
+
         # account for different labeling strategies in manual column
         white_matter_labels = ['wm', 'white', 'whitematter', 'white matter']
         gray_matter_labels = ['gm', 'gray', 'graymatter', 'gray matter']
         out_of_brain_labels = ['oob', 'out of brain']
         manual_col = elec_data.keys().str.lower().str.contains('manual')
         if np.any(manual_col):
-            manual_key = elec_data.keys()[elec_data.keys().str.lower().str.contains('manual')][0]
-            wm_elec_ix_manual += [ind for ind, data in elec_data[manual_key].str.lower().items() if data in white_matter_labels and elec_data['label'].str.lower()[ind] not in bad_channels]
-            oob_elec_ix_manual += [ind for ind, data in elec_data[manual_key].str.lower().items() if data in out_of_brain_labels]
-            false_negatives += [ind for ind, data in elec_data[manual_key].str.lower().items() if data in gray_matter_labels]
+            manual_key = elec_data.keys()[manual_col][0]
+            manual = elec_data[manual_key].str.lower()
+            # get the white matter electrodes and make sure they are not in the bad channel list
+            wm_manual = manual.isin(white_matter_labels) & ~labels.isin(bad_channels)
+            oob_manual = manual.isin(out_of_brain_labels)
+            false_negatives = manual.isin(gray_matter_labels)
         else:
             raise IndexError('No Manual Column!')
-    
+
         # else: # this means we haven't doublechecked the electrode locations manually but trust the automatic locations
         #     print('Beware - no manual examination for electrode locations, could include wm or out-of-brain electrodes')
-        wm_elec_ix_auto += [ind for ind, data in elec_data['gm'].str.lower().items() if data=='white' and pd.isnull(elec_data[manual_key][ind])]
-        oob_elec_ix_auto += [ind for ind, data in elec_data['gm'].str.lower().items() if data=='unknown']
-
-        # # Correct for false negatives in the autodetection that are corrected by manual examination
-        # wm_elec_ix_auto = [x for x in wm_elec_ix_auto if x not in false_negatives]
-        oob_elec_ix_auto = [x for x in oob_elec_ix_auto if x not in false_negatives]
+        auto = elec_data['gm'].str.lower()
+        wm_auto = (auto == 'white') & elec_data[manual_key].isnull()
+        # Correct for false negatives in the autodetection that are corrected by manual examination
+        oob_auto = (auto == 'unknown') & ~false_negatives
 
         # consolidate manual and auto detection 
-        wm_elec_ix = np.unique(wm_elec_ix_manual + wm_elec_ix_auto)
-        oob_elec_ix = np.unique(oob_elec_ix_manual + oob_elec_ix_auto)
-        all_ix = elec_data.index.values
-        gm_elec_ix = np.array([x for x in all_ix if x not in wm_elec_ix and x not in oob_elec_ix])
-
-        cathode_list = []
-        anode_list = []
-        drop_wm_channels = []
-        # reference is anode - cathode, so here wm is cathode
-        # 6/14/23: sped up this code!
-        
-        # compute the distance between all electrodes and white matter electrodes
-        
-        elec_locs = elec_data.loc[gm_elec_ix, ['x', 'y', 'z']].values.astype(float)
-        wm_locs = elec_data.loc[wm_elec_ix, ['x', 'y', 'z']].values.astype(float)
-        dists = np.linalg.norm(elec_locs[:, None, :] - wm_locs[None, :, :], axis=-1)
+        wm_mask = (wm_manual | wm_auto).values
+        oob_mask = (oob_manual | oob_auto).values
+        gm_mask = ~wm_mask & ~oob_mask
+        locs = elec_data[['x', 'y', 'z']].values.astype(float)
+        oob_channels = labels[oob_mask].tolist()
 
-        # only keep the ones in the same hemisphere
-        hemi_mask = np.stack([(elec_data.loc[wm_elec_ix, 'label'].str.lower().str[0]==x).values for x in elec_data.loc[gm_elec_ix, 'label'].str.lower().str[0]])
-        dists[hemi_mask==False] = np.nan
+    elif site == 'UI':
+        labels = elec_data['label'].str.lower()
+        wm_mask = (elec_data['DesikanKilliany'].str.lower().str.contains('white', na=False) & ~elec_data['Channel'].isin(mne_data.info['bads'])).values
+        gm_mask = ~wm_mask
+        locs = elec_data[['mni_x', 'mni_y', 'mni_z']].values.astype(float)
+        oob_channels = []
 
-        # get the 3 closest wm electrodes for each gm electrode
-        closest_wm_elec_ix = np.argpartition(dists, 3, axis=1)[:, :3]
-        # closest_wm_elec_dist = np.take_along_axis(dists, closest_wm_elec_ix, axis=1)
+    # reference is anode - cathode, so here wm is cathode
+    anode_list, cathode_list, closest = _plan_wm_reference(mne_data, labels.values, locs, wm_mask, gm_mask, k=n_wm, average=average)
+
+    # Also collect the wm electrodes that are not used for referencing and drop them later
+    used_wm = set(labels[wm_mask].values[np.unique(closest)]) if average else set(cathode_list)
+    drop_wm_channels = [x for x in labels[wm_mask] if x not in used_wm]
+
+    return anode_list, cathode_list, drop_wm_channels, oob_channels
+
+
+def _wm_oob_masks(elec_data, bad_channels, site='MSSM'):
+    """
+    Classify the contacts of an electrode dataframe as white matter (not bad) and out of brain, from the manual column 
+    and (MSSM only) the automatic 'gm' labels, with the same rules as bipolar_ref. Vectorized over the rows. 
+
+    Returns
+    -------
+    wm_mask : np.ndarray of bool 
+    oob_mask : np.ndarray of bool 
+    """
+
+    labels = elec_data['label'].str.lower()
+    # account for different labeling strategies in manual column
+    white_matter_labels = ['wm', 'white', 'whitematter', 'white matter']
+    gray_matter_labels = ['gm', 'gray', 'graymatter', 'gray matter']
+    out_of_brain_labels = ['oob', 'out of brain']
+    manual_col = elec_data.keys().str.lower().str.contains('manual')
+    if np.any(manual_col):
+        manual = elec_data[elec_data.keys()[manual_col][0]]
+        # an all-empty manual column is read as floats
+        manual_lower = manual.astype(str).str.lower()
+        wm_manual = manual_lower.isin(white_matter_labels) & ~labels.isin(bad_channels)
+        oob_manual = manual_lower.isin(out_of_brain_labels)
+        false_negatives = manual_lower.isin(gray_matter_labels)
+    else:
+        warnings.warn('Warning...........No Manual Column!')
+        manual = pd.Series(np.nan, index=elec_data.index)
+        wm_manual = oob_manual = false_negatives = pd.Series(False, index=elec_data.index)
+
+    wm_mask, oob_mask = wm_manual, oob_manual
+    if site == 'MSSM':
+        auto = elec_data['gm'].str.lower()
+        # Correct for false negatives in the autodetection that are corrected by manual examination
+        oob_mask = oob_mask | ((auto == 'unknown') & ~false_negatives)
+        wm_mask = wm_mask | ((auto == 'white') & manual.isnull())
+
+    return wm_mask.values, oob_mask.values
 
-        # get the variance of the 3 closest wm electrodes
-        wm_data = mne_data.copy().pick_channels(elec_data.loc[wm_elec_ix, 'label'].str.lower().tolist())._data
-        
-        wm_vars = wm_data.var(axis=1)
-        wm_elec_var = []
-        for wm_ix in closest_wm_elec_ix:
-            wm_elec_var.append(wm_vars[wm_ix])
-
-        # get the index of the lowest variance electrode
-        wm_elec_ix_lowest = np.argmin(wm_elec_var, axis=1)
-
-        # get the name of the lowest amplitude electrode
-        wm_elec_name = elec_data.loc[wm_elec_ix[closest_wm_elec_ix[np.arange(len(gm_elec_ix)), wm_elec_ix_lowest]], 'label'].str.lower()
-
-        # get the electrode name
-        anode_list = elec_data.loc[gm_elec_ix, 'label'].str.lower().tolist()
-        cathode_list = wm_elec_name.tolist()
-
-        # # DEPRECATED: This loop is SLOW AF: is there a way to vectorize this for speed?
-        # for elec_ix in gm_elec_ix:
-        #     # get the electrode location
-        #     elec_loc = elec_data.loc[elec_ix, ['x', 'y', 'z']].values.astype(float)
-        #     elec_name = elec_data.loc[elec_ix, 'label'].lower()
-        #     # compute the distance to all wm electrodes
-        #     wm_elec_dist = np.linalg.norm(elec_data.loc[wm_elec_ix, ['x', 'y', 'z']].values.astype(float) - elec_loc, axis=1)
-        #     # get the closest wm electrodes in order
-        #     wm_elec_ix_closest = wm_elec_ix[np.argsort(wm_elec_dist)]
-        #     # only keep the ones in the same hemisphere: 
-        #     wm_elec_ix_closest = [x for x in wm_elec_ix_closest if elec_data.loc[x, 'label'].lower()[0]==elec_name[0]]
-        #     # only keep the 3 closest: 
-        #     wm_elec_ix_closest = wm_elec_ix_closest[0:4]
-        #     # get the variance of the 3 closest wm electrodes
-        #     wm_data = mne_data.copy().pick_channels(elec_data.loc[wm_elec_ix_closest, 'label'].str.lower().tolist())._data
-        #     wm_elec_var = wm_data.var(axis=1)
-        #     # get the index of the lowest variance electrode
-        #     wm_elec_ix_lowest = wm_elec_ix_closest[np.argmin(wm_elec_var)]
-        #     # get the name of the lowest amplitude electrode
-        #     wm_elec_name = elec_data.loc[wm_elec_ix_lowest, 'label'].lower()
-        #     # get the electrode name
-        #     anode_list.append(elec_name)
-        #     cathode_list.append(wm_elec_name)
-            
-        # Also collect the wm electrodes that are not used for referencing and drop them later
-        drop_wm_channels = [x for x in elec_data.loc[wm_elec_ix, 'label'].str.lower() if x not in cathode_list]
-        oob_channels = elec_data.loc[oob_elec_ix, 'label'].str.lower().tolist()
 
-        # cathode_list = np.hstack(cathode_list)
-        # anode_list = np.hstack(anode_list)
+def build_contact_graph(elec_data, site='MSSM', dist_factor=2.):
+    """
+    Contact adjacency graph of an implant, to be computed once per implant (e.g. for laplacian_ref). 
+
+    Contacts on the same shaft (bundle) with consecutive contact numbers are neighbours, unless they are further apart 
+    than dist_factor times the median spacing of consecutive contacts on that shaft (e.g. a numbering gap or a 
+    mislabeled contact). Microwires are left out. 
 
-        return anode_list, cathode_list, drop_wm_channels, oob_channels
+    Parameters
+    ----------
+    elec_data : pandas df 
+        electrode localization information (see load_elec) 
+    site : str 
+        hospital where the recording took place. MSSM bundles come from the labels, UI bundles from the Array (or 
+        ContactLabel) column and contact numbers from the Contact column 
+    dist_factor : float 
+        maximum distance between neighbours, relative to the median contact spacing of the shaft 
 
+    Returns
+    -------
+    contact_graph : dict 
+        'labels', 'bundle', 'number' (one per contact), 'locs' (n_contacts, 3) and 'adjacency' (a symmetric 
+        scipy.sparse.csr_matrix, n_contacts x n_contacts) 
+    """
+
+    elec_data = elec_data.dropna(subset=['label']).reset_index(drop=True)
+    if site == 'MSSM':
+        labels = elec_data['label'].str.lower()
+        elec_data = elec_data[labels.str[0] != 'u'].reset_index(drop=True)
+        labels = elec_data['label'].str.lower()
+        bundle = labels.str.replace(r'\d', '', regex=True)
+        number = pd.to_numeric(labels.str.extract(r'(\d+)$')[0], errors='coerce')
+        locs = elec_data[['x', 'y', 'z']].values.astype(float)
     elif site == 'UI':
-        wm_elec_ix = [ind for ind, data in elec_data['DesikanKilliany'].str.lower().items() if 'white' in data and elec_data['Channel'][ind] not in mne_data.info['bads']]
-        all_ix = elec_data.index.values
-        gm_elec_ix = np.array([x for x in all_ix if x not in wm_elec_ix])
-        wm_elec_ix = np.array(wm_elec_ix)
-
-        cathode_list = []
-        anode_list = []
-        drop_wm_channels = []
-        # reference is anode - cathode, so here wm is cathode
-        elec_locs = elec_data.loc[gm_elec_ix, ['mni_x', 'mni_y', 'mni_z']].values.astype(float)
-        wm_locs = elec_data.loc[wm_elec_ix, ['mni_x', 'mni_y', 'mni_z']].values.astype(float)
-        dists = np.linalg.norm(elec_locs[:, None, :] - wm_locs[None, :, :], axis=-1)
-
-        # only keep the ones in the same hemisphere
-        hemi_mask = np.stack([(elec_data.loc[wm_elec_ix, 'label'].str.lower().str[0]==x).values for x in elec_data.loc[gm_elec_ix, 'label'].str.lower().str[0]])
-        dists[hemi_mask==False] = np.nan
-
-        # get the 3 closest wm electrodes for each gm electrode
-        closest_wm_elec_ix = np.argpartition(dists, 3, axis=1)[:, :3]
-        # closest_wm_elec_dist = np.take_along_axis(dists, closest_wm_elec_ix, axis=1)
-
-        # get the variance of the 3 closest wm electrodes
-        wm_data = mne_data.copy().pick_channels(elec_data.loc[wm_elec_ix, 'label'].str.lower().tolist())._data
-        
-        wm_vars = wm_data.var(axis=1)
-        wm_elec_var = []
-        for wm_ix in closest_wm_elec_ix:
-            wm_elec_var.append(wm_vars[wm_ix])
+        labels = elec_data['label']
+        key = 'Array' if any(elec_data.keys().str.contains('Array')) else 'ContactLabel'
+        bundle = (elec_data[key] != elec_data[key].shift()).cumsum()
+        number = pd.to_numeric(elec_data['Contact'], errors='coerce')
+        locs = elec_data[['mni_x', 'mni_y', 'mni_z']].values.astype(float)
 
-        # get the index of the lowest variance electrode
-        wm_elec_ix_lowest = np.argmin(wm_elec_var, axis=1)
+    # consecutive contacts of each shaft, in contact order
+    order = np.lexsort((number.values, pd.factorize(bundle)[0]))
+    same_bundle = bundle.values[order][1:] == bundle.values[order][:-1]
+    consecutive = (number.values[order][1:] - number.values[order][:-1]) == 1
+    a, b = order[:-1][same_bundle & consecutive], order[1:][same_bundle & consecutive]
 
-        # get the name of the lowest amplitude electrode
-        wm_elec_name = elec_data.loc[wm_elec_ix[closest_wm_elec_ix[np.arange(len(gm_elec_ix)), wm_elec_ix_lowest]], 'label'].str.lower()
-        
-        # get the electrode name
-        anode_list = elec_data.loc[gm_elec_ix, 'label'].str.lower().tolist()
-        cathode_list = wm_elec_name.tolist()
-
-        # NOTE: This loop is SLOW AF: is there a way to vectorize this for speed?
-        # for elec_ix in gm_elec_ix:
-        #     # get the electrode location
-        #     elec_loc = elec_data.loc[elec_ix, ['mni_x', 'mni_y', 'mni_z']].values.astype(float)
-        #     elec_name = elec_data.loc[elec_ix, 'label'].lower()
-        #     # compute the distance to all wm electrodes
-        #     wm_elec_dist = np.linalg.norm(elec_data.loc[wm_elec_ix, ['mni_x', 'mni_y', 'mni_z']].values.astype(float) - elec_loc, axis=1)
-        #     # get the 3 closest wm electrodes
-        #     wm_elec_ix_closest = wm_elec_ix[np.argsort(wm_elec_dist)[:4]]
-        #     # only keep the ones in the same hemisphere: 
-        #     wm_elec_ix_closest = [x for x in wm_elec_ix_closest if elec_data.loc[x, 'label'].lower()[0]==elec_data.loc[elec_ix, 'label'].lower()[0]]
-        #     # get the variance of the 3 closest wm electrodes
-        #     wm_data = mne_data.copy().pick_channels(elec_data.loc[wm_elec_ix_closest, 'label'].str.lower().tolist())._data
-        #     wm_elec_var = wm_data.var(axis=1)
-        #     # get the index of the lowest variance electrode
-        #     wm_elec_ix_lowest = wm_elec_ix_closest[np.argmin(wm_elec_var)]
-        #     # get the name of the lowest amplitude electrode
-        #     wm_elec_name = elec_data.loc[wm_elec_ix_lowest, 'label'].lower()
-        #     # get the electrode name
-        #     anode_list.append(elec_name)
-        #     cathode_list.append(wm_elec_name)
-
-        # Also collect the wm electrodes that are not used for referencing and drop them later
-        drop_wm_channels = [x for x in elec_data.loc[wm_elec_ix, 'label'].str.lower() if x not in cathode_list]
-
-        return anode_list, cathode_list, drop_wm_channels
-
-
-def laplacian_ref(mne_data, elec_path, bad_channels, unmatched_seeg=None, site=None):
-    """
-    Return the cathode list and anode list for mne to use for laplacian referencing.
-
-    In this case, the cathode is the average of the surrounding electrodes. If an edge electrode, it's just bipolar. 
+    # drop the links that are much longer than the typical spacing of their shaft (NaN coordinates can't be checked)
+    dists = np.linalg.norm(locs[a] - locs[b], axis=1)
+    spacing = pd.Series(dists).groupby(bundle.values[a]).transform('median').values
+    keep = ~(dists > dist_factor * spacing)
+    a, b = a[keep], b[keep]
+
+    n = len(labels)
+    adjacency = sparse.csr_matrix((np.ones(2 * len(a), dtype=bool), (np.r_[a, b], np.r_[b, a])), shape=(n, n))
+
+    return {'labels': labels.values, 'bundle': bundle.values, 'number': number.values, 'locs': locs, 'adjacency': adjacency}
+
+
+def laplacian_ref(mne_data, elec_path, bad_channels, unmatched_seeg=None, site='MSSM', contact_graph=None):
+    """
+    Return the cathode list and anode list for laplacian referencing.
+
+    In this case, the cathode is the average of the surrounding electrodes (its neighbours on the shaft, see 
+    build_contact_graph). If an edge electrode (or only one of its neighbours is usable), it's just bipolar. 
+    Bad, out-of-brain and unmatched contacts are never used, and contacts that are in white matter along with all 
+    their neighbours are dropped (as in bipolar_ref). 
+
+    The cathodes of interior contacts are lists, which mne.set_bipolar_reference can't apply: use 
+    ref_mne(..., method='laplacian') or make_reref_operator. 
 
     Parameters
     ----------
@@ -703,67 +814,67 @@ def laplacian_ref(mne_data, elec_path, bad_channels, unmatched_seeg=None, site=N
         List of channels that were not in the edf file 
     site : str
         Hospital where the recording took place 
+    contact_graph : dict 
+        precomputed output of build_contact_graph for this implant (computed from elec_path if None)
 
     Returns
     -------
     anode_list : list 
         List of channels to subtract from
     cathode_list : list 
-        List of channels to subtract
+        List of channels to subtract (a list of channels to average for interior contacts)
+    drop_wm_channels : list 
+        List of white matter channels which were not referenced 
+    oob_channels : list 
+        List of out-of-brain channels 
     """
 
-    # TODO: for someone clever. Note that you have to bypass the mne reference script because that specific a single reference for each electrode.
-
-    # elec_data = load_elec(elec_path)
-    # elec_data['bundle'] = np.nan
-    # elec_data['bundle'] = elec_data.apply(lambda x: ''.join(i for i in x.label if not i.isdigit()), axis=1)
-
-
-    # # helper function to perform sort for bipolar electrodes:
-    # def sort_strings(strings):
-    #     # Create a regular expression pattern to extract the number at the end of each string
-    #     pattern = re.compile(r'\d+$')
-
-    #     # Sort the strings using a custom key function
-    #     sorted_strings = sorted(strings, key=lambda x: int(pattern.search(x).group()), reverse=False)
+    elec_data = load_elec(elec_path, site=site)
+    elec_data = elec_data.dropna(subset=['label']).reset_index(drop=True)
+    if contact_graph is None:
+        contact_graph = build_contact_graph(elec_data, site=site)
 
-    #     return sorted_strings
+    labels = contact_graph['labels']
+    label_col = elec_data['label'].str.lower() if site == 'MSSM' else elec_data['label']
+    wm_mask, oob_mask = _wm_oob_masks(elec_data, bad_channels if bad_channels is not None else [], site=site)
+    wm_channels = set(label_col[wm_mask])
+    oob_channels = label_col[oob_mask].tolist()
 
-    # cathode_list = [] 
-    # anode_list = [] 
+    # contacts that can be used at all
+    unusable = set(bad_channels or []) | set(unmatched_seeg or []) | set(oob_channels)
+    if mne_data is not None:
+        unusable |= set(labels) - set(mne_data.ch_names)
+    usable = ~pd.Series(labels).isin(unusable).values
 
-    # if site=='MSSM':
+    adjacency = contact_graph['adjacency'].tocsr()
 
-    #     for bundle in elec_data.bundle.unique():
-    #         if bundle[0] == 'u':
-    #             print('this is a microwire, pass')
-    #             continue         
-    #         # Isolate the electrodes in each bundle 
-    #         bundle_df = elec_data[elec_data.bundle==bundle].sort_values(by='z', ignore_index=True)
-    #         all_elecs = bundle_df.label.tolist()
-    #         # Sort them by number 
-    #         all_elecs = sort_strings(all_elecs)
-    #         # make sure these are not bad channels 
-    #         all_elecs = [x for x in all_elecs if x not in bad_channels]
-    #         # Set the cathodes and anodes 
-    #         for i, elec in enumerate(all_elecs):
-    #             # Set the bipolar conditions
-    #             if i == 0:
-    #                 cathode_list.append(elec)
-    #                 anode_list.append((all_elecs[i+1])
-    #             elif i == len(all_elecs) - 1:
-    #                 cathode_list.append(elec)
-    #                 anode_list.append((all_elecs[i-1])  
-    #             # Set the laplace conditions 
-    #             # else:
-    #             # TODO: add laplace conditions here
+    anode_list = [] 
+    cathode_list = [] 
+    drop_wm_channels = [] 
+    for ix in np.where(usable)[0]:
+        # usable neighbours on the shaft
+        neighbours = adjacency.indices[adjacency.indptr[ix]:adjacency.indptr[ix+1]]
+        neighbours = labels[np.sort(neighbours[usable[neighbours]])].tolist()
+        if len(neighbours) == 0:
+            continue
+        # I need to make sure I drop any channels where all the electrodes are in the wm
+        if (labels[ix] in wm_channels) and all([x in wm_channels for x in neighbours]):
+            drop_wm_channels.append(labels[ix])
+            continue
+        anode_list.append(labels[ix])
+        # laplacian for interior contacts, bipolar at the edges
+        cathode_list.append(neighbours if len(neighbours) > 1 else neighbours[0])
 
-    # return anode_list, cathode_list
+    return anode_list, cathode_list, drop_wm_channels, oob_channels
 
-def bipolar_ref(elec_path, bad_channels, unmatched_seeg=None, site='MSSM'):
+def bipolar_ref(elec_path, bad_channels, unmatched_seeg=None, site='MSSM', return_pairs=False):
     """
     Return the cathode list and anode list for mne to use for bipolar referencing.
 
+    Neighbouring contacts of each bundle (in contact order, skipping bad channels) are paired. Pairs where both 
+    contacts are in white matter are dropped (and listed in drop_wm_channels), pairs with an out-of-brain contact are 
+    skipped. 
+
     Parameters
     ----------
     elec_data : pandas df 
@@ -774,6 +885,10 @@ def bipolar_ref(elec_path, bad_channels, unmatched_seeg=None, site='MSSM'):
         list of channels that were not in the edf file 
     site : str
         hospital where the recording took place 
+    return_pairs : bool 
+        also return the pair table (one row per candidate pair: bundle, anode, cathode, anode_wm, cathode_wm, 
+        anode_oob, cathode_oob, status in ['keep', 'wm', 'oob']), e.g. to cache the plan or to inspect why a pair 
+        was dropped 
 
     Returns
     -------
@@ -781,148 +896,126 @@ def bipolar_ref(elec_path, bad_channels, unmatched_seeg=None, site='MSSM'):
         list of channels to subtract from
     cathode_list : list 
         list of channels to subtract
+    drop_wm_channels : list 
+        white matter channels (both contacts of each dropped pair)
+    oob_channels : list 
+        out-of-brain channels 
+    pairs : pandas df 
+        the pair table (only if return_pairs)
     """
 
+    if unmatched_seeg is None:
+        unmatched_seeg = []
+
     elec_data = load_elec(elec_path, site=site)
-    elec_data['bundle'] = np.nan
     elec_data = elec_data.dropna(subset=['label']) ## added by AD
-    if site == 'MSSM':
-        elec_data['bundle'] = elec_data.apply(lambda x: ''.join(i for i in x.label if not i.isdigit()), axis=1)
-    elif site == 'UI':
-        if any(elec_data.keys().str.contains('Array')):
-            elec_data['bundle'] = (elec_data['Array'] != elec_data['Array'].shift()).cumsum()
-        elif any(elec_data.keys().str.contains('ContactLabel')):
-            elec_data['bundle'] = (elec_data['ContactLabel'] != elec_data['ContactLabel'].shift()).cumsum()
+    labels = elec_data['label'].str.lower()
+    # drop channels that weren't recorded and microwires
+    elec_data = elec_data[~labels.isin(unmatched_seeg) & (labels.str[0] != 'u')].reset_index(drop=True)
+    labels = elec_data['label'].str.lower()
 
-    drop_from_locs = []
-    for ind, data in elec_data['label'].str.lower().items(): 
-        if data in unmatched_seeg:
-            drop_from_locs.append(ind)
-        elif data[0] == 'u':
-            drop_from_locs.append(ind)
+    # get the white matter electrodes (not in the bad channel list) and the out-of-brain electrodes 
+    wm_mask, oob_mask = _wm_oob_masks(elec_data, bad_channels, site=site)
+    wm_channels = set(labels[wm_mask])
+    oob_channels = labels[oob_mask].tolist()
 
-    elec_data = elec_data.drop(index=drop_from_locs).reset_index(drop=True)
+    if site == 'MSSM':
+        contacts = labels
+        bundle = elec_data['label'].str.replace(r'\d', '', regex=True)
+        # contact order: number at the end of the label (ties broken by depth)
+        number = pd.to_numeric(labels.str.extract(r'(\d+)$')[0], errors='coerce').values
+        depth = elec_data['z'].values.astype(float)
+    elif site == 'UI':
+        contacts = elec_data['label']
+        key = 'Array' if any(elec_data.keys().str.contains('Array')) else 'ContactLabel'
+        bundle = (elec_data[key] != elec_data[key].shift()).cumsum()
+        number = pd.to_numeric(elec_data['Contact'], errors='coerce').values
+        depth = np.zeros(len(elec_data))
+
+    # sort the contacts by bundle (in order of first appearance), then by contact number, then drop the bad channels
+    bundle_order = pd.factorize(bundle)[0]
+    order = np.lexsort((depth, number, bundle_order))
+    order = order[~contacts.isin(bad_channels).values[order]]
+
+    contacts = contacts.values[order]
+    bundle = bundle.values[order]
+    same_bundle = bundle[1:] == bundle[:-1]
+
+    pairs = pd.DataFrame({'bundle': bundle[1:][same_bundle],
+                          'anode': contacts[:-1][same_bundle],
+                          'cathode': contacts[1:][same_bundle]})
+    pairs['anode_wm'] = pairs['anode'].isin(wm_channels)
+    pairs['cathode_wm'] = pairs['cathode'].isin(wm_channels)
+    pairs['anode_oob'] = pairs['anode'].isin(oob_channels)
+    pairs['cathode_oob'] = pairs['cathode'].isin(oob_channels)
+
+    # I need to make sure I drop any channels where both electrodes are in the wm
+    # POSSIBLE ALTERNATIVE FOR FUTURE USERS: you can determine if the "virtual" electrode is in gray matter or not.
+    # I need to make sure I drop any channels where either electrode is out of the brain
+    pairs['status'] = np.where(pairs['anode_wm'] & pairs['cathode_wm'], 'wm', 
+                               np.where(pairs['anode_oob'] | pairs['cathode_oob'], 'oob', 'keep'))
+
+    keep = pairs['status'] == 'keep'
+    anode_list = pairs.loc[keep, 'anode'].tolist()
+    cathode_list = pairs.loc[keep, 'cathode'].tolist()
+    # cathode then anode of each dropped pair
+    drop_wm_channels = pairs.loc[pairs['status'] == 'wm', ['cathode', 'anode']].values.ravel().tolist()
+
+    if return_pairs:
+        return anode_list, cathode_list, drop_wm_channels, oob_channels, pairs
 
-    # get the white matter electrodes and make sure they are note in the bad channel list
-    wm_elec_ix_manual = [] 
-    wm_elec_ix_auto = []
-    oob_elec_ix_manual = [] 
-    oob_elec_ix_auto = []
-    false_negatives = [] 
-    # account for different labeling strategies in manual column
-    white_matter_labels = ['wm', 'white', 'whitematter', 'white matter']
-    gray_matter_labels = ['gm', 'gray', 'graymatter', 'gray matter']
-    out_of_brain_labels = ['oob', 'out of brain']
-    manual_col = elec_data.keys().str.lower().str.contains('manual')
-    if np.any(manual_col):
-        manual_key = elec_data.keys()[elec_data.keys().str.lower().str.contains('manual')][0]
-        wm_elec_ix_manual += [ind for ind, data in elec_data[manual_key].str.lower().items() if data in white_matter_labels and elec_data['label'].str.lower()[ind] not in bad_channels]
-        oob_elec_ix_manual += [ind for ind, data in elec_data[manual_key].str.lower().items() if data in out_of_brain_labels]
-        false_negatives += [ind for ind, data in elec_data[manual_key].str.lower().items() if data in gray_matter_labels]
-    else:
-        warnings.warn('Warning...........No Manual Column!')
+    return anode_list, cathode_list, drop_wm_channels, oob_channels
 
-    # else: # this means we haven't doublechecked the electrode locations manually but trust the automatic locations
-    #     print('Beware - no manual examination for electrode locations, could include wm or out-of-brain electrodes')
-    
-    if site == 'MSSM':
-        oob_elec_ix_auto += [ind for ind, data in elec_data['gm'].str.lower().items() if data=='unknown']
-        wm_elec_ix_auto += [ind for ind, data in elec_data['gm'].str.lower().items() if data=='white' and pd.isnull(elec_data[manual_key][ind])]
 
-    # # Correct for false negatives in the autodetection that are corrected by manual examination
-    # wm_elec_ix_auto = [x for x in wm_elec_ix_auto if x not in false_negatives]
-    oob_elec_ix_auto = [x for x in oob_elec_ix_auto if x not in false_negatives]
+def _batch_match_names(unmatched_seeg, mne_names, loc_names, cutoff=0.49, overrides=None):
+    """
+    Non-interactive matching of localization names to mne names: one similarity matrix (same score as lev.ratio) for all 
+    pairs, candidates with a different contact number or that are legit localization names are excluded, and the 
+    remaining pairs are assigned jointly (Hungarian algorithm) so each mne name is used at most once. Names are sorted 
+    before scoring so ties are always resolved the same way (by name), whatever the order of unmatched_seeg. 
 
-    # consolidate manual and auto detection 
-    wm_elec_ix = np.unique(wm_elec_ix_manual + wm_elec_ix_auto)
-    oob_elec_ix = np.unique(oob_elec_ix_manual + oob_elec_ix_auto)
+    Unlike the levenshtein method, which only compares the first digit of the two names, the contact number is the 
+    whole digit string here (e.g. 'la1' can't be matched to 'la12'). 
 
-    wm_channels = elec_data['label'].str.lower()[wm_elec_ix].tolist()
-    oob_channels = elec_data['label'].str.lower()[oob_elec_ix].tolist()
+    Returns
+    -------
+    matches : dict 
+        {localization name: mne name}
+    """
 
-    # helper function to perform sort for bipolar electrodes:
-    def sort_strings(strings):
-        # Create a regular expression pattern to extract the number at the end of each string
-        pattern = re.compile(r'\d+$')
+    matches = {}
+    if overrides is not None:
+        if isinstance(overrides, str):
+            with open(overrides, 'r') as f:
+                overrides = json.load(f)
+        overrides = {k.lower(): v.replace(" ", "").lower() for k, v in overrides.items()}
+        matches = {k: v for k, v in overrides.items() if (k in unmatched_seeg) and (v in mne_names)}
 
-        # Sort the strings using a custom key function
-        sorted_strings = sorted(strings, key=lambda x: int(pattern.search(x).group()), reverse=False)
+    loc_set = set(loc_names)
+    matched = set(matches.values())
+    elecs = sorted([x for x in unmatched_seeg if x not in matches])
+    candidates = sorted([x for x in set(mne_names) if x not in loc_set and x not in matched])
+    if (len(elecs) == 0) or (len(candidates) == 0):
+        return matches
 
-        return sorted_strings
+    scores = process.cdist(elecs, candidates, scorer=fuzz.ratio, workers=-1) / 100
 
-    cathode_list = [] 
-    anode_list = [] 
-    drop_wm_channels = [] 
+    # Make sure this isn't matched to a similar named channel on the same probe with a different NUMBER
+    elec_nums = np.array([re.sub(r'\D', '', x) for x in elecs])
+    cand_nums = np.array([re.sub(r'\D', '', x) for x in candidates])
+    valid = (elec_nums[:, None] == cand_nums[None, :]) & (scores >= cutoff)
 
-    if site=='MSSM':
-
-        for bundle in elec_data.bundle.unique():
-            if bundle[0] == 'u':
-                print('this is a microwire, pass')
-                continue         
-            # Isolate the electrodes in each bundle 
-            bundle_df = elec_data[elec_data.bundle==bundle].sort_values(by='z', ignore_index=True)
-            all_elecs = bundle_df.label.str.lower().tolist()
-            # Sort them by number 
-            all_elecs = sort_strings(all_elecs)
-            # make sure these are not bad channels 
-            all_elecs = [x for x in all_elecs if x not in bad_channels]
-            # Set the cathodes and anodes 
-            cath = all_elecs[1:]
-            an = all_elecs[:-1]
-            for c, a in zip(cath, an):
-            # I need to make sure I drop any channels where both electrodes are in the wm
-            # POSSIBLE ALTERNATIVE FOR FUTURE USERS: you can determine if the "virtual" electrode is in gray matter or not.
-                if (c in wm_channels) and (a in wm_channels):
-                    drop_wm_channels.append(c)
-                    drop_wm_channels.append(a)
-                    continue
-                # I need to make sure I drop any channels where either electrode is out of the brain
-                elif (c in oob_channels) or (a in oob_channels):
-                    continue
-                else:
-                    cathode_list.append(c)
-                    anode_list.append(a)
-            # # I need to make sure I drop any channels where both electrodes are in the wm
-            # if cath in wm_channels and an in wm_channels:
-            #     drop_wm_channels.append(cath)
-            #     drop_wm_channels.append(an)
-            #     continue
-            # # I need to make sure I drop any channels where either electrode is out of the brain
-            # elif cath in oob_channels or an in oob_channels:
-            #     continue
-            # else:
-            #     cathode_list = cathode_list + cath
-            #     anode_list = anode_list + an
-
-    elif site=='UI':
-
-        for bundle in elec_data.bundle.unique():
-            # Isolate the electrodes in each bundle 
-            bundle_df = elec_data[elec_data.bundle==bundle].sort_values(by='Contact', ignore_index=True)
-            all_elecs = bundle_df.label.tolist()
-            # make sure these are not bad channels 
-            all_elecs = [x for x in all_elecs if x not in bad_channels]
-            # Set the cathodes and anodes 
-            cath = all_elecs[1:]
-            an = all_elecs[:-1]
-            for c, a in zip(cath, an):
-            # I need to make sure I drop any channels where both electrodes are in the wm
-                if (c in wm_channels) and (a in wm_channels):
-                    drop_wm_channels.append(c)
-                    drop_wm_channels.append(a)
-                    continue
-                # I need to make sure I drop any channels where either electrode is out of the brain
-                elif (c in oob_channels) or (a in oob_channels):
-                    continue
-                else:
-                    cathode_list.append(c)
-                    anode_list.append(a)
+    # invalid pairs get a cost no valid assignment can beat, and are discarded afterwards
+    cost = np.where(valid, -scores, 1.)
+    rows, cols = linear_sum_assignment(cost)
+    for r, c in zip(rows, cols):
+        if valid[r, c]:
+            matches[elecs[r]] = candidates[c]
 
-    return anode_list, cathode_list, drop_wm_channels, oob_channels
+    return matches
 
 
-def match_elec_names(mne_names, loc_names, method='levenshtein'):
+def match_elec_names(mne_names, loc_names, method='levenshtein', overrides=None):
     """
     The electrode names read out of the edf file do not always match those 
     in the pdf (used for localization). This could be error on the side of the tech who input the labels, 
@@ -936,6 +1029,12 @@ def match_elec_names(mne_names, loc_names, method='levenshtein'):
         list of electrode names in the recording data (mne)
     loc_names : list 
         list of electrode names in the pdf, used for the localization
+    method : str 
+        'levenshtein' (may ask for a manual tiebreak), 'batch' (non-interactive: full similarity matrix and a 
+        Hungarian assignment, for unattended runs) or anything else for difflib matching 
+    overrides : dict or str 
+        manual matches {localization name: mne name} (or the path of a json file with them), used before the 
+        automatic matching. Only for method='batch'
 
     Returns
     -------
@@ -980,7 +1079,17 @@ def match_elec_names(mne_names, loc_names, method='levenshtein'):
     matched_elecs = []
     replaced_elec_names = []
     cutoff=0.49
-    if method=='levenshtein':
+    if method=='batch':
+        matches = _batch_match_names(unmatched_seeg, mne_names, loc_names, cutoff=cutoff, overrides=overrides)
+        for elec in unmatched_seeg:
+            if elec in matches:
+                # agree on one name: the localization name 
+                new_mne_names[mne_names.index(matches[elec])] = elec
+                replaced_elec_names.append(matches[elec])
+                matched_elecs.append(elec)
+            else:
+                print(f"Could not find a match for {elec}.")
+    elif method=='levenshtein':
         for elec in unmatched_seeg:
             all_lev_ratios = [(x, lev.ratio(elec, x)) for x in mne_names]
             # 9/8/23: Sometimes this algo fails and returns multiple matches with equal distances from the real name: MANUALLY DO THE TIEBREAKER
@@ -1099,30 +1208,185 @@ def detect_bad_elecs(mne_data, sEEG_mapping_dict):
     # 
     return bad_channels
 
-def detect_misc_artifacts(mne_data, peak_thresh=6):
+# frequency bands (Hz) of the band envelopes used by the detectors: IEDs, ripples and high-frequency activity
+ENVELOPE_BANDS = {'ied': (25, 80), 
+                  'ripple': (80, 120), 
+                  'hfa': (70, 150)}
+
+
+def compute_band_envelopes(mne_data, bands=None, signals=(), picks=None, chunk_size=2**15, out_dir=None): 
+    """
+    Amplitude envelopes of several frequency bands, computed in a single chunked pass over the data. 
+
+    Each chunk of samples is read once and Fourier transformed once. For each band it is multiplied by the spectrum of 
+    the analytic (one-sided) version of the same zero-phase FIR band-pass that mne's filter uses, and inverse 
+    transformed (overlap-save), so the result is the envelope of the band-passed signal (filter + hilbert) without 
+    copying the recording. The edges are padded like mne's filter does (odd reflection). 
+
+    Parameters
+    ----------
+    mne_data : mne Raw object 
+        continuous data (preloaded or not) 
+    bands : dict 
+        {name: (l_freq, h_freq)}. Defaults to ENVELOPE_BANDS (ied, ripple, hfa). Bands above the Nyquist frequency are 
+        skipped with a warning 
+    signals : list 
+        bands whose band-passed signal (the real part of the analytic signal) is also returned, as '{band}_signal' 
+        (e.g. 'ripple' for detect_ripple_evs) 
+    picks : list 
+        channel indices (defaults to all channels) 
+    chunk_size : int 
+        number of output samples per chunk. Memory use is about n_picks x chunk_size complex samples per band 
+    out_dir : str 
+        if given, the envelopes are written to (and returned as memmaps of) {out_dir}/{band}_envelope.npy 
+
+    Returns
+    -------
+    envelopes : dict 
+        {band name: float32 array (n_picks, n_times)}, plus {'{band}_signal': float32 array} for the bands in signals 
+    """
+
+    if bands is None:
+        bands = ENVELOPE_BANDS
+    if picks is None:
+        picks = np.arange(len(mne_data.ch_names))
+    picks = np.asarray(picks, dtype=int)
+    sr = mne_data.info['sfreq']
+    n_times = mne_data.n_times
+
+    kernels = {}
+    for band, (l_freq, h_freq) in bands.items():
+        if h_freq >= sr / 2:
+            warnings.warn(f'{band} band ({l_freq}-{h_freq} Hz) is above the Nyquist frequency - skipping it')
+            continue
+        kernels[band] = mne.filter.create_filter(None, sr, l_freq, h_freq, fir_design='firwin', verbose=False)
+    if len(kernels) == 0:
+        return {}
+
+    # zero-phase kernels all centred on the longest one so that they share the same delay
+    half = max([(len(h) - 1) // 2 for h in kernels.values()])
+    kernels = {band: np.pad(h, half - (len(h) - 1) // 2) for band, h in kernels.items()}
+    # the analytic kernels are longer than the FIR (the hilbert part decays slowly): read 3 half-lengths on each side
+    margin = 3 * half
+    chunk_size = max(chunk_size, 2 * margin + 1)
+
+    outputs = list(kernels.keys()) + [f'{band}_signal' for band in signals if band in kernels]
+    envelopes = {}
+    for name in outputs:
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+            fname = f'{name}.npy' if name.endswith('_signal') else f'{name}_envelope.npy'
+            envelopes[name] = np.lib.format.open_memmap(os.path.join(out_dir, fname), mode='w+', 
+                                                        dtype=np.float32, shape=(len(picks), int(n_times)))
+        else:
+            envelopes[name] = np.empty((len(picks), n_times), dtype=np.float32)
+
+    spectra = {}
+    for start in range(0, n_times, chunk_size):
+        stop = min(n_times, start + chunk_size)
+        # input samples start-margin:stop+margin, padded at the edges of the recording
+        seg_start, seg_stop = max(0, start - margin), min(n_times, stop + margin)
+        seg = _read_chunk(mne_data, picks, seg_start, seg_stop).astype(np.float64)
+        pad_left, pad_right = margin - (start - seg_start), margin - (seg_stop - stop)
+        if pad_left or pad_right:
+            seg = mne.filter._smart_pad(seg, np.array([pad_left, pad_right]))
+
+        n_fft = next_fast_len(seg.shape[-1])
+        if n_fft not in spectra:
+            # one-sided spectrum of each kernel (analytic filter), kept for every fft length used
+            weights = np.zeros(n_fft // 2 + 1)
+            weights[0] = 1
+            weights[1:(n_fft + 1) // 2] = 2
+            if n_fft % 2 == 0:
+                weights[-1] = 1
+            spectra[n_fft] = {band: scipy.fft.rfft(h, n_fft) * weights for band, h in kernels.items()}
+
+        seg_fft = scipy.fft.rfft(seg, n_fft, axis=-1, workers=-1)
+        analytic = np.zeros((len(picks), n_fft), dtype=np.complex128)
+        for band in kernels.keys():
+            analytic[:, :n_fft // 2 + 1] = seg_fft * spectra[n_fft][band]
+            # the output sample i of the chunk is sample i + margin + half of the (linear) convolution
+            band_signal = scipy.fft.ifft(analytic, axis=-1, workers=-1)[:, margin + half:margin + half + stop - start]
+            envelopes[band][:, start:stop] = np.abs(band_signal)
+            if f'{band}_signal' in envelopes:
+                envelopes[f'{band}_signal'][:, start:stop] = band_signal.real
+
+    for name in envelopes.keys():
+        if isinstance(envelopes[name], np.memmap):
+            envelopes[name].flush()
+
+    return envelopes
+
+
+def detect_misc_artifacts(mne_data, peak_thresh=6, chunk_size=2**16):
     """
     This function detects artifacts (sharp transients) in the LFP signal automatically. 
-    
+
+    Samples where the zscored gradient of the signal is above peak_thresh are artifacts. The recording is streamed 
+    twice, a chunk of samples at a time and without copying it: once for the mean and std of the gradient of each 
+    channel, once to threshold it. 
+
+    Parameters
+    ----------
+    mne_data : mne object 
+        raw data (preloaded or not) 
+    peak_thresh : float 
+        zscore threshold 
+    chunk_size : int 
+        number of samples per chunk (peak memory is a few times n_channels x chunk_size) 
+
+    Returns
+    -------
+    artifact_sec_dict : dict 
+        {channel name: times of the artifact samples (s)} 
     """
-    # 1. take the gradient of the signal: 
-    gradient_signal = np.gradient(mne_data.copy()._data, axis=-1)
 
-    # 2. zscore the gradient of the signal:
-    zscored_gradient = zscore(gradient_signal, axis=-1)
+    picks = np.arange(len(mne_data.ch_names))
 
-    # 3. find where the zscored gradient is above 5
-    artifact_samps = np.where(np.abs(zscored_gradient) >= peak_thresh)
+    # 1. mean and std of the gradient of the signal: 
+    mean, var = _streaming_moments(mne_data, picks, chunk_size=chunk_size, gradient=True)
+    std = np.sqrt(var)
 
-    artifact_samps_dict = {f'{x}':np.nan for x in mne_data.ch_names}
-    artifact_sec_dict = {f'{x}':np.nan for x in mne_data.ch_names}
+    # 2./3. zscore the gradient of the signal and find where it is above the threshold, chunk by chunk
+    artifact_chans = []
+    artifact_samps = []
+    for start in range(0, mne_data.n_times, chunk_size):
+        stop = min(mne_data.n_times, start + chunk_size)
+        gradient_signal = _read_chunk(mne_data, picks, start, stop, gradient=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            chans, samps = np.where(np.abs((gradient_signal - mean[:, None]) / std[:, None]) >= peak_thresh)
+        artifact_chans.append(chans)
+        artifact_samps.append(samps + start)
+    artifact_chans = np.concatenate(artifact_chans)
+    artifact_samps = np.concatenate(artifact_samps)
 
-    for ch_ in mne_data.ch_names:
-        artifact_samps_dict[ch_] = artifact_samps[1][artifact_samps[0] == mne_data.ch_names.index(ch_)]
-        artifact_sec_dict[ch_] = (artifact_samps_dict[ch_] / mne_data.info['sfreq'])
+    # group the detections by channel with one (stable, so still time-ordered) sort
+    order = np.argsort(artifact_chans, kind='stable')
+    artifact_chans, artifact_samps = artifact_chans[order], artifact_samps[order]
+    bounds = np.searchsorted(artifact_chans, np.arange(len(picks) + 1))
+
+    artifact_sec_dict = {f'{x}':(artifact_samps[bounds[ix]:bounds[ix+1]] / mne_data.info['sfreq']) for ix, x in enumerate(mne_data.ch_names)}
 
     return artifact_sec_dict
 
-def detect_IEDs(mne_data, peak_thresh=5, closeness_thresh=0.25, width_thresh=0.2): 
+def _local_IEDs(IED_samps, all_IEDs, across_chan_threshold_samps, n_closest=5):
+    """
+    Which IEDs are not present on enough electrodes: True for the IEDs whose n_closest closest IEDs across all channels 
+    (themselves included) are not all closer than across_chan_threshold_samps. 
+
+    all_IEDs must be sorted (NaNs are ignored). Counts the IEDs within the threshold with two binary searches per IED 
+    instead of sorting the distances to all of them.
+    """
+
+    IED_samps = np.asarray(IED_samps)
+    all_IEDs = all_IEDs[~np.isnan(all_IEDs)]
+    n_close = (np.searchsorted(all_IEDs, IED_samps + across_chan_threshold_samps, side='left') - 
+               np.searchsorted(all_IEDs, IED_samps - across_chan_threshold_samps, side='right'))
+
+    return n_close < min(n_closest, len(all_IEDs))
+
+
+def detect_IEDs(mne_data, peak_thresh=5, closeness_thresh=0.25, width_thresh=0.2, envelopes=None): 
     """
     This function detects IEDs in the LFP signal automatically. Alternative to manual marking of each ied. 
 
@@ -1147,6 +1411,9 @@ def detect_IEDs(mne_data, peak_thresh=5, closeness_thresh=0.25, width_thresh=0.2
         the closeness threshold in time
     width_thresh : float 
         the width threshold for IEDs 
+    envelopes : dict 
+        (continuous data only) precomputed band envelopes of mne_data (see compute_band_envelopes), of which the 'ied' 
+        band is used. Computed here if None 
 
     Returns
     -------
@@ -1171,99 +1438,154 @@ def detect_IEDs(mne_data, peak_thresh=5, closeness_thresh=0.25, width_thresh=0.2
     min_width = width_thresh * sr
     across_chan_threshold_samps = closeness_thresh * sr # This sets a threshold for detecting cross-channel IEDs 
 
-    # filter data in beta-gamma band
-    filtered_data = mne_data.copy().filter(25, 80, n_jobs=-1)
-
-    n_fft = next_fast_len(n_times)
-
-    # Hilbert bandpass amplitude 
-    filtered_data = filtered_data.apply_hilbert(envelope=True, n_fft=n_fft, n_jobs=-1)
-
-    # Rectify: 
-    filtered_data._data[filtered_data._data<0] = 0
-
-    # Zscore
-    filtered_data.apply_function(lambda x: zscore(x, axis=-1))
     IED_samps_dict = {f'{x}':np.nan for x in mne_data.ch_names}
     IED_sec_dict = {f'{x}':np.nan for x in mne_data.ch_names}
 
     if data_type == 'continuous':
-        for ch_ in filtered_data.ch_names:
-            sig = filtered_data.get_data(picks=[ch_])[0, :]
+        # Hilbert amplitude in the beta-gamma band, from the shared band-envelope pass (no copy of the data)
+        if envelopes is None:
+            envelopes = compute_band_envelopes(mne_data, bands={'ied': ENVELOPE_BANDS['ied']})
+
+        widths = []
+        for ch_ix, ch_ in enumerate(mne_data.ch_names):
+            # Zscore (one channel at a time, the envelopes may be memmaps)
+            sig = zscore(envelopes['ied'][ch_ix, :].astype(np.float64))
 
             # Find peaks 
             IED_samps, _ = find_peaks(sig, height=peak_thresh, distance=closeness_thresh * sr)
 
             IED_samps_dict[ch_] = IED_samps 
+            widths.append(peak_widths(sig, IED_samps, rel_height=0.75)[0])
 
         # aggregate all IEDs
-        all_IEDs = np.sort(np.concatenate(list(IED_samps_dict.values())).ravel())
+        IED_chans = np.repeat(np.arange(len(mne_data.ch_names)), [len(x) for x in IED_samps_dict.values()])
+        IED_samps = np.concatenate(list(IED_samps_dict.values())).ravel().astype(int)
+        all_IEDs = np.sort(IED_samps)
 
         # Remove lame IEDs 
-        for ch_ in filtered_data.ch_names:
-            sig = filtered_data.get_data(picks=[ch_])[0, :]
-            # 1. Too wide  
-            # Whick IEDs are longer than 200 ms?
-            widths = peak_widths(sig, IED_samps_dict[ch_], rel_height=0.75)
-            wide_IEDs = np.where(widths[0] > min_width)[0]
-            # 2. Too small 
-            # Which IEDs are below 3 in z-scored unfiltered signal? 
-            small_IEDs = np.where(zscore(mne_data.get_data(picks=[ch_]), axis=-1)[0, IED_samps_dict[ch_]] < 3)[0]
-            local_IEDs = [] 
-            # 3. Too local 
-            # Which IEDs are not present on enough electrodes? 
-            # Logic - aggregate IEDs across all channels as a reference point 
-            # Check each channel's IED across aggregate to find ones that are close in time (but are<500 ms so can't be same channel)
-            for IED_ix, indvid_IED in enumerate(IED_samps_dict[ch_]): 
-                # compute the time (in samples) to all IEDS if the 5 closest aren't all within 100 ms, then reject
-                diff_with_all_IEDs = np.sort(np.abs(indvid_IED - all_IEDs))[0:5]
-                if any(diff_with_all_IEDs>=across_chan_threshold_samps): 
-                    local_IEDs.append(IED_ix)
-                    # print(diff_with_all_IEDs)
-            local_IEDs = np.array(local_IEDs).astype(int)   
-            elim_IEDs = np.unique(np.hstack([small_IEDs, wide_IEDs, local_IEDs]))
-            revised_IED_samps = np.delete(IED_samps_dict[ch_], elim_IEDs)
-            IED_s = (revised_IED_samps / sr)
-            IED_sec_dict[ch_] = IED_s   
+        # 1. Too wide  
+        # Whick IEDs are longer than 200 ms? (widths measured on each channel with its peaks)
+        wide_IEDs = np.concatenate(widths) > min_width
+        # 2. Too small 
+        # Which IEDs are below 3 in z-scored unfiltered signal? (moments of every channel computed once, no copy)
+        mean, var = _streaming_moments(mne_data, np.arange(len(mne_data.ch_names)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            small_IEDs = ((mne_data._data[IED_chans, IED_samps] - mean[IED_chans]) / np.sqrt(var[IED_chans])) < 3
+        # 3. Too local 
+        # Which IEDs are not present on enough electrodes? 
+        # Logic - aggregate IEDs across all channels as a reference point 
+        # Check each channel's IED across aggregate to find ones that are close in time (but are<500 ms so can't be same channel)
+        local_IEDs = _local_IEDs(IED_samps, all_IEDs, across_chan_threshold_samps)
+
+        keep = ~(small_IEDs | wide_IEDs | local_IEDs)
+        bounds = np.cumsum([len(x) for x in IED_samps_dict.values()])[:-1]
+        for ch_, ch_samps, ch_keep in zip(mne_data.ch_names, np.split(IED_samps, bounds), np.split(keep, bounds)):
+            IED_sec_dict[ch_] = (ch_samps[ch_keep] / sr)
           
         return IED_sec_dict
     elif data_type == 'epoch':
-        # Detect the IEDs in every event in epoch time
-        for ch_ in filtered_data.ch_names:
-            sig = filtered_data.get_data(picks=[ch_])[:,0,:]
-            IED_dict = {x:np.nan for x in np.arange(sig.shape[0])}
-            for event in np.arange(sig.shape[0]):
-                IED_samps, _ = find_peaks(sig[event, :], height=peak_thresh, distance=closeness_thresh * sr)
-                # IED_s = (IED_samps / sr)
-                if len(IED_samps) == 0: 
-                    IED_samps = np.array([np.nan])
-                    # IED_s = np.nan
-                IED_dict[event] = IED_samps
-            IED_samps_dict[ch_] = IED_dict
-        # aggregate all IEDs
-        all_IEDs = np.sort(np.concatenate([list(x.values())[0] for x in list(IED_samps_dict.values())]).ravel())
-
-        for ch_ in filtered_data.ch_names:
-            sig = filtered_data.get_data(picks=[ch_])[:,0,:]
-            for event in np.arange(sig.shape[0]):
-                if all(~np.isnan(IED_samps_dict[ch_][event])): # Make sure there are IEDs here to begin with during this event 
-                    widths = peak_widths(sig[event, :], IED_samps_dict[ch_][event], rel_height=0.75)
-                    wide_IEDs = np.where(widths[0] > min_width)[0]
-                    small_IEDs = np.where(zscore(mne_data.get_data(picks=[ch_]), axis=-1)[event, 0, IED_samps_dict[ch_][event]] < 3)[0]
-                    local_IEDs = [] 
-                    for IED_ix, indvid_IED in enumerate(IED_samps_dict[ch_][event]): 
-                        # compute the time (in samples) to all IEDS if the 5 closest aren't all within 100 ms, then reject
-                        diff_with_all_IEDs = np.sort(np.abs(indvid_IED - all_IEDs))[0:5]
-                        if any(diff_with_all_IEDs>=across_chan_threshold_samps): 
-                            local_IEDs.append(IED_ix)
-                    local_IEDs = np.array(local_IEDs).astype(int)
-                    elim_IEDs = np.unique(np.hstack([small_IEDs, wide_IEDs, local_IEDs]))
-                    revised_IED_samps = np.delete(IED_samps_dict[ch_][event], elim_IEDs)
-                    IED_samps_dict[ch_][event] = revised_IED_samps
+        # Detect the IEDs in every event in epoch time (see detect_IEDs_epochs), as {channel: {event: samples}} 
+        IED_df = detect_IEDs_epochs(mne_data, peak_thresh=peak_thresh, closeness_thresh=closeness_thresh, 
+                                    width_thresh=width_thresh, return_all=True)
+        kept = {key: x.values for key, x in IED_df[IED_df['keep']].groupby(['channel', 'epoch'])['sample']}
+        # events without any candidate IED are NaN, events whose candidates were all rejected are empty
+        IED_samps_dict = {ch_: {x:np.array([np.nan]) for x in np.arange(len(mne_data))} for ch_ in mne_data.ch_names}
+        for ch_, event in IED_df.groupby(['channel', 'epoch']).size().index:
+            IED_samps_dict[ch_][event] = kept.get((ch_, event), np.array([], dtype=int))
 
         return IED_samps_dict
 
 
+def detect_IEDs_epochs(mne_data, peak_thresh=5, closeness_thresh=0.25, width_thresh=0.2, amp_thresh=3, return_all=False):
+    """
+    Detect IEDs in epoched data (same criteria as detect_IEDs), for all channels and epochs at once. 
+
+    The z-scored beta-gamma envelope of every (epoch, channel) row is searched for peaks in one pass over the flattened 
+    data, and the candidates are rejected if they are too wide, too small in the z-scored unfiltered signal, or not 
+    present on enough electrodes around the same time of the same epoch. 
+
+    Parameters
+    ----------
+    mne_data : mne Epochs object 
+        epoched data 
+    peak_thresh : float 
+        the peak threshold in amplitude 
+    closeness_thresh : float 
+        the closeness threshold in time
+    width_thresh : float 
+        the width threshold for IEDs 
+    amp_thresh : float 
+        the minimum amplitude of IEDs in the z-scored unfiltered signal 
+    return_all : bool 
+        also return the rejected candidates (with the wide, small and local flags) 
+
+    Returns
+    -------
+    IED_df : pandas df 
+        one row per IED: epoch, channel, sample (in the epoch), time (s, epoch time), width (samples), amplitude 
+        (z-scored unfiltered signal), wide, small, local, keep 
+    """
+
+    sr = mne_data.info['sfreq']
+    min_width = width_thresh * sr
+    across_chan_threshold_samps = closeness_thresh * sr # This sets a threshold for detecting cross-channel IEDs 
+    n_epochs, n_chans, n_times = len(mne_data), len(mne_data.ch_names), len(mne_data.times)
+
+    # filter data in beta-gamma band, Hilbert bandpass amplitude, zscore each epoch of each channel
+    filtered_data = mne_data.copy().filter(*ENVELOPE_BANDS['ied'], n_jobs=-1)
+    filtered_data = filtered_data.apply_hilbert(envelope=True, n_fft=next_fast_len(n_times), n_jobs=-1)
+    sig = zscore(filtered_data.get_data(), axis=-1).reshape(n_epochs * n_chans, n_times)
+    del filtered_data
+
+    # one row per (epoch, channel), separated by NaNs (which are never peaks and stop the peak measurements), at 
+    # least the peak distance apart so that rows don't interact
+    distance = closeness_thresh * sr
+    row_len = n_times + int(np.ceil(distance)) + 1
+    flat = np.full((n_epochs * n_chans, row_len), np.nan)
+    flat[:, :n_times] = sig
+    flat = flat.ravel()
+    del sig
+
+    # Find peaks 
+    peaks, _ = find_peaks(flat, height=peak_thresh, distance=distance)
+    prominence_data = peak_prominences(flat, peaks)
+    widths = peak_widths(flat, peaks, rel_height=0.75, prominence_data=prominence_data)[0]
+    rows, samps = np.divmod(peaks, row_len)
+    epochs_ix, chans_ix = np.divmod(rows, n_chans)
+
+    # z-scored unfiltered signal at the peaks
+    data = mne_data.get_data()
+    mean, std = data.mean(axis=-1), data.std(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        amplitude = (data[epochs_ix, chans_ix, samps] - mean[epochs_ix, chans_ix]) / std[epochs_ix, chans_ix]
+
+    # Remove lame IEDs 
+    # 1. Too wide, 2. Too small 
+    wide_IEDs = widths > min_width
+    small_IEDs = amplitude < amp_thresh
+    # 3. Too local: not enough IEDs on any channel close in time, in the same epoch (epochs are laid end to end, far 
+    # enough apart that they don't count for each other)
+    offset = n_times + 2 * int(np.ceil(across_chan_threshold_samps)) + 1
+    IED_times = epochs_ix * offset + samps
+    local_IEDs = _local_IEDs(IED_times, np.sort(IED_times).astype(float), across_chan_threshold_samps)
+
+    IED_df = pd.DataFrame({'epoch': epochs_ix, 
+                           'channel': np.array(mne_data.ch_names)[chans_ix], 
+                           'sample': samps, 
+                           'time': mne_data.times[samps], 
+                           'width': widths, 
+                           'amplitude': amplitude, 
+                           'wide': wide_IEDs, 
+                           'small': small_IEDs, 
+                           'local': local_IEDs})
+    IED_df['keep'] = ~(IED_df['wide'] | IED_df['small'] | IED_df['local'])
+
+    if not return_all:
+        IED_df = IED_df[IED_df['keep']].reset_index(drop=True)
+
+    return IED_df
+
+
 # def detect_IEDs_2(mne_data, bandwidth = np.array([10, 60])): 
 #     """
 
@@ -1462,19 +1784,122 @@ def detect_IEDs(mne_data, peak_thresh=5, closeness_thresh=0.25, width_thresh=0.2
 
 # Below are code that condense the Jupyter notebooks for pre-processing into individual functions. 
 
-def load_elec(elec_path=None, site='MSSM'):
+# Keyword rules used to assign the UIowa atlas labels to the regions of the YBA atlas used for MSSM data: 
+# (keyword, region), applied in order (later matches take precedence)
+DESTRIEUX_REGION_RULES = [('hippocampus', 'HPC'), 
+                          ('amygdala', 'AMY'), 
+                          ('temporal', 'Temporal'), 
+                          # umbrella label captures some operc/triangul/orbital
+                          ('front_inf', 'dlPFC'), 
+                          # rename those 
+                          ('opercular', 'vlPFC'), 
+                          ('triangul', 'vlPFC'), 
+                          ('frontopol', 'vmPFC'), 
+                          # captures frontal gyrus and lateral, medial, orbital sulci
+                          ('orbital', 'OFC'), 
+                          ('rectus', 'OFC'), 
+                          ('front_middle', 'dmPFC'), 
+                          ('insula_ant', 'AINS')]
+
+REGION_RULES = [('hippocampus', 'HPC'), 
+                ('amygdala', 'AMY'), 
+                ('temporal', 'Temporal'), 
+                ('anterior cingulate', 'ACC'), 
+                ('insula', 'AINS'), 
+                # unique to Iowa: 
+                ('lingual', 'OCC'), 
+                ('occipital', 'OCC'), 
+                ('cuneus', 'OCC'), 
+                ('parietal', 'Parietal')]
+
+# notes that mark an electrode as out of brain 
+OOB_NOTES_KEYWORDS = ['outside', 'ventricle', 'lesion', 'cyst', 'bad']
+
+# parsed electrode tables of this session: {(path, site): (file signature, table)}
+_ELEC_CACHE = {}
+
+
+def _keyword_labels(values, rules):
+    """
+    Label each (case-insensitive) string of values with the region of the last rule whose keyword it contains, in 
+    a single regex pass. NaN where no keyword matches.
+    """
+
+    values = pd.Series(values).reset_index(drop=True)
+    labels = np.full(len(values), np.nan, dtype=object)
+    pattern = '|'.join([f'({re.escape(keyword)})' for keyword, _ in rules])
+    hits = values.fillna('').astype(str).str.lower().str.extractall(pattern)
+    if len(hits) == 0:
+        return labels
+
+    # rule index of every match, and the last matching rule of each row
+    rule_ix = pd.Series(hits.notna().values.argmax(axis=1), index=hits.index.get_level_values(0))
+    rule_ix = rule_ix.groupby(level=0).max()
+    labels[rule_ix.index.values] = np.array([region for _, region in rules], dtype=object)[rule_ix.values]
+
+    return labels
+
+
+def clear_elec_cache():
+    """
+    Forget the electrode tables parsed in this session (the optional copies on disk are invalidated by the file 
+    modification time and the package code)
+    """
+
+    _ELEC_CACHE.clear()
+
+
+def load_elec(elec_path=None, site='MSSM', use_cache=True, disk_cache=False):
     """
     Load the electrode data from a CSV or Excel file, correct for small idiosyncracies, and return as a pandas dataframe.
 
+    The parsed table is cached in memory for the session, and optionally as a pickle in .lfp_cache next to the file 
+    (see cache_utils). Both are invalidated when the file (or the package code) changes. Every call returns its own copy.
+
     Parameters
     ----------
     elec_path (str): Path to the electrode data file. The file should be in CSV or Excel format.
+    site (str): Hospital where the recording took place.
+    use_cache (bool): Reuse the table parsed earlier in the session (default True). 
+    disk_cache (bool): Also keep the parsed table on disk, across sessions (default False). Only use this for data 
+        folders you trust: the cached table is a pickle, and loading a pickle can run arbitrary code.
 
     Returns
     ----------
     pandas.DataFrame: A dataframe containing the electrode data. The dataframe has columns for the electrode label, the x, y, and z coordinates in MNI space, and any other metadata associated with the electrodes.
     """
 
+    signature = cache_utils.file_signature(elec_path)
+    if (not use_cache) or (signature is None):
+        return _parse_elec(elec_path, site=site)
+
+    cached = _ELEC_CACHE.get((signature[0], site))
+    if (cached is not None) and (cached[0] == signature):
+        return cached[1].copy()
+
+    elec_data = None
+    if disk_cache:
+        cache_dir = cache_utils.default_cache_dir(elec_path)
+        cache_key = cache_utils.stage_key('load_elec', [elec_path], {'site': site})
+        elec_data = cache_utils.load_stage(cache_dir, 'load_elec', cache_key)
+    if elec_data is None:
+        elec_data = _parse_elec(elec_path, site=site)
+        if disk_cache:
+            try:
+                cache_utils.save_stage(elec_data, cache_dir, 'load_elec', cache_key)
+            except OSError:
+                # e.g. read-only data directory: keep the table in memory only
+                pass
+    _ELEC_CACHE[(signature[0], site)] = (signature, elec_data)
+
+    return elec_data.copy()
+
+
+def _parse_elec(elec_path=None, site='MSSM'):
+    """
+    Read and normalize the electrode file (see load_elec)
+    """
+
     # Load electrode data (should already be manually localized!)
     if elec_path.split('.')[-1] =='csv':
         elec_data = pd.read_csv(elec_path)
@@ -1522,78 +1947,336 @@ def load_elec(elec_path=None, site='MSSM'):
         # elec_data = elec_data.dropna(axis=1)
 
         # Assign regions here that match keys for more detailed YBA atlas that we use for MSSM data.
+        # (keyword rules are applied in order, later matches take precedence, see _keyword_labels)
+        salman_region = np.full(len(elec_data), np.nan, dtype=object)
+        manual = elec_data['manual'].values.astype(object) if 'manual' in elec_data.keys() else np.full(len(elec_data), np.nan, dtype=object)
 
-        elec_data['salman_region'] = np.nan
- 
         if any(elec_data.keys().str.contains('Destrieux')):
-
             destr_key = elec_data.keys()[elec_data.keys().str.contains('Destrieux')].values[0]
+            labels = _keyword_labels(elec_data[destr_key], DESTRIEUX_REGION_RULES)
+            salman_region = np.where(pd.isnull(labels), salman_region, labels)
 
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('hippocampus', na=False)] = 'HPC'
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('amygdala', na=False)] = 'AMY'
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('temporal', na=False)] = 'Temporal'
-            
+        if any(elec_data.keys().str.contains('Region')):
+            # make a manual column to assign white matter 
+            manual = _keyword_labels(elec_data['Region'], [('wm', 'white')])
+            # Get manual labels for hippocampus, amygdala etc. 
+            labels = _keyword_labels(elec_data['Region'], REGION_RULES)
+            salman_region = np.where(pd.isnull(labels), salman_region, labels)
 
-            # umbrella label captures some operc/triangul/orbital
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('front_inf', na=False)] = 'dlPFC'
+        if any(elec_data.keys().str.contains('Notes')):
+            labels = _keyword_labels(elec_data['Notes'], [(x, 'oob') for x in OOB_NOTES_KEYWORDS])
+            manual = np.where(pd.isnull(labels), manual, labels)
 
-            # rename those 
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('opercular', na=False)] = 'vlPFC'
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('triangul', na=False)] = 'vlPFC'
+        elec_data['salman_region'] = salman_region
+        if any(elec_data.keys().str.contains('Region|Notes')) or ('manual' in elec_data.keys()):
+            elec_data['manual'] = manual
 
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('frontopol', na=False)] = 'vmPFC'
+    return elec_data
 
-            # captures frontal gyrus and lateral, medial, orbital sulci
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('orbital', na=False)] = 'OFC'
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('rectus', na=False)] = 'OFC'
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('front_middle', na=False)] = 'dmPFC'
-            elec_data['salman_region'][elec_data[f'{destr_key}'].str.lower().str.contains('insula_ant', na=False)] = 'AINS'
-        if any(elec_data.keys().str.contains('Region')):
-            
-            # make a manual column to assign white matter 
-            elec_data['manual'] = np.nan
-            # elec_data['manual'][elec_data['Destrieuxlabel'].str.lower().str.contains('white')] = 'white'
-            elec_data['manual'][elec_data['Region'].str.lower().str.contains('wm', na=False)] = 'white'
-                        
-            # Get manual labels for hippocampus and amygdala 
-            elec_data['salman_region'][elec_data['Region'].str.lower().str.contains('hippocampus', na=False)] = 'HPC'
-            elec_data['salman_region'][elec_data['Region'].str.lower().str.contains('amygdala', na=False)] = 'AMY'
-            elec_data['salman_region'][elec_data['Region'].str.lower().str.contains('temporal', na=False)] = 'Temporal'
+def _notch_filter_runs(data, sfreq, freqs, gaps=None):
+    """
+    Notch filter (n_channels, n_samples) data separately within every run of samples between gaps, like mne's 
+    skip_by_annotation, so the filters never run across a jump into a zero-filled pause. The gaps are left untouched. 
 
+    Parameters
+    ----------
+    data : np.ndarray 
+        (n_channels, n_samples) data 
+    sfreq : float 
+        sampling rate of data 
+    freqs : list 
+        frequencies to notch out 
+    gaps : mne.Annotations 
+        segments to leave out (e.g. the BAD_ACQ_SKIP annotations of merged channels, see _ncs_gap_annotations). 
+        None to filter all the samples at once 
 
-            # elec_data['salman_region'][elec_data['Destrieuxlabel'].str.lower().str.contains('cingul-ant')] = 'ACC'
-            elec_data['salman_region'][elec_data['Region'].str.lower().str.contains('anterior cingulate', na=False)] = 'ACC'
+    Returns
+    -------
+    data : np.ndarray 
+        filtered data 
+    """
 
-            elec_data['salman_region'][elec_data['Region'].str.lower().str.contains('insula', na=False)] = 'AINS'
+    if (gaps is None) or (len(gaps) == 0):
+        return mne.filter.notch_filter(data, Fs=sfreq, freqs=freqs, verbose=False)
 
-            # unique to Iowa: 
-            elec_data['salman_region'][elec_data['Region'].str.lower().str.contains('lingual', na=False)] = 'OCC'
-            elec_data['salman_region'][elec_data['Region'].str.lower().str.contains('occipital', na=False)] = 'OCC'
-            elec_data['salman_region'][elec_data['Region'].str.lower().str.contains('cuneus', na=False)] = 'OCC'
+    n_samples = data.shape[-1]
+    gap_starts = np.clip(np.round(gaps.onset * sfreq).astype(int), 0, n_samples)
+    gap_stops = np.clip(np.round((gaps.onset + gaps.duration) * sfreq).astype(int), 0, n_samples)
+    run_starts = np.concatenate([[0], gap_stops])
+    run_stops = np.concatenate([gap_starts, [n_samples]])
+
+    data = data.copy()
+    for start, stop in zip(run_starts, run_stops):
+        if stop > start:
+            data[:, start:stop] = mne.filter.notch_filter(data[:, start:stop], Fs=sfreq, freqs=freqs, verbose=False)
+
+    return data
 
-            elec_data['salman_region'][elec_data['Region'].str.lower().str.contains('parietal', na=False)] = 'Parietal'
-       
-        if any(elec_data.keys().str.contains('Notes')):
-            elec_data['manual'][elec_data['Notes'].str.lower().str.contains('outside', na=False)] = 'oob'
-            elec_data['manual'][elec_data['Notes'].str.lower().str.contains('ventricle', na=False)] = 'oob'
-            elec_data['manual'][elec_data['Notes'].str.lower().str.contains('lesion', na=False)] = 'oob'
-            elec_data['manual'][elec_data['Notes'].str.lower().str.contains('cyst', na=False)] = 'oob'
-            elec_data['manual'][elec_data['Notes'].str.lower().str.contains('bad', na=False)] = 'oob'
 
+def condition_signals(signals, srs=None, ch_types=None, scales=None, resample_sr=500, line_freqs=(60, 120, 180, 240), 
+                      block_size=16, gaps=None):
+    """
+    Fused line-noise removal and downsampling. 
 
+    Each block of channels is decimated with a polyphase filter (which also acts as the anti-aliasing filter) and then 
+    notch filtered at the output rate, so the notch filters never run over the samples that decimation throws away. 
+    Only one block is read (from a raw object, get_data on those channels) and held at the native rate at a time; 
+    blocks are not split in time, so block_size sets the peak memory (block_size x recording length in float64). 
+    Channels recorded at different sampling rates are resampled straight to resample_sr and cropped to a common length, 
+    instead of being resampled to the lowest rate and merged first. 
 
+    As with mne's Raw.notch_filter, only the data channels (eeg, seeg) are notch filtered. Line frequencies at or above 
+    the output Nyquist frequency are removed by the decimation and skipped. 
 
+    Parameters
+    ----------
+    signals : np.ndarray, list or mne object 
+        (n_channels, n_samples) array or list of 1D rows (e.g. from nlx_utils.parse_subject_nlx_data), or a raw object 
+    srs : float or list 
+        sampling rate of every channel (or one for all). Ignored for raw objects. 
+    ch_types : list 
+        channel types, used to decide which channels get notch filtered. None filters all of them. Ignored for raw objects. 
+    scales : np.ndarray 
+        per-channel factors to apply first, e.g. to int16 ADC counts (parse_subject_nlx_data(..., compact=True))
+    resample_sr : float 
+        sampling rate to resample to. None keeps the lowest sampling rate in the data. 
+    line_freqs : tuple 
+        frequencies to notch out 
+    block_size : int 
+        number of channels processed at a time 
+    gaps : mne.Annotations 
+        segments (e.g. zero-filled recording pauses) the notch filters should not run across (see _notch_filter_runs) 
 
+    Returns
+    -------
+    conditioned : np.ndarray or mne object 
+        float64 (n_channels, n_samples) array at resample_sr (a raw object with the same info if given one) 
+    """
 
+    raw = None
+    if isinstance(signals, mne.io.BaseRaw):
+        # read a block of channels at a time (a non-preloaded raw is never loaded whole)
+        raw = signals
+        srs = raw.info['sfreq']
+        ch_types = raw.get_channel_types()
+    n_channels = len(raw.ch_names) if raw is not None else len(signals)
+
+    srs = np.broadcast_to(np.asarray(srs, dtype=float), (n_channels,))
+    if resample_sr is None:
+        resample_sr = np.min(srs)
+
+    groups = []
+    for sr in np.unique(srs):
+        ch_ix = np.where(srs==sr)[0]
+        ratio = Fraction(float(resample_sr) / float(sr)).limit_denominator(1000)
+        freqs = [x for x in line_freqs if x < resample_sr / 2.]
+        out = None
+        for start in range(0, len(ch_ix), block_size):
+            block_ix = ch_ix[start:start+block_size]
+            if raw is not None:
+                block = raw.get_data(picks=block_ix).astype(np.float64, copy=False)
+            else:
+                block = np.array([signals[ix] for ix in block_ix], dtype=np.float64)
+            if scales is not None:
+                block *= np.asarray(scales)[block_ix][:, None]
+            if ratio != 1:
+                block = resample_poly(block, ratio.numerator, ratio.denominator, axis=1, padtype='line')
+            notch_rows = [row for row, ix in enumerate(block_ix) if (ch_types is None) or (ch_types[ix] in ['eeg', 'seeg'])]
+            if notch_rows and freqs:
+                block[notch_rows] = _notch_filter_runs(block[notch_rows], resample_sr, freqs, gaps=gaps)
+            if out is None:
+                out = np.empty((len(ch_ix), block.shape[1]), dtype=np.float64)
+            out[start:start+len(block_ix)] = block
+        groups.append((ch_ix, out))
+
+    # Rates that don't divide evenly can leave the groups a sample or so apart
+    n_samples = np.min([x[1].shape[1] for x in groups])
+    if len(groups) == 1:
+        conditioned = groups[0][1][:, :n_samples]
+    else:
+        conditioned = np.empty((n_channels, n_samples), dtype=np.float64)
+        for ch_ix, out in groups:
+            conditioned[ch_ix] = out[:, :n_samples]
 
+    if raw is not None:
+        info = raw.info.copy()
+        with info._unlock():
+            info['sfreq'] = float(resample_sr)
+            info['lowpass'] = min(info['lowpass'], resample_sr / 2.)
+        conditioned = mne.io.RawArray(conditioned, info, first_samp=int(np.round(raw.first_samp * resample_sr / raw.info['sfreq'])))
+        conditioned.set_annotations(raw.annotations)
 
+    return conditioned
 
 
-    return elec_data
+def _load_edf_channels_by_block(raw, ch_names, line_freqs=(60, 120, 180, 240), resample_sr=None, block_size=16):
+    """
+    Decode the given channels of a non-preloaded raw (e.g. read_raw_edf(..., preload=False)) a block of channels at 
+    a time, notch filter and resample each block, and collect the result in a new raw. Only one block is ever held at 
+    the native sampling rate. 
+
+    Parameters
+    ----------
+    raw : mne object 
+        non-preloaded raw data 
+    ch_names : list 
+        channels to load 
+    line_freqs : tuple 
+        frequencies to notch out 
+    resample_sr : float 
+        sampling rate to resample to. None to keep the native rate. 
+    block_size : int 
+        number of channels decoded at a time 
+
+    Returns
+    -------
+    mne_data : mne object 
+        preloaded raw data with the requested channels (same channel info, measurement date and annotations) 
+    """
+
+    sfreq = raw.info['sfreq']
+    info = mne.pick_info(raw.info, mne.pick_channels(raw.ch_names, include=ch_names, ordered=True))
+    data = None
+    for start in range(0, len(ch_names), block_size):
+        block_names = info.ch_names[start:start+block_size]
+        block = raw.get_data(picks=block_names)
+        block = mne.filter.notch_filter(block, Fs=sfreq, freqs=line_freqs, verbose=False)
+        if resample_sr is not None:
+            block = mne.filter.resample(block, up=resample_sr, down=sfreq, npad='auto', n_jobs=-1, verbose=False)
+        if data is None:
+            data = np.empty((len(info.ch_names), block.shape[1]), dtype=block.dtype)
+        data[start:start+len(block_names)] = block
+
+    with info._unlock():
+        info['line_freq'] = 60
+        if resample_sr is not None:
+            info['sfreq'] = float(resample_sr)
+            info['lowpass'] = min(info['lowpass'], resample_sr / 2.)
+    mne_data = mne.io.RawArray(data, info, first_samp=int(np.round(raw.first_samp * info['sfreq'] / sfreq)))
+    mne_data.set_annotations(raw.annotations)
+
+    return mne_data
+
+
+def _counts_to_notched_signals(signals, scales, srs, ch_types, line_freqs, block_size=16, gaps=None):
+    """
+    Convert int16 ADC counts (see nlx_utils.parse_subject_nlx_data(compact=True)) to float64 volts and notch filter 
+    them, a block of channels at a time, so that only the kept channels are ever held as floats. 
+
+    As with mne's Raw.notch_filter, only the data channels (eeg, seeg) are filtered. 
+
+    Parameters
+    ----------
+    signals : np.ndarray or list
+        int16 counts, either a (n_channels, n_samples) array or a list of 1D rows 
+    scales : np.ndarray 
+        per-channel conversion factor to volts 
+    srs : list 
+        per-channel sampling rates 
+    ch_types : list 
+        per-channel types 
+    line_freqs : tuple 
+        frequencies to notch out 
+    block_size : int 
+        number of channels converted and filtered at a time 
+    gaps : mne.Annotations 
+        segments (e.g. zero-filled recording pauses) the notch filters should not run across (see _notch_filter_runs) 
+
+    Returns
+    -------
+    float_signals : np.ndarray or list 
+        float64 signals, a (n_channels, n_samples) array if all the sampling rates match, otherwise a list of 1D rows 
+    """
+
+    srs = np.array(srs)
+    rows = [None] * len(signals)
+    buffers = []
+    for sr in np.unique(srs):
+        ch_ix = np.where(srs==sr)[0]
+        buffer = np.empty((len(ch_ix), len(signals[ch_ix[0]])), dtype=np.float64)
+        for start in range(0, len(ch_ix), block_size):
+            block_ix = ch_ix[start:start+block_size]
+            block = buffer[start:start+len(block_ix)]
+            for row, ix in enumerate(block_ix):
+                np.multiply(signals[ix], scales[ix], out=block[row])
+            notch_rows = [row for row, ix in enumerate(block_ix) if ch_types[ix] in ['eeg', 'seeg']]
+            if notch_rows:
+                block[notch_rows] = _notch_filter_runs(block[notch_rows], sr, line_freqs, gaps=gaps)
+        for row, ix in enumerate(ch_ix):
+            rows[ix] = buffer[row]
+        buffers.append(buffer)
+
+    if len(buffers) == 1:
+        return buffers[0]
+
+    return rows
+
+
+def _merge_split_ncs_channel(file_paths, cache_dir):
+    """
+    Merge the numbered .ncs files of one channel (see nlx_utils.merge_multiple_ncs_files) into an int16 memmap in the 
+    cache directory, or reopen the merged memmap if its source files haven't changed since it was written. 
+
+    Pauses are zero-filled (not dropped), so the sample index stays proportional to Neuralynx time and the NEV TTL 
+    times still line up with the samples. 
+
+    Returns
+    -------
+    merged : dict 
+        ncs dict of the merged channel (see nlx_utils.merge_multiple_ncs_files) 
+    """
+
+    params = {'gap_policy': 'zero', 'rescale_data': False}
+    key = cache_utils.stage_key('merge_ncs', sorted(file_paths), params)
+    dat_path = os.path.join(cache_dir, f'merge_ncs-{key}.dat')
+    merged = cache_utils.load_stage(cache_dir, 'merge_ncs', key)
+    if (merged is not None) and os.path.exists(dat_path) and (os.path.getsize(dat_path) == merged['n_samples'] * np.dtype(np.int16).itemsize):
+        merged['data'] = np.memmap(dat_path, dtype=np.int16, mode='r', shape=(merged['n_samples'],))
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        merged = nlx_utils.merge_multiple_ncs_files(file_paths, gap_policy='zero', output='memmap', save_path=dat_path, 
+                                                    rescale_data=False)
+        merged['n_samples'] = merged['data'].shape[0]
+        cache_utils.save_stage({k: v for k, v in merged.items() if k != 'data'}, cache_dir, 'merge_ncs', key)
+
+    gaps = _ncs_gap_annotations([merged])
+    gap_samples = merged['n_samples'] - merged['segments']['n_samples'].sum()
+    if gap_samples > 0:
+        warnings.warn(f'{len(gaps)} gap(s) in {os.path.basename(merged["source_files"][0])} ({gap_samples / merged["sampling_rate"]:.2f} s in total) '
+                      'were zero-filled to keep the samples aligned with the Neuralynx timestamps - they are annotated BAD_ACQ_SKIP')
+
+    return merged
+
+
+def _ncs_gap_annotations(merged_list):
+    # BAD_ACQ_SKIP annotations covering the zero-filled gaps of any of the merged channels (see _merge_split_ncs_channel)
+    starts, stops = [], []
+    for merged in merged_list:
+        segments = merged['segments']
+        sr = np.float64(merged['sampling_rate'])
+        ends = segments['start_sample'][:-1] + segments['n_samples'][:-1]
+        is_gap = segments['start_sample'][1:] > ends
+        starts.append(ends[is_gap] / sr)
+        stops.append(segments['start_sample'][1:][is_gap] / sr)
+    starts, stops = np.concatenate(starts + [[]]), np.concatenate(stops + [[]])
+
+    # union of the gaps: merge the ones that overlap
+    order = np.argsort(starts, kind='stable')
+    onset, end = [], []
+    for start, stop in zip(starts[order], stops[order]):
+        if end and (start <= end[-1]):
+            end[-1] = max(end[-1], stop)
+        else:
+            onset.append(start)
+            end.append(stop)
+
+    return mne.Annotations(onset=onset, duration=np.subtract(end, onset), description=['BAD_ACQ_SKIP'] * len(onset))
+
 
 def make_mne(load_path=None, elec_path=None, format='edf', site='MSSM', resample_sr = 500, overwrite=True, return_data=False, 
 include_micros=False, eeg_names=None, resp_names=None, ekg_names=None, sync_name=None, sync_type='photodiode', seeg_names=None, drop_names=None,
-seeg_only=True, check_bad=False):
+seeg_only=True, check_bad=False, ingest_jobs=1, compact=False, lazy=False, fused=False, use_cache=False, cache_dir=None,
+match_method='levenshtein', match_overrides=None):
     """
     Make a mne object from the data and electrode files, and save out the sync. 
     Following this step, you can indicate bad electrodes manually.
@@ -1633,6 +2316,32 @@ seeg_only=True, check_bad=False):
         provide the drop names in case you know certain channels that should be thrown out asap
     seeg_only: bool  (default=True)
         indicate whether you want non seeg channels included
+    ingest_jobs: int (default=1)
+        number of threads used to read the .ncs files concurrently (nlx only). Worth raising on network storage.
+    compact: bool (default=False)
+        (nlx only) keep the data as int16 ADC counts through channel selection and sync extraction, and only convert 
+        the channels that are kept to float, block by block, right before the notch filter. Cuts the peak memory of 
+        ingestion by ~4x.
+    lazy: bool (default=False)
+        (edf only) don't preload the edf. Channel names are resolved from the header, the photodiode is read on its 
+        own, and only the sEEG channels are decoded, a block of channels at a time, each block being notch filtered and 
+        resampled before it is stored. Bad channels (check_bad) are then detected at the resampled rate. Use this for 
+        edf files that don't fit in memory.
+    fused: bool (default=False)
+        replace the separate notch filter and resampling steps with condition_signals: polyphase decimation followed 
+        by the notch filter at the output rate, a block of channels at a time. For nlx data with mixed sampling rates, 
+        every group is resampled straight to resample_sr. The photodiode is still saved unfiltered at the native (lowest) 
+        rate. Bad channels (check_bad) are then detected at the resampled rate.
+    use_cache: bool (default=False)
+        skip the whole stage if it already ran on the same raw files with the same parameters and the files it wrote 
+        are unchanged (see cache_utils)
+    cache_dir: str 
+        where to keep the cache. Defaults to load_path/.lfp_cache
+    match_method: str 
+        how to match the channel names to the localization names (see match_elec_names). Use 'batch' for unattended 
+        runs: the default may stop and ask for a manual tiebreak 
+    match_overrides: dict or str 
+        manual name matches for match_method='batch' (see match_elec_names) 
 
     Returns
     -------
@@ -1640,6 +2349,18 @@ seeg_only=True, check_bad=False):
         mne object
     """
 
+    if use_cache:
+        params = {k: v for k, v in locals().items() if k not in ['load_path', 'elec_path', 'overwrite', 'return_data', 'use_cache', 'cache_dir']}
+        cache_dir = cache_dir or cache_utils.default_cache_dir(load_path)
+        raw_files = sorted([x for x in glob(f'{load_path}/*') if x.lower().endswith(('.edf', '.ncs', '.nev'))])
+        cache_key = cache_utils.stage_key('make_mne', raw_files + [elec_path], params)
+        manifest = cache_utils.load_stage(cache_dir, 'make_mne', cache_key)
+        if (manifest is not None) and cache_utils.outputs_unchanged(manifest):
+            print(f'make_mne already ran with these inputs and parameters - using {load_path}/lfp_data.fif')
+            if return_data==True:
+                return mne.io.read_raw_fif(f'{load_path}/lfp_data.fif', preload=True)
+            return
+
     if not sync_name:
         warnings.warn(f'No sync name specified - if using an audiovisual sync signal please check load_path to make sure a valid sync was saved out')
 
@@ -1656,7 +2377,8 @@ seeg_only=True, check_bad=False):
 
         # This is a big block of data. Have to load first, then split out the sEEG and photodiode downstream. 
         edf_file = glob(f'{load_path}/*.edf')[0]
-        mne_data = mne.io.read_raw_edf(edf_file, preload=True)
+        # In lazy mode only the header is read here 
+        mne_data = mne.io.read_raw_edf(edf_file, preload=not lazy)
 
         if not sync_name:
             if sync_type == 'photodiode':
@@ -1686,7 +2408,7 @@ seeg_only=True, check_bad=False):
         # or on the side of MNE reading the labels in. Usually there's a mixup between lowercase 'l' and capital 'I'.
         
         # Sometimes, there's electrodes on the pdf that are NOT in the MNE data structure... let's identify those as well. 
-        new_mne_names, _, _ = match_elec_names(mne_data.ch_names, elec_data.label)
+        new_mne_names, _, _ = match_elec_names(mne_data.ch_names, elec_data.label, method=match_method, overrides=match_overrides)
         # Rename the mne data according to the localization data
         new_name_dict = {x:y for (x,y) in zip(mne_data.ch_names, new_mne_names)}
         mne_data.rename_channels(new_name_dict)
@@ -1695,28 +2417,52 @@ seeg_only=True, check_bad=False):
             seeg_names = [i for i in mne_data.ch_names if (((i.startswith('l')) | (i.startswith('r'))) & (i!='research'))]
         sEEG_mapping_dict = {f'{x}':'seeg' for x in seeg_names}
 
-        mne_data.set_channel_types(sEEG_mapping_dict)
+        if lazy:
+            # Decode, notch filter and resample only the sEEG channels, block by block
+            mne_data = _load_edf_channels_by_block(mne_data, seeg_names, line_freqs=(60, 120, 180, 240), resample_sr=resample_sr)
+            mne_data.set_channel_types(sEEG_mapping_dict)
 
-        mne_data.info['line_freq'] = 60
-        # Notch out 60 Hz noise and harmonics 
-        mne_data.notch_filter(freqs=(60, 120, 180, 240))
+            if check_bad == True:
+                bads = detect_bad_elecs(mne_data, sEEG_mapping_dict)
+                mne_data.info['bads'] = bads
+        elif fused:
+            mne_data.set_channel_types(sEEG_mapping_dict)
+            mne_data.info['line_freq'] = 60
 
-        # drop EEG and EKG channels
-        drop_chans = list(set(mne_data.ch_names)^set(seeg_names))
-        mne_data.drop_channels(drop_chans)
+            # drop EEG and EKG channels
+            drop_chans = list(set(mne_data.ch_names)^set(seeg_names))
+            mne_data.drop_channels(drop_chans)
 
-        if check_bad == True:
-            bads = detect_bad_elecs(mne_data, sEEG_mapping_dict)
-            mne_data.info['bads'] = bads
+            # Resample and notch out 60 Hz noise and harmonics in one pass
+            mne_data = condition_signals(mne_data, resample_sr=resample_sr, line_freqs=(60, 120, 180, 240))
 
-        # Resample
-        if resample_sr is not None: 
-            mne_data.resample(sfreq=resample_sr, npad='auto', n_jobs=-1)
+            if check_bad == True:
+                bads = detect_bad_elecs(mne_data, sEEG_mapping_dict)
+                mne_data.info['bads'] = bads
+        else:
+            mne_data.set_channel_types(sEEG_mapping_dict)
+
+            mne_data.info['line_freq'] = 60
+            # Notch out 60 Hz noise and harmonics 
+            mne_data.notch_filter(freqs=(60, 120, 180, 240))
+
+            # drop EEG and EKG channels
+            drop_chans = list(set(mne_data.ch_names)^set(seeg_names))
+            mne_data.drop_channels(drop_chans)
+
+            if check_bad == True:
+                bads = detect_bad_elecs(mne_data, sEEG_mapping_dict)
+                mne_data.info['bads'] = bads
+
+            # Resample
+            if resample_sr is not None: 
+                mne_data.resample(sfreq=resample_sr, npad='auto', n_jobs=-1)
             
         mne_data.save(f'{load_path}/lfp_data.fif', picks=seeg_names, overwrite=overwrite)
 
     elif format =='nlx': 
         # This is a pre-split data. Have to specifically load the sEEG and sync individually.
+        gap_annotations = None
         if site == 'MSSM': 
             # MSSM data seems to sometime have a "_0000.ncs" to "_9999.ncs" appended to the end of the data. 
             pattern = re.compile(r"_\d{4}\.ncs") 
@@ -1728,27 +2474,35 @@ seeg_only=True, check_bad=False):
             # If it's the latter, something got screwed up - no tasks are that long. 
             # TODO 
             # -----
-            # If it's the former, we EITHER need to concatenate multiple, real data files, 
-            # DONE 
+            # If it's the former, we EITHER need to concatenate multiple, real data files,
+            # DONE
             # -----
-            # OR need to select the file that actually has data in it. 
+            # OR need to select the file that actually has data in it.
+            # DONE - empty files are found from the header scan and skipped
 
 
-            # First, let's list the file wihout a number attached. This always comes first: 
-            ncs_files = [x for x in glob(f'{load_path}/*.ncs') if not re.search(pattern, x)]
-            # Second, let's account for all variants 
-            numbered_ncs_files = [x for x in glob(f'{load_path}/*.ncs') if re.search(pattern, x)]
+            # Scan the headers of every file (no data is read) to see which files are empty and which channels are split
+            scan_df = nlx_utils.scan_nlx_directory(load_path, extensions=('.ncs',))
             if not seeg_names:
-                seeg_names = [x.split('/')[-1].replace('.ncs','') for x in glob(f'{load_path}/[R,L]*.ncs') if not re.search(pattern, x)]
-            try: 
-                # Let's see if the original files have the data or the numbered variant: 
-                test_load = nlx_utils.load_ncs(ncs_files[0])
-            except: 
-                print('Data in numbered files')
-                # This means that we need to load the the files with the numbers appended
-                pattern = re.compile(r"_\d{4}\.ncs")  # regex pattern to match "_0000.ncs" to "_9999.ncs"
-                ncs_files = numbered_ncs_files
-                seeg_names = [x.split('/')[-1].replace('.ncs','').split('_')[0] for x in glob(f'{load_path}/[R,L]*.ncs') if re.search(pattern, x)]
+                seeg_names = list(dict.fromkeys(scan_df.channel_name[scan_df.channel_name.str.match(r'[RL]')]))
+            for x in scan_df.file_path[scan_df.n_records==0]:
+                print(f'No data in {x}')
+            scan_df = scan_df[scan_df.n_records>0]
+
+            ncs_files = []
+            for chan, chan_df in scan_df.groupby('channel_name', sort=False):
+                if len(chan_df) == 1:
+                    # Only one of the files (original or numbered) has data in it
+                    ncs_files.append(chan_df.file_path.iloc[0])
+                else:
+                    # Stream the channel's files into one merged memmap in the cache directory, in timestamp order 
+                    # (reused as long as the files don't change)
+                    print(f'Data for {chan} split across {len(chan_df)} files - merging')
+                    merged = _merge_split_ncs_channel(chan_df.file_path.tolist(), cache_dir or cache_utils.default_cache_dir(load_path))
+                    ncs_files.append(merged)
+            merged_list = [x for x in ncs_files if isinstance(x, dict)]
+            if merged_list:
+                gap_annotations = _ncs_gap_annotations(merged_list)
 
         elif site == 'UI':
             # here, the filenames are not informative. We have to get subject-specific information from the experimenter
@@ -1777,15 +2531,64 @@ seeg_only=True, check_bad=False):
             seeg_names = [x.lower() for x in seeg_names]
 
         # Go through every ncs file and parse the useful data based on the extracted channel names and channel types from above
-        signals, srs, ch_name, ch_type = nlx_utils.parse_subject_nlx_data(ncs_files,
+        parsed = nlx_utils.parse_subject_nlx_data(ncs_files,
         eeg_names=eeg_names, 
         resp_names=resp_names, 
         ekg_names=ekg_names, 
         seeg_names=seeg_names, 
         drop_names=drop_names,
-        include_micros=include_micros)
+        include_micros=include_micros,
+        n_jobs=ingest_jobs, 
+        compact=compact)
+        signals, srs, ch_name, ch_type = parsed[:4]
+
+        # Search for sync names if need be
+        if not sync_name: 
+            if sync_type == 'photodiode':
+                iteration = 0
+                photodiode_options = ['photodiode', 'research', 'sync', 'dc1', 'analog', 'stim', 'trig', 'dc2']
+                while (not sync_name) & (iteration<len(photodiode_options)-1):
+                    sync_name = next((s for s in ch_name if photodiode_options[iteration] in s.lower()), None)
+                    iteration += 1
+            elif sync_type == 'audio': 
+                pass 
+            elif sync_type == 'ttl': 
+                pass
 
-        if np.unique(srs).shape[0] == 1:
+        # if not sync_name:
+        #     raise ValueError('Could not find a sync channel')
+
+        line_freqs = (60, 120, 180, 240)
+        scales = parsed[4] if compact else None
+        if compact:
+            if seeg_only == True:
+                # Drop everything that won't be saved out while it is still int16 counts
+                keep_names = set(seeg_names) | set([x.lower() for x in (resp_names or []) + (eeg_names or []) + (ekg_names or [])])
+                if sync_name:
+                    keep_names.add(sync_name.lower())
+                keep_ix = [ix for ix, x in enumerate(ch_name) if x.lower() in keep_names]
+                signals = [signals[ix] for ix in keep_ix]
+                srs, ch_name, ch_type, scales = [srs[ix] for ix in keep_ix], [ch_name[ix] for ix in keep_ix], [ch_type[ix] for ix in keep_ix], scales[keep_ix]
+            if not fused:
+                # First numeric stage: convert to volts and notch filter 
+                signals = _counts_to_notched_signals(signals, scales, srs, ch_type, line_freqs, gaps=gap_annotations)
+
+        sync_data = None
+        if fused:
+            if (sync_type == 'photodiode') and (sync_name in ch_name):
+                # The photodiode is kept off the fused path: unfiltered, at the (lowest) native rate, as before
+                ix = ch_name.index(sync_name)
+                sync_signal = np.asarray(signals[ix], dtype=np.float64) * (scales[ix] if compact else 1)
+                sync_data = mne.io.RawArray(sync_signal[None], mne.create_info([sync_name], srs[ix], ch_type[ix]))
+                if srs[ix] != np.min(srs):
+                    sync_data.resample(sfreq=np.min(srs), npad='auto', n_jobs=-1)
+            # Resample every sampling rate group straight to the output rate and notch filter there
+            out_sr = resample_sr if resample_sr is not None else np.min(srs)
+            signals = condition_signals(signals, srs, ch_types=ch_type, scales=scales, resample_sr=out_sr, line_freqs=line_freqs, 
+                                        gaps=gap_annotations)
+            info = mne.create_info(ch_name, out_sr, ch_type)
+            mne_data = mne.io.RawArray(signals, info)
+        elif np.unique(srs).shape[0] == 1:
             # all the sampling rates match:
             info = mne.create_info(ch_name, np.unique(srs), ch_type)
             mne_data = mne.io.RawArray(signals, info)
@@ -1817,30 +2620,22 @@ seeg_only=True, check_bad=False):
 
             mne_data.add_channels(mne_data_resampled)
 
-        # Search for sync names if need be
-        if not sync_name: 
-            if sync_type == 'photodiode':
-                iteration = 0
-                photodiode_options = ['photodiode', 'research', 'sync', 'dc1', 'analog', 'stim', 'trig', 'dc2']
-                while (not sync_name) & (iteration<len(photodiode_options)-1):
-                    sync_name = next((s for s in mne_data.ch_names if photodiode_options[iteration] in s.lower()), None)
-                    iteration += 1
-            elif sync_type == 'audio': 
-                pass 
-            elif sync_type == 'ttl': 
-                pass
-
-        # if not sync_name:
-        #     raise ValueError('Could not find a sync channel')
+        if gap_annotations is not None:
+            # mark the pauses that were zero-filled when merging split channels
+            mne_data.set_annotations(mne_data.annotations + gap_annotations)
 
         mne_data.info['line_freq'] = 60
-        # Notch out 60 Hz noise and harmonics 
-        mne_data.notch_filter(freqs=(60, 120, 180, 240))
+        if not (compact or fused):
+            # Notch out 60 Hz noise and harmonics (already done during the conversion in compact or fused mode)
+            mne_data.notch_filter(freqs=line_freqs)
 
         if sync_type == 'photodiode':
             # Save out the photodiode channel separately
             print(f'Saving photodiode data to {load_path}/photodiode.fif')
-            mne_data.save(f'{load_path}/photodiode.fif', picks=sync_name, overwrite=overwrite)
+            if sync_data is not None:
+                sync_data.save(f'{load_path}/photodiode.fif', overwrite=overwrite)
+            else:
+                mne_data.save(f'{load_path}/photodiode.fif', picks=sync_name, overwrite=overwrite)
         elif sync_type == 'audio':
             pass
         elif sync_type == 'ttl':
@@ -1870,7 +2665,7 @@ seeg_only=True, check_bad=False):
 
         if site == 'MSSM':
             # Sometimes, there's electrodes on the pdf that are NOT in the MNE data structure... let's identify those as well. 
-            new_mne_names, _, _ = match_elec_names(mne_data.ch_names, elec_data.label)
+            new_mne_names, _, _ = match_elec_names(mne_data.ch_names, elec_data.label, method=match_method, overrides=match_overrides)
             # Rename the mne data according to the localization data
             new_name_dict = {x:y for (x,y) in zip(mne_data.ch_names, new_mne_names)}
             mne_data.rename_channels(new_name_dict)
@@ -1889,16 +2684,174 @@ seeg_only=True, check_bad=False):
             bads = detect_bad_elecs(mne_data, sEEG_mapping_dict)
             mne_data.info['bads'] = bads
 
-        if resample_sr is not None: 
+        if (resample_sr is not None) and (not fused): 
             mne_data.resample(sfreq=resample_sr, npad='auto', n_jobs=-1)
         print(f'Saving LFP data to {load_path}/lfp_data.fif')
         mne_data.save(f'{load_path}/lfp_data.fif', picks=seeg_names, overwrite=overwrite)
 
+    if use_cache:
+        # Remember what this run wrote, so a later hit can check that it is still there
+        output_files = [f'{load_path}/{x}' for x in ['lfp_data.fif', 'photodiode.fif', 'respiration_data.fif', 'scalp_eeg_data.fif', 'ekg_data.fif']]
+        manifest = {x: cache_utils.file_signature(x) for x in output_files if os.path.exists(x)}
+        cache_utils.save_stage(manifest, cache_dir, 'make_mne', cache_key)
+
     if return_data==True:
         return mne_data
 
 
-def ref_mne(mne_data=None, elec_path=None, method='wm', site='MSSM'):
+def make_reref_operator(ch_names, anode_list, cathode_list, ch_names_out=None):
+    """
+    Build a re-reference operator from a reference plan (the anode/cathode lists of wm_ref, bipolar_ref or 
+    laplacian_ref). 
+
+    The operator is a sparse matrix W (n_out, n_channels) such that W @ data gives every anode minus its cathode, or 
+    minus the mean of its cathodes when a cathode entry is a list. It can be applied to any Raw or Epochs object with 
+    these channels (see apply_reref_operator), and saved and reloaded to re-reference other sessions from the same 
+    implant without re-planning (see save_reref_operator). 
+
+    Parameters
+    ----------
+    ch_names : list 
+        input channels (at least all the anodes and cathodes) 
+    anode_list : list 
+        channels to subtract from
+    cathode_list : list 
+        channels to subtract: a channel name, or a list of channel names to average 
+    ch_names_out : list 
+        names of the re-referenced channels. Defaults to '{anode}-{cathode}_bp' (or '{anode}-avg' for averages)
+
+    Returns
+    -------
+    reref_operator : dict 
+        'matrix' (scipy.sparse.csr_matrix), 'ch_names_in' and 'ch_names_out' 
+    """
+
+    if ch_names_out is None:
+        ch_names_out = [f'{a}-{c}_bp' if isinstance(c, str) else f'{a}-avg' for a, c in zip(anode_list, cathode_list)]
+
+    ch_ix = {x: ix for ix, x in enumerate(ch_names)}
+    rows, cols, vals = [], [], []
+    for row, (anode, cathode) in enumerate(zip(anode_list, cathode_list)):
+        cathodes = [cathode] if isinstance(cathode, str) else list(cathode)
+        rows += [row] * (1 + len(cathodes))
+        cols += [ch_ix[anode]] + [ch_ix[x] for x in cathodes]
+        vals += [1.] + [-1. / len(cathodes)] * len(cathodes)
+
+    # duplicates (e.g. an anode that is also one of its own cathodes) are summed
+    matrix = sparse.csr_matrix((vals, (rows, cols)), shape=(len(anode_list), len(ch_names)))
+
+    return {'matrix': matrix, 'ch_names_in': list(ch_names), 'ch_names_out': list(ch_names_out)}
+
+
+def save_reref_operator(reref_operator, fname):
+    """
+    Save a re-reference operator (see make_reref_operator) to a .npz file 
+    """
+
+    matrix = reref_operator['matrix'].tocsr()
+    np.savez(fname, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=matrix.shape, 
+             ch_names_in=np.array(reref_operator['ch_names_in']), ch_names_out=np.array(reref_operator['ch_names_out']))
+
+
+def load_reref_operator(fname):
+    """
+    Load a re-reference operator saved with save_reref_operator 
+    """
+
+    with np.load(fname) as f:
+        matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+        return {'matrix': matrix, 'ch_names_in': f['ch_names_in'].tolist(), 'ch_names_out': f['ch_names_out'].tolist()}
+
+
+def apply_reref_operator(inst, reref_operator, copy=True, chunk_size=2**16):
+    """
+    Re-reference Raw or Epochs data with a re-reference operator: one sparse-dense product per chunk of samples 
+    (or per epoch), instead of one pair of channels at a time. 
+
+    Parameters
+    ----------
+    inst : mne object 
+        Raw or Epochs with (at least) the input channels of the operator, in any order 
+    reref_operator : dict 
+        see make_reref_operator 
+    copy : bool 
+        if False, the re-referenced data are written over the first rows of the data of inst (which must be preloaded) 
+        and the returned object shares that buffer, so the recording is never held twice. inst is unusable afterwards. 
+    chunk_size : int 
+        number of samples per product (Raw only) 
+
+    Returns
+    -------
+    inst_reref : mne object 
+        new Raw or Epochs with the ch_names_out channels. A channel is bad if any of its inputs is bad. 
+    """
+
+    # map the operator's columns onto the channels of inst
+    missing = [x for x in reref_operator['ch_names_in'] if x not in inst.ch_names]
+    coo = reref_operator['matrix'].tocoo()
+    if np.any(coo.data != 0) and missing:
+        used = set(np.array(reref_operator['ch_names_in'])[np.unique(coo.col)])
+        if used & set(missing):
+            raise ValueError(f'Channels needed for re-referencing are missing from the data: {sorted(used & set(missing))}')
+    inst_ix = {x: ix for ix, x in enumerate(inst.ch_names)}
+    col_map = np.array([inst_ix.get(x, -1) for x in reref_operator['ch_names_in']])
+    matrix = sparse.csr_matrix((coo.data, (coo.row, col_map[coo.col])), shape=(coo.shape[0], len(inst.ch_names)))
+    n_out = matrix.shape[0]
+
+    # output channels inherit the channel info (type, location, calibration) of their anode (largest coefficient), 
+    # and are bad if any input is bad
+    bads = set(inst.info['bads'])
+    anodes, out_bads = [], []
+    for row, ch in enumerate(reref_operator['ch_names_out']):
+        cols = matrix.indices[matrix.indptr[row]:matrix.indptr[row+1]]
+        vals = matrix.data[matrix.indptr[row]:matrix.indptr[row+1]]
+        anodes.append(cols[np.argmax(vals)])
+        if any([inst.ch_names[x] in bads for x in cols]):
+            out_bads.append(ch)
+
+    # keep everything else in the measurement info (filters, line frequency, subject, digitization...), as 
+    # mne.set_bipolar_reference does. pick_info needs unique picks, so anodes used more than once are copied after 
+    unique_anodes = list(dict.fromkeys(anodes))
+    info = mne.pick_info(inst.info, unique_anodes)
+    anode_pos = {x: ix for ix, x in enumerate(unique_anodes)}
+    with info._unlock():
+        info['chs'] = [deepcopy(info['chs'][anode_pos[x]]) for x in anodes]
+        for ch_info, ch in zip(info['chs'], reref_operator['ch_names_out']):
+            ch_info['ch_name'] = ch
+        # projectors refer to the input channels
+        info['projs'] = []
+        info._update_redundant()
+    info['bads'] = out_bads
+    info._check_consistency()
+
+    if not copy:
+        if not inst.preload:
+            raise ValueError('In-place re-referencing needs preloaded data')
+        if n_out > len(inst.ch_names):
+            raise ValueError('In-place re-referencing can not produce more channels than it starts with')
+
+    if isinstance(inst, mne.BaseEpochs):
+        data = inst.get_data() if copy else inst._data
+        out = data if not copy else np.empty((data.shape[0], n_out, data.shape[2]))
+        for ev in range(data.shape[0]):
+            out[ev, :n_out] = matrix @ data[ev]
+        inst_reref = mne.EpochsArray(out[:, :n_out], info, events=inst.events, tmin=inst.tmin, event_id=inst.event_id, 
+                                     metadata=inst.metadata, baseline=None, verbose=False)
+    else:
+        out = inst._data if not copy else np.empty((n_out, inst.n_times))
+        for start in range(0, inst.n_times, chunk_size):
+            stop = min(inst.n_times, start + chunk_size)
+            chunk = inst._data[:, start:stop] if inst.preload else inst.get_data(start=start, stop=stop)
+            # the product is complete before the rows are written back, so in-place is safe
+            out[:n_out, start:stop] = matrix @ chunk
+        inst_reref = mne.io.RawArray(out[:n_out], info, first_samp=inst.first_samp, copy='auto', verbose=False)
+        inst_reref.set_annotations(inst.annotations)
+
+    return inst_reref
+
+
+def ref_mne(mne_data=None, elec_path=None, method='wm', site='MSSM', average=False, reref_operator=None, save_operator=None, 
+            copy=True, use_cache=False, cache_dir=None, match_method='levenshtein', match_overrides=None):
     """
     Following this step, you can indicate IEDs manually.
 
@@ -1909,9 +2862,30 @@ def ref_mne(mne_data=None, elec_path=None, method='wm', site='MSSM'):
     elec_data : pandas df 
         dataframe with all the electrode localization information
     method : str 
-        how should we reference the data ['wm', 'bipolar']
+        how should we reference the data ['wm', 'bipolar', 'laplacian']
     site : str 
         where was this data collected? Options: ['MSSM', 'UI', 'Davis']
+    average : bool 
+        (method='wm' only) reference every electrode to the mean of its 3 closest same-hemisphere white matter 
+        electrodes instead of the lowest variance one. Applied as a sparse matrix product, chunked in time. 
+    reref_operator : dict or str 
+        re-reference operator (or path to one saved with save_operator) to apply instead of planning a new reference, 
+        e.g. to re-reference another session from the same implant the same way 
+    save_operator : str 
+        path to save the re-reference operator to (.npz) 
+    copy : bool 
+        if False, re-reference in place: the data of mne_data are overwritten and only one copy of the recording is 
+        held in memory (mne_data is unusable afterwards) 
+    use_cache : bool 
+        reuse the re-referenced data if the same data (hashed by content) was already re-referenced with the same 
+        electrode file and parameters (see cache_utils)
+    cache_dir : str 
+        where to keep the cache. Defaults to .lfp_cache next to the file mne_data was read from (or the electrode file)
+    match_method : str 
+        how to match the channel names to the localization names (see match_elec_names). Use 'batch' for unattended 
+        runs: the default may stop and ask for a manual tiebreak 
+    match_overrides : dict or str 
+        manual name matches for match_method='batch' (see match_elec_names) 
 
     Returns
     -------
@@ -1919,32 +2893,56 @@ def ref_mne(mne_data=None, elec_path=None, method='wm', site='MSSM'):
         mne object with re-referenced data
     """
 
-    elec_data = load_elec(elec_path, site=site)
+    if use_cache:
+        data_path = mne_data.filenames[0] if (mne_data.filenames and mne_data.filenames[0]) else elec_path
+        cache_dir = cache_dir or cache_utils.default_cache_dir(str(data_path))
+        cache_key = cache_utils.stage_key('ref_mne', [mne_data, elec_path], {'method': method, 'site': site, 'average': average, 
+                                                                  'reref_operator': reref_operator, 'match_method': match_method, 
+                                                                  'match_overrides': match_overrides})
+        mne_data_reref = cache_utils.load_stage(cache_dir, 'ref_mne', cache_key, kind='raw')
+        if mne_data_reref is not None:
+            return mne_data_reref
 
-    # Sometimes, there's electrodes on the pdf that are NOT in the MNE data structure... let's identify those as well. 
-    _, _, unmatched_seeg = match_elec_names(mne_data.ch_names, elec_data.label)
-  
-    if method=='wm':
-        anode_list, cathode_list, drop_wm_channels, oob_channels = wm_ref(mne_data=mne_data, 
-                                                                                       elec_path=elec_path, 
-                                                                                       bad_channels=mne_data.info['bads'], 
-                                                                                       unmatched_seeg=unmatched_seeg,
-                                                                                       site=site)
-    elif method=='bipolar':
-        anode_list, cathode_list, drop_wm_channels, oob_channels = bipolar_ref(elec_path=elec_path, 
-                                               bad_channels=mne_data.info['bads'], 
-                                               unmatched_seeg=unmatched_seeg,
-                                               site=site)
-        
-    # Check existing channels (optional, for debugging)
-    print("Existing channels:", mne_data.ch_names)
-    
-    # Note that, despite the name, the following function lets you manually set what is being subtracted from what:
-    mne_data_reref = mne.set_bipolar_reference(mne_data, 
-                          anode=anode_list, 
-                          cathode=cathode_list,
-                          ch_name=[f'{a}-{c}_bp' for a, c in zip(anode_list, cathode_list)],  # added by AD -- Custom unique names
-                          copy=True)
+    if reref_operator is None:
+        elec_data = load_elec(elec_path, site=site)
+
+        # Sometimes, there's electrodes on the pdf that are NOT in the MNE data structure... let's identify those as well. 
+        _, _, unmatched_seeg = match_elec_names(mne_data.ch_names, elec_data.label, method=match_method, overrides=match_overrides)
+      
+        if method=='wm':
+            anode_list, cathode_list, drop_wm_channels, oob_channels = wm_ref(mne_data=mne_data, 
+                                                                                           elec_path=elec_path, 
+                                                                                           bad_channels=mne_data.info['bads'], 
+                                                                                           unmatched_seeg=unmatched_seeg,
+                                                                                           site=site, 
+                                                                                           average=average)
+        elif method=='bipolar':
+            anode_list, cathode_list, drop_wm_channels, oob_channels = bipolar_ref(elec_path=elec_path, 
+                                                   bad_channels=mne_data.info['bads'], 
+                                                   unmatched_seeg=unmatched_seeg,
+                                                   site=site)
+        elif method=='laplacian':
+            anode_list, cathode_list, drop_wm_channels, oob_channels = laplacian_ref(mne_data=mne_data, 
+                                                   elec_path=elec_path, 
+                                                   bad_channels=mne_data.info['bads'], 
+                                                   unmatched_seeg=unmatched_seeg,
+                                                   site=site)
+            
+        # Check existing channels (optional, for debugging)
+        print("Existing channels:", mne_data.ch_names)
+
+        # averaged references get a suffix for the method, single ones are named after the pair
+        avg_suffix = 'lap' if method=='laplacian' else 'wm_avg'
+        ch_names_out = [f'{a}-{c}_bp' if isinstance(c, str) else f'{a}-{avg_suffix}' for a, c in zip(anode_list, cathode_list)]  # added by AD -- Custom unique names
+        reref_operator = make_reref_operator(mne_data.ch_names, anode_list, cathode_list, ch_names_out=ch_names_out)
+    elif isinstance(reref_operator, str):
+        reref_operator = load_reref_operator(reref_operator)
+
+    if save_operator is not None:
+        save_reref_operator(reref_operator, save_operator)
+
+    # anode minus cathode (or minus the mean of its cathodes) for every channel, as one sparse matrix product per chunk
+    mne_data_reref = apply_reref_operator(mne_data, reref_operator, copy=copy)
     
     # drop the unreferenced channels (oob or bad or wm)
     mne_data_reref.drop_channels([x for x in mne_data_reref.ch_names if '-' not in x])
@@ -1959,8 +2957,71 @@ def ref_mne(mne_data=None, elec_path=None, method='wm', site='MSSM'):
     sEEG_mapping_dict = {f'{x}':'seeg' for x in left_seeg_names+right_seeg_names}
     mne_data_reref.set_channel_types(sEEG_mapping_dict)
 
+    if use_cache:
+        cache_utils.save_stage(mne_data_reref, cache_dir, 'ref_mne', cache_key, kind='raw')
+
     return mne_data_reref
 
+def _bin_channelwise_times_long(channel_dict_seconds, ev_starts, ev_ends):
+    """
+    Bin channelwise timestamps into behavioral events, as a long-form table. 
+
+    Every timestamp is assigned to the first event (in event order) whose window [start, end] contains it, like 
+    overlapping windows always were. The windows are cut once into elementary pieces between their sorted boundaries, 
+    each piece is labelled with the first event covering it, and all the timestamps of all channels are then located 
+    with one np.searchsorted. 
+
+    Parameters
+    ----------
+    channel_dict_seconds : dict 
+        {channel name: timestamps (s)} 
+    ev_starts : array-like 
+        start of each event window (s) 
+    ev_ends : array-like 
+        end of each event window (s) 
+
+    Returns
+    -------
+    binned : pandas df 
+        one row per binned timestamp: channel, event (index of the event), offset (time since the event start, s), in 
+        channel order and then in the order of the timestamps 
+    """
+
+    ev_starts = np.asarray(ev_starts, dtype=float).ravel()
+    ev_ends = np.asarray(ev_ends, dtype=float).ravel()
+    channels = list(channel_dict_seconds.keys())
+    timestamps = [np.atleast_1d(np.asarray(channel_dict_seconds[ch], dtype=float)).ravel() for ch in channels]
+    chans = np.repeat(np.arange(len(channels)), [len(x) for x in timestamps])
+    timestamps = np.concatenate(timestamps) if len(timestamps) else np.array([])
+
+    # elementary pieces: every boundary (even pieces) and the open intervals between consecutive boundaries (odd)
+    boundaries = np.unique(np.concatenate([ev_starts, ev_ends]))
+    boundaries = boundaries[~np.isnan(boundaries)]
+    if not len(boundaries):
+        return pd.DataFrame({'channel': pd.Series([], dtype=object), 'event': np.array([], dtype=int),
+                             'offset': np.array([])})
+    piece_event = np.full(max(2 * len(boundaries) - 1, 0), -1)
+    first = 2 * np.searchsorted(boundaries, ev_starts)
+    last = 2 * np.searchsorted(boundaries, ev_ends)
+    # paint the windows from the last event to the first, so that the first event covering a piece wins
+    for ev in np.arange(len(ev_starts))[::-1]:
+        if ev_starts[ev] <= ev_ends[ev]:
+            piece_event[first[ev]:last[ev] + 1] = ev
+
+    # piece of every timestamp
+    ix = np.searchsorted(boundaries, timestamps, side='left')
+    on_boundary = (ix < len(boundaries)) & (boundaries[np.minimum(ix, len(boundaries) - 1)] == timestamps)
+    piece = np.where(on_boundary, 2 * ix, 2 * ix - 1)
+    inside = (piece >= 0) & (piece < len(piece_event)) & ~np.isnan(timestamps)
+    events = np.full(len(timestamps), -1)
+    events[inside] = piece_event[piece[inside]]
+    binned = events >= 0
+
+    return pd.DataFrame({'channel': np.array(channels, dtype=object)[chans[binned]], 
+                         'event': events[binned], 
+                         'offset': timestamps[binned] - ev_starts[events[binned]]})
+
+
 def _bin_channelwise_times_into_behav_evs(channel_dict_seconds, ev_starts, ev_ends):
     """
     feed in a dictionary of format {['channel_name']: [time1,...n]}
@@ -1972,39 +3033,260 @@ def _bin_channelwise_times_into_behav_evs(channel_dict_seconds, ev_starts, ev_en
     detections to the epoched data
     
     ev_starts and ev_ends should be the start and end of each epoch in seconds 
+
+    (one row per event, one column per channel, each cell being the list of offsets in that event or NaN; see 
+    _bin_channelwise_times_long for the long-form table)
     """
-    allts = {f'{x}': np.nan for x in channel_dict_seconds.keys()}
-    for key in channel_dict_seconds.keys():
-        timestamps = channel_dict_seconds[key]
-        time_bins = [(a,b) for (a,b) in zip(ev_starts, ev_ends)]
-
-        # Initialize a dictionary to store the assigned timestamps for each time bin
-        assigned_timestamps = {bin_index: [] for bin_index in range(len(time_bins))}
-
-        # Iterate through each timestamp and assign it to the appropriate time bin
-        for timestamp in timestamps:
-            for bin_index, (start, end) in enumerate(time_bins):
-                if start <= timestamp <= end:
-                    assigned_timestamps[bin_index].append(timestamp - start)
-                    break
-        allts[key] = assigned_timestamps
-    # Turn the dictionary into a metadata dataframe 
-    event_metadata = pd.DataFrame(columns=list(channel_dict_seconds.keys()), index=np.arange(len(time_bins)))
+
+    binned = _bin_channelwise_times_long(channel_dict_seconds, ev_starts, ev_ends)
+    n_events = len(np.asarray(ev_starts).ravel())
+
+    # Turn the long-form table into a metadata dataframe 
+    event_metadata = pd.DataFrame(columns=list(channel_dict_seconds.keys()), index=np.arange(n_events))
+    grouped = {ch: x for ch, x in binned.groupby('channel', sort=False)}
     for ch in list(channel_dict_seconds.keys()):
-        for ev, val in allts[ch].items():
-            if len(val) > 1:    
-                event_metadata[ch].loc[ev] = val
-            else:
-                if ~np.isnan(val): 
-                    event_metadata[ch].loc[ev] = val
-    # Replace all nan with Nones 
-    event_metadata.where(pd.notna(event_metadata), None)
+        cells = np.full(n_events, np.nan, dtype=object)
+        if ch in grouped:
+            for ev, offsets in grouped[ch].groupby('event', sort=False)['offset']:
+                cells[ev] = offsets.tolist()
+        event_metadata[ch] = cells
+
     return event_metadata
 
+
+def save_detections(path, detections, ch_names, n_events):
+    """
+    Save binned detections (IEDs, artifacts, ...) as a compact binary store (.npz, no pickled objects).
+
+    Parameters
+    ----------
+    path : str
+        where to save, e.g. {load_path}/{behav_name}_detections.npz
+    detections : dict
+        {kind: long-form table from _bin_channelwise_times_long}, e.g. {'IED': ..., 'artifact': ...}
+    ch_names : list
+        all the channels the detections were run on (including the ones without detections)
+    n_events : int
+        number of events (including the ones without detections)
+
+    Returns
+    -------
+    path : str
+        path of the store
+    """
+
+    ch_names = list(ch_names)
+    kinds = list(detections.keys())
+    ch_ix = {ch: ix for ix, ch in enumerate(ch_names)}
+
+    event, channel, time_s, kind = [], [], [], []
+    for kind_ix, kind_ in enumerate(kinds):
+        table = detections[kind_]
+        event.append(np.asarray(table['event'], dtype=np.int32))
+        channel.append(np.array([ch_ix[x] for x in table['channel']], dtype=np.int32))
+        time_s.append(np.asarray(table['offset'], dtype=float))
+        kind.append(np.full(len(table), kind_ix, dtype=np.int8))
+
+    np.savez_compressed(path,
+                        event=np.concatenate(event) if kinds else np.array([], dtype=np.int32),
+                        channel=np.concatenate(channel) if kinds else np.array([], dtype=np.int32),
+                        time_s=np.concatenate(time_s) if kinds else np.array([]),
+                        kind=np.concatenate(kind) if kinds else np.array([], dtype=np.int8),
+                        ch_names=np.array(ch_names, dtype=str),
+                        kinds=np.array(kinds, dtype=str),
+                        n_events=np.array(n_events))
+
+    return path
+
+
+def load_detections(path, ch_names=None, kinds=None):
+    """
+    Load a detection store written by save_detections.
+
+    Parameters
+    ----------
+    path : str
+        path of the .npz store
+    ch_names : list
+        channels to keep, in this order (e.g. epochs.ch_names). Defaults to all the channels of the store
+    kinds : list
+        kinds of detections to keep (e.g. ['IED']). Defaults to all of them
+
+    Returns
+    -------
+    detections : pandas df
+        long-form table with columns event, channel (index into ch_names), ch_name, time_s (s since the start of
+        the event window), kind, sorted by event then channel
+    ch_names : list
+        channel names the channel column indexes into
+    n_events : int
+        number of events
+    """
+
+    with np.load(path, allow_pickle=False) as store:
+        event = store['event']
+        channel = store['channel']
+        time_s = store['time_s']
+        kind = store['kind']
+        stored_ch_names = store['ch_names'].tolist()
+        stored_kinds = store['kinds'].tolist()
+        n_events = int(store['n_events'])
+
+    if ch_names is None:
+        ch_names = stored_ch_names
+    ch_names = list(ch_names)
+
+    # re-index the channels onto ch_names (-1: not requested)
+    new_ix = {ch: ix for ix, ch in enumerate(ch_names)}
+    remap = np.array([new_ix.get(ch, -1) for ch in stored_ch_names], dtype=np.int64)
+    channel = remap[channel]
+    keep = channel >= 0
+    if kinds is not None:
+        keep &= np.isin(kind, [stored_kinds.index(x) for x in kinds if x in stored_kinds])
+
+    order = np.lexsort((channel[keep], event[keep]))
+    detections = pd.DataFrame({'event': event[keep][order].astype(int),
+                               'channel': channel[keep][order].astype(int),
+                               'time_s': time_s[keep][order],
+                               'kind': np.array(stored_kinds, dtype=object)[kind[keep][order]] if len(order) else []})
+    detections['ch_name'] = np.array(ch_names, dtype=object)[detections['channel'].values] if len(detections) else []
+    detections = detections[['event', 'channel', 'ch_name', 'time_s', 'kind']]
+
+    return detections, ch_names, n_events
+
+
+def detection_slices(detections, n_events, n_channels):
+    """
+    Row bounds of every (event, channel) in a detection table sorted by event then channel (see load_detections),
+    so that the detections of event ev on channel ch are detections.iloc[start[ev, ch]:stop[ev, ch]].
+
+    Parameters
+    ----------
+    detections : pandas df
+        output of load_detections
+    n_events : int
+        number of events
+    n_channels : int
+        number of channels
+
+    Returns
+    -------
+    start : np.ndarray
+        (n_events, n_channels) first row of each (event, channel)
+    stop : np.ndarray
+        (n_events, n_channels) row after the last row of each (event, channel)
+    """
+
+    flat = detections['event'].values * n_channels + detections['channel'].values
+    bounds = np.searchsorted(flat, np.arange(n_events * n_channels + 1))
+
+    return bounds[:-1].reshape(n_events, n_channels), bounds[1:].reshape(n_events, n_channels)
+
+
+def detections_to_mask(detections, n_events, n_channels, n_times, sfreq, pad=0.1):
+    """
+    Boolean (event, channel, time) mask of the samples within pad seconds of a detection, e.g. to NaN out the
+    IEDs and artifacts of a TFR with np.copyto(power.data, np.nan, where=mask[:, :, None, :]).
+
+    Every detection at time t covers the samples floor((t - pad) * sfreq) to ceil((t + pad) * sfreq) (excluded),
+    clipped to the epoch. The intervals are scattered all at once as +1/-1 steps and integrated with a cumulative
+    sum, only for the (event, channel) pairs that have detections.
+
+    Parameters
+    ----------
+    detections : pandas df
+        long-form table with event, channel (index) and time_s columns (see load_detections)
+    n_events : int
+        number of events
+    n_channels : int
+        number of channels
+    n_times : int
+        number of samples per epoch
+    sfreq : float
+        sampling rate
+    pad : float
+        time (s) to mask before and after each detection
+
+    Returns
+    -------
+    mask : np.ndarray
+        (n_events, n_channels, n_times) boolean, True where the data should be masked
+    """
+
+    mask = np.zeros((n_events, n_channels, n_times), dtype=bool)
+    if not len(detections):
+        return mask
+
+    times = np.asarray(detections['time_s'], dtype=float)
+    starts = np.maximum(0, np.floor((times - pad) * sfreq)).astype(int)
+    ends = np.minimum(n_times, np.ceil((times + pad) * sfreq)).astype(int)
+    valid = starts < ends
+
+    # one row per (event, channel) pair with detections
+    pairs, row = np.unique(np.asarray(detections['event'])[valid] * n_channels + np.asarray(detections['channel'])[valid],
+                           return_inverse=True)
+    steps = np.zeros((len(pairs), n_times + 1), dtype=np.int32)
+    np.add.at(steps, (row, starts[valid]), 1)
+    np.add.at(steps, (row, ends[valid]), -1)
+    mask.reshape(-1, n_times)[pairs] = np.cumsum(steps[:, :-1], axis=1) > 0
+
+    return mask
+
+
+def _detections_from_csvs(load_path, behav_name, ch_names):
+    # Long-form detections (as in load_detections) from the older {behav_name}_IED_df.csv/_artifact_df.csv files
+    rows = []
+    for kind, file in [('IED', f'{load_path}/{behav_name}_IED_df.csv'), ('artifact', f'{load_path}/{behav_name}_artifact_df.csv')]:
+        df = pd.read_csv(file)
+        for ch_ix, ch_name in enumerate(ch_names):
+            if ch_name not in df.columns:
+                continue
+            for ev_, cell in df[ch_name].dropna().items():
+                rows += [(ev_, ch_ix, ch_name, float(x), kind) for x in np.atleast_1d(literal_eval(cell))]
+        n_events = len(df)
+
+    detections = pd.DataFrame(rows, columns=['event', 'channel', 'ch_name', 'time_s', 'kind'])
+    detections = detections.sort_values(['event', 'channel'], kind='stable').reset_index(drop=True)
+
+    return detections, list(ch_names), n_events
+
+
+def read_event_detections(load_path, behav_name, ch_names=None):
+    """
+    Load the detections binned by make_epochs for an event: the {behav_name}_detections.npz store if there is one,
+    otherwise the {behav_name}_IED_df.csv and {behav_name}_artifact_df.csv files written by older versions.
+
+    Parameters
+    ----------
+    load_path : str
+        directory with the epochs and detections
+    behav_name : str
+        name of the event
+    ch_names : list
+        channels to keep, in this order. Required for the csv files
+
+    Returns
+    -------
+    see load_detections
+    """
+
+    if os.path.exists(f'{load_path}/{behav_name}_detections.npz'):
+        return load_detections(f'{load_path}/{behav_name}_detections.npz', ch_names=ch_names)
+
+    return _detections_from_csvs(load_path, behav_name, ch_names)
+
+
+def _event_detection_files(load_path, behav_name):
+    # Files read by read_event_detections (for cache keys)
+    if os.path.exists(f'{load_path}/{behav_name}_detections.npz'):
+        return [f'{load_path}/{behav_name}_detections.npz']
+
+    return [f'{load_path}/{behav_name}_IED_df.csv', f'{load_path}/{behav_name}_artifact_df.csv']
+
 def make_epochs(load_path=None, slope=None, offset=None, behav_name=None, behav_times=None,
 ev_start_s=0, ev_end_s=1.5, buf_s=1, downsamp_factor=None, IED_args=None, baseline=None, 
 nan_artifacts_pre_epoch=True,
-detrend=None):
+detrend=None, use_cache=False, cache_dir=None, save_csvs=False):
 
     # elec_path=None,
     """
@@ -2047,6 +3329,14 @@ detrend=None):
         factor by which to downsample the data 
     IED_args: dict 
         format {'peak_thresh':5, 'closeness_thresh':0.5, 'width_thresh':0.2}
+    use_cache : bool 
+        reuse the IED/artifact detections (shared by every behav_name of the session) and the epochs if they were 
+        already computed from the same file with the same parameters (see cache_utils)
+    cache_dir : str 
+        where to keep the cache. Defaults to .lfp_cache next to load_path
+    save_csvs : bool 
+        the IED and artifact detections binned into the events are saved in {behav_name}_detections.npz (see 
+        save_detections). If True, also write the older {behav_name}_IED_df.csv and {behav_name}_artifact_df.csv 
 
     Returns
     -------
@@ -2054,16 +3344,30 @@ detrend=None):
         mne Epoch object with re-referenced data
     """
 
-    # Load the data 
-    mne_data_reref = mne.io.read_raw_fif(load_path, preload=True)
-
-    IED_sec_dict = lfp_preprocess_utils.detect_IEDs(mne_data_reref, 
-                                            peak_thresh=IED_args['peak_thresh'], 
-                                            closeness_thresh=IED_args['closeness_thresh'], 
-                                            width_thresh=IED_args['width_thresh'])
-
-    artifact_sec_dict = lfp_preprocess_utils.detect_misc_artifacts(mne_data_reref, 
-                                            peak_thresh=IED_args['peak_thresh'])                                        
+    if use_cache:
+        epochs_params = {k: v for k, v in locals().items() if k not in ['load_path', 'IED_args', 'nan_artifacts_pre_epoch', 'use_cache', 'cache_dir', 'save_csvs']}
+        cache_dir = cache_dir or cache_utils.default_cache_dir(load_path)
+        detections_key = cache_utils.stage_key('detections', [load_path], IED_args)
+        detections = cache_utils.load_stage(cache_dir, 'detections', detections_key)
+    else:
+        detections = None
+
+    # Load the data (only needed here if the detections have to be computed)
+    mne_data_reref = None
+    if detections is None:
+        mne_data_reref = mne.io.read_raw_fif(load_path, preload=True)
+
+        IED_sec_dict = lfp_preprocess_utils.detect_IEDs(mne_data_reref, 
+                                                peak_thresh=IED_args['peak_thresh'], 
+                                                closeness_thresh=IED_args['closeness_thresh'], 
+                                                width_thresh=IED_args['width_thresh'])
+
+        artifact_sec_dict = lfp_preprocess_utils.detect_misc_artifacts(mne_data_reref, 
+                                                peak_thresh=IED_args['peak_thresh'])                                        
+        if use_cache:
+            cache_utils.save_stage((IED_sec_dict, artifact_sec_dict), cache_dir, 'detections', detections_key)
+    else:
+        IED_sec_dict, artifact_sec_dict = detections
 
     # all behavioral times of interest 
     beh_ts = [(float(x)*slope + offset) if x != 'None' else np.nan for x in behav_times]
@@ -2075,13 +3379,28 @@ detrend=None):
     ev_starts = [x - ev_start_s for x in beh_ts]
     ev_ends = [x + ev_end_s for x in beh_ts]
 
-    IED_df = _bin_channelwise_times_into_behav_evs(IED_sec_dict, ev_starts, ev_ends)
-    artifact_df = _bin_channelwise_times_into_behav_evs(artifact_sec_dict, ev_starts, ev_ends)
+    IED_binned = _bin_channelwise_times_long(IED_sec_dict, ev_starts, ev_ends)
+    artifact_binned = _bin_channelwise_times_long(artifact_sec_dict, ev_starts, ev_ends)
 
-    # # save these out as csvs in the load path 
+    # # save these out in the load path 
     bads_path = os.path.dirname(load_path)
-    IED_df.to_csv(f'{bads_path}/{behav_name}_IED_df.csv')
-    artifact_df.to_csv(f'{bads_path}/{behav_name}_artifact_df.csv')
+    save_detections(f'{bads_path}/{behav_name}_detections.npz', {'IED': IED_binned, 'artifact': artifact_binned}, 
+                    ch_names=list(dict.fromkeys(list(IED_sec_dict.keys()) + list(artifact_sec_dict.keys()))), 
+                    n_events=len(ev_starts))
+    if save_csvs:
+        IED_df = _bin_channelwise_times_into_behav_evs(IED_sec_dict, ev_starts, ev_ends)
+        artifact_df = _bin_channelwise_times_into_behav_evs(artifact_sec_dict, ev_starts, ev_ends)
+        IED_df.to_csv(f'{bads_path}/{behav_name}_IED_df.csv')
+        artifact_df.to_csv(f'{bads_path}/{behav_name}_artifact_df.csv')
+
+    if use_cache:
+        epochs_key = cache_utils.stage_key('epochs', [load_path], epochs_params)
+        ev_epochs = cache_utils.load_stage(cache_dir, 'epochs', epochs_key, kind='epochs')
+        if ev_epochs is not None:
+            return ev_epochs
+
+    if mne_data_reref is None:
+        mne_data_reref = mne.io.read_raw_fif(load_path, preload=True)
 
     #  it doesn't make sense to nan the raw data before computations 
     # instead, let's just save the indices relative to the epochs and nan them after all is said 
@@ -2162,6 +3481,9 @@ detrend=None):
     #     # save out the noisy epochs 
     #     noise_df.to_csv(f'{bads_path}/noise_df.csv')
 
+    if use_cache:
+        cache_utils.save_stage(ev_epochs, cache_dir, 'epochs', epochs_key, kind='epochs')
+
     return ev_epochs
 
 # def get_bad_epochs_by_chan(epochs):
@@ -2284,7 +3606,8 @@ def rename_elec_df_reref(reref_labels, elec_path, site='MSSM'):
 #
 
 def compute_and_baseline_tfr(baseline_event, task_events, freqs, n_cycles, load_path, save_path,
-                            IED_artifact_thresh=True, uncaptured_z_thresh=True, output='save'):
+                            IED_artifact_thresh=True, uncaptured_z_thresh=True, output='save', use_cache=False, cache_dir=None,
+                            detection_pad=0.1):
     
     """
     This function computes the TFRs for the baseline and task events of interest, and baselines the task events of interest
@@ -2304,67 +3627,73 @@ def compute_and_baseline_tfr(baseline_event, task_events, freqs, n_cycles, load_
     save_path : str
         The path to the directory where the TFRs will be saved
     IED_artifact_thresh : bool
-        If True, will remove 100 ms before and after IEDs and artifacts from the TFRs
+        If True, will remove detection_pad s before and after IEDs and artifacts from the TFRs
     uncaptured_z_thresh : bool
         If True, will iteratively remove absurd z-scores from the TFRs
     output : str
         If 'save', will save the TFRs to the save_path
         If 'return', will return the TFRs
         If 'both', will save and return the TFRs
+    use_cache : bool
+        If True, will reuse the (cropped, artifact-removed) baseline TFR if it was already computed from the same 
+        epochs and detection files with the same parameters (see cache_utils)
+    cache_dir : str
+        Where to keep the cache. Defaults to load_path/.lfp_cache
+    detection_pad : float
+        Time (s) removed before and after each IED and artifact. Default is 0.1
     
     """
     
     
     baseline_name = list(baseline_event.keys())[0]
     
-    # load baseline epochs
-    baseline_epochs_reref = mne.read_epochs(f'{load_path}/{baseline_name}-epo.fif', preload=True)
+    baseline_power = None
+    if use_cache:
+        cache_dir = cache_dir or cache_utils.default_cache_dir(load_path)
+        baseline_inputs = [f'{load_path}/{baseline_name}-epo.fif']
+        if IED_artifact_thresh:
+            baseline_inputs += _event_detection_files(load_path, baseline_name)
+        baseline_key = cache_utils.stage_key('baseline_tfr', baseline_inputs, {'baseline_event': baseline_event, 'freqs': freqs, 
+                                                                              'n_cycles': n_cycles, 'IED_artifact_thresh': IED_artifact_thresh, 
+                                                                              'detection_pad': detection_pad})
+        baseline_power = cache_utils.load_stage(cache_dir, 'baseline_tfr', baseline_key, kind='tfr')
+
+    if baseline_power is None:
+        # load baseline epochs
+        baseline_epochs_reref = mne.read_epochs(f'{load_path}/{baseline_name}-epo.fif', preload=True)
     
-    # compute TFR
-    baseline_power  = mne.time_frequency.tfr_morlet(baseline_epochs_reref, 
-                                          freqs=freqs, 
-                                          n_cycles=n_cycles, 
-                                          picks=baseline_epochs_reref.ch_names,
-                                          use_fft=True, 
-                                          n_jobs=-1, 
-                                          output='power', 
-                                          return_itc=False, 
-                                          average=False)
+        # compute TFR
+        baseline_power  = mne.time_frequency.tfr_morlet(baseline_epochs_reref, 
+                                              freqs=freqs, 
+                                              n_cycles=n_cycles, 
+                                              picks=baseline_epochs_reref.ch_names,
+                                              use_fft=True, 
+                                              n_jobs=-1, 
+                                              output='power', 
+                                              return_itc=False, 
+                                              average=False)
     
 
-    # Crop the data to the appropriate 
-    baseline_power.crop(tmin=baseline_event[baseline_name][0], 
-                        tmax=baseline_event[baseline_name][1])
+        # Crop the data to the appropriate 
+        baseline_power.crop(tmin=baseline_event[baseline_name][0], 
+                            tmax=baseline_event[baseline_name][1])
     
     
-    if IED_artifact_thresh:
-        # NAN out the bad data
-        # THE following will now LOAD in dataframes that indicate IED and artifact time points in your data
-        IED_df = pd.read_csv(f'{load_path}/{baseline_name}_IED_df.csv') 
-        artifact_df = pd.read_csv(f'{load_path}/{baseline_name}_artifact_df.csv') 
-
-
-        # Now, let's iterate through each channel, and each ied/artifact, and NaN 100 ms before and after these timepoints
-        for ch_ix, ch_name in enumerate(baseline_epochs_reref.ch_names): 
-            ied_ev_list = IED_df[ch_name].dropna().index.tolist()
-            artifact_ev_list = artifact_df[ch_name].dropna().index.tolist() 
-            for ev_ in ied_ev_list: 
-                for ied_ in literal_eval(IED_df[ch_name].iloc[ev_]):
-                    # remove 100 ms before 
-                    ev_ix_start = np.max([0, np.floor((ied_- 0.1) * baseline_epochs_reref.info['sfreq'])]).astype(int)
-                    # remove 100 ms after 
-                    ev_ix_end = np.min([baseline_power.data.shape[-1], np.ceil((ied_ + 0.1) * baseline_epochs_reref.info['sfreq'])]).astype(int)
-                    baseline_power.data[ev_, ch_ix, :, ev_ix_start:ev_ix_end] = np.nan
-            for ev_ in artifact_ev_list: 
-                for artifact_ in literal_eval(artifact_df[ch_name].iloc[ev_]):
-                    # remove 100 ms before 
-                    ev_ix_start = np.max([0, np.floor((artifact_- 0.1) * baseline_epochs_reref.info['sfreq'])]).astype(int)
-                    # remove 100 ms after
-                    ev_ix_end = np.min([baseline_power.data.shape[-1], np.ceil((artifact_ + 0.1) * baseline_epochs_reref.info['sfreq'])]).astype(int)
-                    baseline_power.data[ev_, ch_ix, :, ev_ix_start:ev_ix_end] = np.nan
+        if IED_artifact_thresh:
+            # NAN out the bad data
+            # THE following will now LOAD in dataframes that indicate IED and artifact time points in your data
+            detections, _, _ = read_event_detections(load_path, baseline_name, ch_names=baseline_epochs_reref.ch_names)
+
+            # NaN detection_pad s before and after each ied/artifact, across all frequencies
+            bad_mask = detections_to_mask(detections, baseline_power.data.shape[0], baseline_power.data.shape[1], baseline_power.data.shape[-1], 
+                                          baseline_epochs_reref.info['sfreq'], pad=detection_pad)
+            np.copyto(baseline_power.data, np.nan, where=bad_mask[:, :, None, :])
+    
+        if use_cache:
+            cache_utils.save_stage(baseline_power, cache_dir, 'baseline_tfr', baseline_key, kind='tfr')
     
-    # remove epochs from memory
-    del baseline_epochs_reref
+        # remove epochs from memory
+        del baseline_epochs_reref
     
     # Now we will deal with the task events of interest   
     
@@ -2391,27 +3720,12 @@ def compute_and_baseline_tfr(baseline_event, task_events, freqs, n_cycles, load_
         if IED_artifact_thresh:
             # NAN out the bad data
             # THE following will now LOAD in dataframes that indicate IED and artifact time points in your data
-            IED_df = pd.read_csv(f'{load_path}/{event}_IED_df.csv') 
-            artifact_df = pd.read_csv(f'{load_path}/{event}_artifact_df.csv') 
-
-            # Now, let's iterate through each channel, and each ied/artifact, and NaN 100 ms before and after these timepoints
-            for ch_ix, ch_name in enumerate(event_epochs_reref.ch_names): 
-                ied_ev_list = IED_df[ch_name].dropna().index.tolist()
-                artifact_ev_list = artifact_df[ch_name].dropna().index.tolist() 
-                for ev_ in ied_ev_list: 
-                    for ied_ in literal_eval(IED_df[ch_name].iloc[ev_]):
-                        # remove 100 ms before 
-                        ev_ix_start = np.max([0, np.floor((ied_- 0.1) * event_epochs_reref.info['sfreq'])]).astype(int)
-                        # remove 100 ms after
-                        ev_ix_end = np.min([temp_pow.data.shape[-1], np.ceil((ied_ + 0.1) * event_epochs_reref.info['sfreq'])]).astype(int)
-                        temp_pow.data[ev_, ch_ix, :, ev_ix_start:ev_ix_end] = np.nan
-                for ev_ in artifact_ev_list: 
-                    for artifact_ in literal_eval(artifact_df[ch_name].iloc[ev_]):
-                        # remove 100 ms before 
-                        ev_ix_start = np.max([0, np.floor((artifact_- 0.1) * event_epochs_reref.info['sfreq'])]).astype(int)
-                        # remove 100 ms after
-                        ev_ix_end = np.min([temp_pow.data.shape[-1], np.ceil((artifact_ + 0.1) * event_epochs_reref.info['sfreq'])]).astype(int)
-                        temp_pow.data[ev_, ch_ix, :, ev_ix_start:ev_ix_end] = np.nan    
+            detections, _, _ = read_event_detections(load_path, event, ch_names=event_epochs_reref.ch_names)
+
+            # NaN detection_pad s before and after each ied/artifact, across all frequencies
+            bad_mask = detections_to_mask(detections, temp_pow.data.shape[0], temp_pow.data.shape[1], temp_pow.data.shape[-1], 
+                                          event_epochs_reref.info['sfreq'], pad=detection_pad)
+            np.copyto(temp_pow.data, np.nan, where=bad_mask[:, :, None, :])
     
         # Compute first pass of baseline
         baseline_corrected_power = baseline_trialwise_TFR(data=temp_pow.data, include_epoch_in_baseline=False, 
@@ -7,9 +7,12 @@
 from __future__ import division
 
 import os
+import re
 import warnings
 import numpy as np
+import pandas as pd
 import datetime
+from joblib import Parallel, delayed
 
 HEADER_LENGTH = 16 * 1024  # 16 kilobytes of header
 
@@ -45,10 +48,20 @@ NEV_RECORD = np.dtype([('stx',           np.int16),      # Reserved
                                                          # character. If the string is less than 127 characters, the
                                                          # remainder of the characters will be null.
 
+NCS_SEGMENT = np.dtype([('start_sample',  np.int64),     # First sample (in the concatenated Samples) of a run of
+                                                             # records without timestamp discontinuities
+                        ('n_samples',     np.int64),     # Number of samples in the run
+                        ('TimeStamp',     np.uint64),    # Cheetah timestamp (µs) of the first sample of the run
+                        ('SamplePeriod',  np.float64)])  # Time between consecutive samples (µs)
+
 VOLT_SCALING = (1, u'V')
 MILLIVOLT_SCALING = (1000, u'mV')
 MICROVOLT_SCALING = (1000000, u'µV')
 
+# Parsed headers and directory scan results, keyed on (path, mtime, size) so that a file that is rewritten is re-read
+_HEADER_CACHE = dict()
+_SCAN_CACHE = dict()
+
 
 def read_header(fid):
     # Read the raw header data (16 kb) from the file object fid. Restores the position in the file object after reading.
@@ -101,6 +114,33 @@ def parse_header(raw_hdr):
     return hdr
 
 
+def file_signature(file_path):
+    # (absolute path, modification time, size) of a file. Used as the key of the header and scan caches.
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+
+    return (file_path, stat.st_mtime_ns, stat.st_size)
+
+
+def read_cached_header(file_path):
+    # Read and parse the header of file_path, or return it from the cache if the file has not changed since it was
+    # last parsed. Returns the raw header and a copy of the parsed header (so callers can't modify the cached one).
+    key = file_signature(file_path)
+    if key not in _HEADER_CACHE:
+        with open(key[0], 'rb') as fid:
+            raw_header = read_header(fid)
+        _HEADER_CACHE[key] = (raw_header, parse_header(raw_header))
+    raw_header, header = _HEADER_CACHE[key]
+
+    return raw_header, dict(header)
+
+
+def clear_header_cache():
+    # Forget all cached headers and directory scans
+    _HEADER_CACHE.clear()
+    _SCAN_CACHE.clear()
+
+
 def read_records(fid, record_dtype, record_skip=0, count=None):
     # Read count records (default all) from the file object fid skipping the first record_skip records. Restores the
     # position of the file object after reading.
@@ -116,6 +156,16 @@ def read_records(fid, record_dtype, record_skip=0, count=None):
     return rec
 
 
+def map_records(file_path, record_dtype):
+    # Memory-map all the records of the file (everything after the header) as a read-only structured array. Nothing is
+    # read from disk until a field is accessed.
+    n_records = int(estimate_record_count(file_path, record_dtype))
+    if n_records == 0:
+        return np.zeros(0, dtype=record_dtype)
+
+    return np.memmap(file_path, dtype=record_dtype, mode='r', offset=HEADER_LENGTH, shape=(n_records,))
+
+
 def estimate_record_count(file_path, record_dtype):
     # Estimate the number of records from the file size
     file_size = os.path.getsize(file_path)
@@ -162,27 +212,113 @@ def check_ncs_records(records):
         return True
 
 
-def load_ncs(file_path, load_time=True, rescale_data=True, signal_scaling=VOLT_SCALING):
-    # Load the given file as a Neuralynx .ncs continuous acquisition file and extract the contents
+def build_ncs_segment_index(timestamps, sampling_rate, samples_per_record=NCS_SAMPLES_PER_RECORD):
+    """
+    Build a compact gap/segment index from the record timestamps of an ncs file. 
+
+    There is one entry per contiguous run of records (i.e. one per discontinuity + 1) instead of one timestamp per 
+    sample, which is enough to recover the time of any sample with ncs_sample_times. 
+
+    The record period is estimated as the median difference between record timestamps (the SampleFreq in the records is 
+    rounded to an integer), and a new segment is started wherever consecutive records are further apart than that by 
+    more than half a sample. 
+
+    Parameters
+    ----------
+    timestamps : np.ndarray 
+        the TimeStamp field of the records (µs)
+    sampling_rate : float 
+        nominal sampling rate, only used when there are too few records to estimate the record period 
+    samples_per_record : int 
+        number of samples per record 
+
+    Returns
+    -------
+    segments : np.ndarray, dtype NCS_SEGMENT
+        the segment index
+    """
+
+    timestamps = np.asarray(timestamps).astype(np.int64)
+    if timestamps.shape[0] == 0:
+        return np.zeros(0, dtype=NCS_SEGMENT)
+
+    dt = np.diff(timestamps)
+    if dt.shape[0] > 0:
+        record_period = np.median(dt)
+    else:
+        record_period = samples_per_record / np.float64(sampling_rate) * 1e6
+    sample_period = record_period / samples_per_record
+
+    # a discontinuity is any jump that doesn't match the record period to within half a sample
+    seg_starts = np.concatenate([[0], np.where(np.abs(dt - record_period) > 0.5 * sample_period)[0] + 1])
+    seg_ends = np.append(seg_starts[1:], timestamps.shape[0])
+
+    segments = np.zeros(seg_starts.shape[0], dtype=NCS_SEGMENT)
+    segments['start_sample'] = seg_starts * samples_per_record
+    segments['n_samples'] = (seg_ends - seg_starts) * samples_per_record
+    segments['TimeStamp'] = timestamps[seg_starts]
+    segments['SamplePeriod'] = sample_period
+
+    return segments
+
+
+def ncs_sample_times(segments, samples):
+    """
+    Compute the Cheetah time (µs) of arbitrary sample indices from a segment index (see build_ncs_segment_index). 
+
+    Parameters
+    ----------
+    segments : np.ndarray, dtype NCS_SEGMENT
+        the segment index of the file 
+    samples : int or np.ndarray 
+        sample indices (into the concatenated samples of the file)
+
+    Returns
+    -------
+    times : np.ndarray
+        time of each sample in µs (float64, so sub-microsecond sample times are not rounded)
+    """
+
+    samples = np.asarray(samples)
+    seg = np.clip(np.searchsorted(segments['start_sample'], samples, side='right') - 1, 0, None)
+
+    return segments['TimeStamp'][seg] + (samples - segments['start_sample'][seg]) * segments['SamplePeriod'][seg]
+
+
+def load_ncs(file_path, load_time=True, rescale_data=True, signal_scaling=VOLT_SCALING, mmap=False):
+    # Load the given file as a Neuralynx .ncs continuous acquisition file and extract the contents.
+    # If mmap=True, the records are memory-mapped instead of read into RAM: ncs['data'] is then a strided int16 view of
+    # the samples (shape [n_records, 512]) and the ADBitVolts scaling is deferred to read_ncs_samples, so only the
+    # slices that are actually requested are converted to float.
     file_path = os.path.abspath(file_path)
-    with open(file_path, 'rb') as fid:
-        raw_header = read_header(fid)
-        records = read_records(fid, NCS_RECORD)
+    raw_header, header = read_cached_header(file_path)
+    if mmap:
+        records = map_records(file_path, NCS_RECORD)
+    else:
+        with open(file_path, 'rb') as fid:
+            records = read_records(fid, NCS_RECORD)
 
-    header = parse_header(raw_header)
     check_ncs_records(records)
 
-    # Reshape (and rescale, if requested) the data into a 1D array
-    data = records['Samples'].ravel()
-    #data = records['Samples'].reshape((NCS_SAMPLES_PER_RECORD * len(records), 1))
+    # ADBitVolts specifies the conversion factor between the ADC counts and volts
+    scale = None
     if rescale_data:
         try:
-            # ADBitVolts specifies the conversion factor between the ADC counts and volts
-            data = data.astype(np.float64) * (np.float64(header['ADBitVolts']) * signal_scaling[0])
+            scale = np.float64(header['ADBitVolts']) * signal_scaling[0]
         except KeyError:
             warnings.warn('Unable to rescale data, no ADBitVolts value specified in header')
             rescale_data = False
 
+    if mmap:
+        # Keep the samples as a (n_records, 512) strided view into the file: no copy, no upcast
+        data = records['Samples']
+    else:
+        # Reshape (and rescale, if requested) the data into a 1D array
+        data = records['Samples'].ravel()
+        #data = records['Samples'].reshape((NCS_SAMPLES_PER_RECORD * len(records), 1))
+        if rescale_data:
+            data = data.astype(np.float64) * scale
+
     # Pack the extracted data in a dictionary that is passed out of the function
     ncs = dict()
     ncs['file_path'] = file_path
@@ -193,10 +329,14 @@ def load_ncs(file_path, load_time=True, rescale_data=True, signal_scaling=VOLT_S
     ncs['sampling_rate'] = records['SampleFreq'][0]
     ncs['channel_number'] = records['ChannelNumber'][0]
     ncs['timestamp'] = records['TimeStamp']
+    ncs['segments'] = build_ncs_segment_index(records['TimeStamp'], ncs['sampling_rate'])
+    ncs['mmap'] = mmap
+    # scaling that still has to be applied to ncs['data'] (only deferred in mmap mode)
+    ncs['scale'] = scale if mmap else None
 
     # Calculate the sample time points (if needed)
     if load_time:
-        num_samples = data.shape[0]
+        num_samples = data.size
         times = np.interp(np.arange(num_samples), np.arange(0, num_samples, 512), records['TimeStamp']).astype(np.uint64)
         ncs['time'] = times
         ncs['time_units'] = u'µs'
@@ -204,15 +344,107 @@ def load_ncs(file_path, load_time=True, rescale_data=True, signal_scaling=VOLT_S
     return ncs
 
 
+def read_ncs_samples(ncs, start=0, stop=None, dtype=np.float64, rescale=True):
+    """
+    Read a slice of samples out of an ncs dict returned by load_ncs. 
+
+    For memory-mapped ncs dicts (load_ncs(..., mmap=True)) only the records that overlap [start, stop) are touched, and 
+    the ADBitVolts scaling is applied to that slice alone. For regular ncs dicts this is just a slice of ncs['data'].
+
+    Parameters
+    ----------
+    ncs : dict
+        output of load_ncs
+    start : int
+        first sample to read 
+    stop : int
+        sample to stop reading at (exclusive). Defaults to the end of the recording. 
+    dtype : numpy dtype
+        float type to return scaled data in. Ignored if the data are not being rescaled. 
+    rescale : bool 
+        apply the deferred scaling. If False, memory-mapped data are returned as raw int16 ADC counts. 
+
+    Returns
+    -------
+    samples : np.ndarray, shape (n_samples,)
+        the requested samples, in ncs['data_units'] (or ADC counts if rescale=False)
+    """
+
+    data = ncs['data']
+    if data.ndim == 1:
+        # flat data (load_ncs without mmap, or merge_multiple_ncs_files) 
+        samples = data[start:stop]
+    else:
+        # data is a (n_records, 512) strided view: only pull the records we need
+        start, stop, _ = slice(start, stop).indices(data.size)
+        stop = max(start, stop)
+        rec_start = start // NCS_SAMPLES_PER_RECORD
+        rec_stop = -(-stop // NCS_SAMPLES_PER_RECORD)
+        offset = rec_start * NCS_SAMPLES_PER_RECORD
+        samples = np.asarray(data[rec_start:rec_stop]).ravel()[start - offset:stop - offset]
+
+    if rescale and (ncs['scale'] is not None):
+        samples = samples.astype(dtype) * np.asarray(ncs['scale'], dtype=dtype)
+
+    return samples
+
+
+def iter_ncs_blocks(ncs_files, block_size=2**20, rescale_data=True, signal_scaling=VOLT_SCALING, dtype=np.float64):
+    """
+    Stream a set of ncs files (e.g. all the channels of a session) as fixed-size sample blocks. 
+
+    The files are memory-mapped, so at most one (n_channels, block_size) block is held in memory at a time. Sample times 
+    are not materialized: use ncs_sample_times with the segment index of any channel, e.g. 
+    ncs_sample_times(load_ncs(ncs_files[0], load_time=False, mmap=True)['segments'], np.arange(start, start + block.shape[1])). 
+
+    Parameters
+    ----------
+    ncs_files : list 
+        paths to the .ncs files. These should share a sampling rate. 
+    block_size : int 
+        number of samples per block 
+    rescale_data : bool
+        convert ADC counts to signal_scaling units. If False, blocks are int16 ADC counts. 
+    signal_scaling : tuple 
+        scaling and units to convert to 
+    dtype : numpy dtype 
+        float type of the rescaled blocks 
+
+    Yields
+    ------
+    start : int 
+        index of the first sample of the block
+    block : np.ndarray, shape (n_channels, n_block_samples)
+        the block of samples 
+    """
+
+    ncs_data = [load_ncs(chan_path, load_time=False, rescale_data=rescale_data, signal_scaling=signal_scaling, mmap=True) for chan_path in ncs_files]
+
+    if len(np.unique([x['sampling_rate'] for x in ncs_data])) > 1:
+        raise ValueError('All the ncs files streamed together must have the same sampling rate')
+    if len(np.unique([x['segments'].shape[0] for x in ncs_data])) > 1:
+        warnings.warn('Channels have a different number of recording segments (gaps) - blocks may not be aligned in time')
+
+    n_samples = np.min([x['data'].size for x in ncs_data])
+    if len(np.unique([x['data'].size for x in ncs_data])) > 1:
+        warnings.warn(f'Channels have different lengths - only streaming the first {n_samples} samples')
+
+    block_dtype = dtype if rescale_data else np.int16
+    for start in range(0, n_samples, block_size):
+        stop = min(n_samples, start + block_size)
+        block = np.empty((len(ncs_data), stop - start), dtype=block_dtype)
+        for ix, ncs in enumerate(ncs_data):
+            block[ix] = read_ncs_samples(ncs, start, stop, dtype=dtype)
+        yield start, block
+
+
 def load_nev(file_path):
     # Load the given file as a Neuralynx .nev event file and extract the contents
     file_path = os.path.abspath(file_path)
+    raw_header, header = read_cached_header(file_path)
     with open(file_path, 'rb') as fid:
-        raw_header = read_header(fid)
         records = read_records(fid, NEV_RECORD)
 
-    header = parse_header(raw_header)
-
     # Check for the packet data size, which should be two. DISABLED because these seem to be set to 0 in our files.
     #assert np.all(record['pkt_data_size'] == 2), 'Some packets have invalid data size'
 
@@ -228,84 +460,489 @@ def load_nev(file_path):
     return nev
 
 
-def parse_subject_nlx_data(ncs_files, eeg_names=None, resp_names=None, ekg_names=None, seeg_names=None, drop_names=None, include_micros=False):
+def build_nev_ttl_index(ttl):
+    # Group the event indices by TTL value (CSR layout): the events with TTL value values[i] are
+    # order[offsets[i]:offsets[i+1]], in recording order (stable sort)
+    order = np.argsort(ttl, kind='stable')
+    values, counts = np.unique(ttl[order], return_counts=True)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    return {'values': values, 'order': order, 'offsets': offsets}
+
+
+def load_nev_indexed(file_path, build_index=True):
+    """
+    Memory-map a Neuralynx .nev event file and expose only the TimeStamp, ttl and event_id columns. 
+
+    Unlike load_nev, the records (incl. the 128-byte EventString and the Extra arrays) are never decoded: the columns 
+    are strided views into the file and nothing is read until they are accessed. 
+
+    Parameters
+    ----------
+    file_path : str 
+        path to the .nev file 
+    build_index : bool 
+        precompute the per-TTL-value index (see build_nev_ttl_index) so that nev_ttl_times only touches the matching 
+        events. Costs one pass over the ttl column. 
+
+    Returns
+    -------
+    nev : dict 
+        file_path, raw_header, header, records (the memory-mapped records, for access to the other fields when they 
+        are really needed), timestamp, ttl, event_id and ttl_index (None if build_index=False) 
+    """
+
+    file_path = os.path.abspath(file_path)
+    raw_header, header = read_cached_header(file_path)
+    records = map_records(file_path, NEV_RECORD)
+
+    nev = dict()
+    nev['file_path'] = file_path
+    nev['raw_header'] = raw_header
+    nev['header'] = header
+    nev['records'] = records
+    nev['timestamp'] = records['TimeStamp']
+    nev['ttl'] = records['ttl']
+    nev['event_id'] = records['event_id']
+    nev['ttl_index'] = build_nev_ttl_index(np.asarray(records['ttl'])) if build_index else None
+
+    return nev
+
+
+def nev_ttl_times(nev, ttl_value=1):
+    """
+    Timestamps (s) of the events with a given TTL value, e.g. the sync pulses. 
+
+    Works on the output of load_nev_indexed (uses the TTL index when there is one, so only the matching events are 
+    read) as well as on the output of load_nev. 
+
+    Parameters
+    ----------
+    nev : dict 
+        output of load_nev_indexed or load_nev 
+    ttl_value : int 
+        TTL value of the events 
+
+    Returns
+    -------
+    ttl_ts : np.ndarray 
+        event times in seconds, in recording order 
+    """
+
+    if nev.get('ttl_index') is not None:
+        ttl_index = nev['ttl_index']
+        ix = np.searchsorted(ttl_index['values'], ttl_value)
+        if (ix == len(ttl_index['values'])) or (ttl_index['values'][ix] != ttl_value):
+            return np.zeros(0)
+        event_ix = ttl_index['order'][ttl_index['offsets'][ix]:ttl_index['offsets'][ix + 1]]
+        return nev['timestamp'][event_ix] * 1e-6
+
+    if 'timestamp' in nev:
+        timestamp, ttl = nev['timestamp'], nev['ttl']
+    else:
+        timestamp, ttl = nev['records']['TimeStamp'], nev['records']['ttl']
+
+    return timestamp[ttl == ttl_value] * 1e-6
+
+
+def scan_nlx_file(file_path):
+    """
+    Collect the metadata of a single .ncs or .nev file from its header, its size and its first and last record only. 
+
+    The result is cached on (path, mtime, size), so scanning a file again is free unless it has changed. 
+
+    Returns
+    -------
+    info : dict 
+        file_path, file_name, channel_name (file name without extension and "_0001"-style suffix), ext, channel_number, 
+        sampling_rate, ADBitVolts, n_records, start_ts and end_ts (µs, start of the first/last record) and 
+        duration (s, NaN for .nev). Values that are not available are NaN. 
+    """
+
+    key = file_signature(file_path)
+    if key in _SCAN_CACHE:
+        return dict(_SCAN_CACHE[key])
+
+    file_path = key[0]
+    file_name, ext = os.path.splitext(os.path.basename(file_path))
+    ext = ext.lower()
+    record_dtype = NEV_RECORD if ext == '.nev' else NCS_RECORD
+    _, header = read_cached_header(file_path)
+    n_records = int(estimate_record_count(file_path, record_dtype))
+
+    info = dict()
+    info['file_path'] = file_path
+    info['file_name'] = file_name
+    info['channel_name'] = re.sub(r'_\d{4}$', '', file_name)
+    info['ext'] = ext
+    info['channel_number'] = np.nan
+    info['sampling_rate'] = np.nan
+    info['ADBitVolts'] = np.float64(header['ADBitVolts']) if 'ADBitVolts' in header else np.nan
+    info['n_records'] = n_records
+    info['start_ts'] = np.nan
+    info['end_ts'] = np.nan
+    info['duration'] = np.nan
+
+    if n_records > 0:
+        with open(file_path, 'rb') as fid:
+            first = read_records(fid, record_dtype, count=1)[0]
+            last = read_records(fid, record_dtype, record_skip=n_records - 1, count=1)[0]
+        info['start_ts'] = int(first['TimeStamp'])
+        info['end_ts'] = int(last['TimeStamp'])
+        if ext == '.ncs':
+            info['channel_number'] = int(first['ChannelNumber'])
+            info['sampling_rate'] = float(first['SampleFreq'])
+            # the last record may be partially filled
+            info['duration'] = (info['end_ts'] - info['start_ts']) * 1e-6 + int(last['NumValidSamples']) / info['sampling_rate']
+
+    _SCAN_CACHE[key] = info
+
+    return dict(info)
+
+
+def scan_nlx_directory(load_path, extensions=('.ncs', '.nev')):
+    """
+    Scan every Neuralynx file in a session folder without reading any data (see scan_nlx_file). 
+
+    Use this to discover the channels, spot empty or numbered ("_0001.ncs") files and check sampling rates and time 
+    spans before deciding what to load. 
+
+    Parameters
+    ----------
+    load_path : str 
+        path to the session folder 
+    extensions : tuple 
+        file extensions to include 
+
+    Returns
+    -------
+    scan_df : pandas df 
+        one row per file (see scan_nlx_file for the columns), sorted by file name 
+    """
+
+    file_paths = sorted([os.path.join(load_path, x) for x in os.listdir(load_path) 
+                         if os.path.splitext(x)[-1].lower() in extensions])
+    columns = ['file_path', 'file_name', 'channel_name', 'ext', 'channel_number', 'sampling_rate', 'ADBitVolts', 
+               'n_records', 'start_ts', 'end_ts', 'duration']
+
+    scan_df = pd.DataFrame([scan_nlx_file(x) for x in file_paths], columns=columns)
+
+    return scan_df
+
+
+def nlx_channel_name(chan_path):
+    # Channel name from the file name, e.g. '/path/RA1_0001.ncs' -> 'ra1'
+    chan_name = chan_path.split('/')[-1].replace('.ncs','').lower()
+    # strip the file type off the end if needed 
+    if '_' in chan_name:
+        chan_name = chan_name.split('_')[0].lower()
+
+    return chan_name
+
+
+def assign_nlx_channel_type(chan_name, eeg_names=None, resp_names=None, ekg_names=None, seeg_names=None, drop_names=None, include_micros=False):
+    """
+    Decide the channel type of a Neuralynx channel from its name alone, before any data is read. 
+
+    Returns None if the channel should be skipped (selected to drop, or a microwire when include_micros=False). 
+    """
+
+    if drop_names and (chan_name in [x.lower() for x in drop_names]):
+        return None
+
+    #  scalp eeg
+    if eeg_names and (chan_name in [x.lower() for x in eeg_names]):
+        return 'eeg'
+    if resp_names and (chan_name in [x.lower() for x in resp_names]):
+        return 'bio'
+    if ekg_names:
+        if chan_name in [x.lower() for x in ekg_names]: 
+            return 'ecg'
+    elif 'ekg' in chan_name:
+        return 'ecg'
+    if seeg_names: 
+        if chan_name in [x.lower() for x in seeg_names]:
+            return 'seeg'
+        elif (chan_name[0] == 'u') | (chan_name[:3] == 'pde'):
+            # microwire data
+            if include_micros==True:
+                return 'seeg'
+            else: # skip
+                return None
+
+    # This means we were unable to assign the channel a type
+    return 'misc'
+
+
+def _read_ncs_into(ncs, out, block_records=4096):
+    # Copy (and rescale) the samples of a memory-mapped ncs dict into the preallocated 1D array out, one block of 
+    # records at a time so that the temporary float arrays stay small. An integer out gets the raw ADC counts.
+    rescale = not np.issubdtype(out.dtype, np.integer)
+    block_samples = block_records * NCS_SAMPLES_PER_RECORD
+    for start in range(0, out.shape[0], block_samples):
+        stop = min(out.shape[0], start + block_samples)
+        out[start:stop] = read_ncs_samples(ncs, start, stop, dtype=out.dtype, rescale=rescale)
+
+
+def parse_subject_nlx_data(ncs_files, eeg_names=None, resp_names=None, ekg_names=None, seeg_names=None, drop_names=None, include_micros=False, 
+                           n_jobs=1, buffer_path=None, compact=False):
     """
     Iterate through a list of ncs files and extract the relevant data: signal, sr, channel type and channel name
+
+    Channel names and types are resolved from the file names before any data is read. The samples of all kept channels 
+    are then read concurrently (thread pool) straight into one preallocated (n_channels, n_samples) buffer per 
+    sampling rate, so no per-channel float arrays are built and later re-copied by mne. 
+
+    Parameters
+    ----------
+    ncs_files : list 
+        paths to the .ncs files, or ncs dicts that are already mapped (e.g. from merge_multiple_ncs_files) 
+    eeg_names, resp_names, ekg_names, seeg_names, drop_names : list 
+        channel names for each channel type (see make_mne)
+    include_micros : bool
+        whether to keep the microwire channels 
+    n_jobs : int 
+        number of threads used to read the channels. Reading is IO bound, so this can exceed the number of cores 
+        (e.g. 8-16 on network storage). 
+    buffer_path : str 
+        if given, the signal buffer is a np.memmap backed by this file (e.g. under /dev/shm for shared memory) instead of 
+        an in-memory array. With mixed sampling rates the rate is appended to the file name. 
+    compact : bool 
+        keep the signals as int16 ADC counts (a quarter of the memory of float64) and return the per-channel scaling 
+        factors alongside. The conversion is left to the first numeric stage (see make_mne). 
+
+    Returns
+    -------
+    signals : np.ndarray, shape (n_channels, n_samples) or list of np.ndarray
+        the signals. A single 2D buffer if all channels share a sampling rate, otherwise a list of 1D row views into 
+        one buffer per sampling rate.
+    srs : list 
+        sampling rate of every channel 
+    ch_name : list 
+        channel names 
+    ch_type : list 
+        channel types 
+    scales : np.ndarray 
+        only if compact=True: factor that converts each channel's counts to volts (signals[i] * scales[i]) 
     """
 
-    signals = [] 
+    ncs_data = [] 
     srs = [] 
     ch_name = [] 
     ch_type = []
 
     for chan_path in ncs_files:
-        chan_name = chan_path.split('/')[-1].replace('.ncs','').lower()
-        # strip the file type off the end if needed 
-        if '_' in chan_name:
-            chan_name = chan_name.split('_')[0].lower()
-        try:
-            fdata = load_ncs(chan_path)
-        except IndexError: 
-            print(f'No data in channel {chan_path}')
-            continue
-        if drop_names: 
-            drop_names = [x.lower() for x in drop_names]
-            if chan_name in drop_names:
-                print(f'Channel selected to skip (bad or empty) {chan_path}')
-                continue
-        #  scalp eeg
-        if eeg_names:
-            eeg_names = [x.lower() for x in eeg_names]
-            if chan_name in eeg_names:
-                ch_type.append('eeg')
-        if resp_names:
-            resp_names = [x.lower() for x in resp_names]
-            if chan_name in resp_names:
-                ch_type.append('bio')
-        if ekg_names:
-            ekg_names = [x.lower() for x in ekg_names]
-            if (chan_name in ekg_names): 
-                ch_type.append('ecg') 
+        if isinstance(chan_path, dict):
+            # already mapped, e.g. a channel merged with merge_multiple_ncs_files 
+            fdata = chan_path
+            chan_path = fdata['source_files'][0] if 'source_files' in fdata else fdata['file_path']
+            chan_name = nlx_channel_name(chan_path)
         else:
-            ekg_names = []
-            if 'ekg' in chan_name:
-                ch_type.append('ecg')
-                ekg_names.append(chan_name)
-        if seeg_names: 
-            seeg_names = [x.lower() for x in seeg_names]
-            if chan_name in seeg_names:
-                ch_type.append('seeg')  
-            elif (chan_name[0] == 'u') | (chan_name[:3] == 'pde'):
-                # microwire data
-                if include_micros==True:
-                    ch_type.append('seeg')  
-                else: # skip
-                    continue
-        signals.append(fdata['data'])
+            chan_name = nlx_channel_name(chan_path)
+            try:
+                # memory-map the file: nothing is read until we know we want this channel 
+                fdata = load_ncs(chan_path, load_time=False, mmap=True)
+            except IndexError: 
+                print(f'No data in channel {chan_path}')
+                continue
+        chan_type = assign_nlx_channel_type(chan_name, eeg_names=eeg_names, resp_names=resp_names, ekg_names=ekg_names, 
+                                            seeg_names=seeg_names, drop_names=drop_names, include_micros=include_micros)
+        if chan_type is None:
+            if drop_names and (chan_name in [x.lower() for x in drop_names]):
+                print(f'Channel selected to skip (bad or empty) {chan_path}')
+            continue
+        if chan_type == 'misc':
+            print(f'Unidentified data type in {chan_name}')
+        ncs_data.append(fdata)
         srs.append(fdata['sampling_rate'])
         ch_name.append(chan_name)
-        if len(ch_type) < len(ch_name):
-            # This means we were unable to assign tha channel a type
-            ch_type.append('misc')
-            print(f'Unidentified data type in {chan_name}')
+        ch_type.append(chan_type)
+
+    # Preallocate one buffer per sampling rate and read every channel directly into its row
+    srs_arr = np.array(srs)
+    rows = [None] * len(ncs_data)
+    buffers = {}
+    buffer_dtype = np.int16 if compact else np.float64
+    for sr in np.unique(srs_arr):
+        ch_ix = np.where(srs_arr==sr)[0]
+        n_samples = [ncs_data[ix]['data'].size for ix in ch_ix]
+        if len(np.unique(n_samples)) > 1:
+            warnings.warn(f'Channels sampled at {sr} Hz have different lengths - truncating all of them to {np.min(n_samples)} samples')
+        shape = (len(ch_ix), int(np.min(n_samples)))
+        if buffer_path is not None:
+            path = buffer_path if len(np.unique(srs_arr)) == 1 else f'{buffer_path}_{sr}'
+            buffers[sr] = np.memmap(path, dtype=buffer_dtype, mode='w+', shape=shape)
+        else:
+            buffers[sr] = np.empty(shape, dtype=buffer_dtype)
+        for row, ix in enumerate(ch_ix):
+            rows[ix] = buffers[sr][row]
+
+    Parallel(n_jobs=n_jobs, prefer='threads')(delayed(_read_ncs_into)(fdata, row) for fdata, row in zip(ncs_data, rows))
+
+    if len(buffers) == 1:
+        signals = list(buffers.values())[0]
+    else:
+        signals = rows
+
+    if compact:
+        # channels without an ADBitVolts value were not rescaled by load_ncs either
+        scales = np.array([1.0 if fdata['scale'] is None else fdata['scale'] for fdata in ncs_data])
+        return signals, srs, ch_name, ch_type, scales
 
     return signals, srs, ch_name, ch_type
 
 
-def merge_multiple_ncs_files(ncs_files): 
-    """
-    TODO
+def _ncs_scale(parts, signal_scaling=VOLT_SCALING):
+    # Factor converting the ADC counts of ncs dicts of one channel to signal_scaling units (None without ADBitVolts)
+    try:
+        adbitvolts = np.unique([np.float64(x['header']['ADBitVolts']) for x in parts])
+    except KeyError:
+        warnings.warn('Unable to rescale data, no ADBitVolts value specified in header')
+        return None
+    if len(adbitvolts) > 1:
+        warnings.warn(f'The files have different ADBitVolts values {adbitvolts} - using the first one')
+
+    return np.float64(parts[0]['header']['ADBitVolts']) * signal_scaling[0]
 
-    Merge multiple ncs files. Usually done if recording was paused for whatever reason. 
+
+def merge_multiple_ncs_files(ncs_files, gap_policy='nan', output='memmap', save_path=None, rescale_data=True, 
+                             signal_scaling=VOLT_SCALING, dtype=np.float64, block_records=4096, max_gap=3600.): 
+    """
+    Merge multiple ncs files of the same channel. Usually done if recording was paused for whatever reason, in which case 
+    Neuralynx writes the continuation into "_0001.ncs" ... "_9999.ncs" files. 
+
+    The files are put in timestamp order and streamed record block by record block, so no segment is ever fully loaded. 
+
+    Parameters
+    ----------
+    ncs_files : list 
+        paths to the files of one channel (in any order). Empty files are skipped.
+    gap_policy : str 
+        how to reconcile gaps between (and within) files. options: ['nan', 'zero', 'drop']
+        'nan' fills the gaps with NaN so that sample index stays proportional to recording time, 
+        'zero' does the same with zeros (works with int16 counts, and with filters that NaNs would spread through), 
+        'drop' concatenates the recorded samples back to back. 
+    output : str 
+        options: ['memmap', 'ncs']
+        'memmap' writes a contiguous flat binary array (dtype) that is returned as a np.memmap, 
+        'ncs' writes a merged .ncs file (header of the first file + all records in timestamp order). In a .ncs file the 
+        gaps are kept in the record timestamps, so only gap_policy='drop' is allowed. 
+    save_path : str 
+        where to write the merged data. Defaults to {dir}/{channel}_merged.ncs (or .dat for output='memmap')
+    rescale_data : bool 
+        convert ADC counts to signal_scaling units (memmap output only) 
+    signal_scaling : tuple 
+        scaling and units to convert to 
+    dtype : numpy dtype 
+        dtype of the memmap output when rescaling 
+    block_records : int 
+        number of records copied at a time 
+    max_gap : float 
+        largest gap (s) that is filled in the memmap output (gap_policy='nan' or 'zero'). A longer gap (e.g. a corrupted 
+        timestamp) raises a ValueError instead of allocating the whole gap. None for no limit. 
+
+    Returns
+    -------
+    merged_ncs_dict : dict 
+        dict in the format of load_ncs(..., mmap=True) for the merged data, with the segment index of the merged data and 
+        the list of source files. For the memmap output 'data' is flat, 'timestamp' holds the time of every 512th sample 
+        (like the record timestamps) and 'scale' converts int16 counts to signal_scaling units (None if rescaled). 
     """
 
+    if gap_policy not in ['nan', 'zero', 'drop']:
+        raise ValueError(f'Unknown gap_policy {gap_policy}. Options are: nan, zero, drop')
+    if output not in ['memmap', 'ncs']:
+        raise ValueError(f'Unknown output {output}. Options are: memmap, ncs')
+    if (output == 'ncs') & (gap_policy != 'drop'):
+        raise ValueError('Gaps cannot be filled in a .ncs file (they are kept in the record timestamps) - use gap_policy="drop" or output="memmap"')
+    if (output == 'memmap') & (gap_policy == 'nan') & (not rescale_data):
+        raise ValueError('Gaps cannot be NaN-filled in int16 ADC counts - use rescale_data=True or gap_policy="drop"')
+
     merged_ncs_dict = {}
 
     path_dir_ncs = os.path.split(ncs_files[0])[0]
-    chan_name = os.path.split(ncs_files[0])[-1][:-4]
+    chan_name = re.sub(r'_\d{4}$', '', os.path.split(ncs_files[0])[-1][:-4])
     
     # Make a filepath for this  
-    merged_ncs_dict['file_path'] = f'{path_dir_ncs}/{chan_name}_merged.ncs'
-
+    if save_path is None:
+        save_path = f'{path_dir_ncs}/{chan_name}_merged.' + ('ncs' if output == 'ncs' else 'dat')
+    if os.path.dirname(save_path):
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
 
-    pass
\ No newline at end of file
+    # Map every file and put them in recording order
+    parts = [] 
+    for chan_path in ncs_files:
+        try:
+            parts.append(load_ncs(chan_path, load_time=False, rescale_data=rescale_data, signal_scaling=signal_scaling, mmap=True))
+        except IndexError: 
+            print(f'No data in {chan_path}')
+    if len(parts) == 0:
+        raise IndexError(f'No data in any of the files for {chan_name}')
+    parts = sorted(parts, key=lambda x: int(x['timestamp'][0]))
+
+    if len(np.unique([x['sampling_rate'] for x in parts])) > 1:
+        raise ValueError(f'Cannot merge {chan_name}: the files have different sampling rates')
+
+    if output == 'ncs':
+        with open(save_path, 'wb') as fid:
+            fid.write(parts[0]['raw_header'].ljust(HEADER_LENGTH, b'\0'))
+            for ncs in parts:
+                records = map_records(ncs['file_path'], NCS_RECORD)
+                for start in range(0, records.shape[0], block_records):
+                    np.asarray(records[start:start + block_records]).tofile(fid)
+
+        merged_ncs_dict = load_ncs(save_path, load_time=False, rescale_data=rescale_data, signal_scaling=signal_scaling, mmap=True)
+        merged_ncs_dict['source_files'] = [x['file_path'] for x in parts]
+
+        return merged_ncs_dict
+
+    # Lay out every recorded segment in the output 
+    sample_period = parts[0]['segments']['SamplePeriod'][0]
+    t0 = int(parts[0]['segments']['TimeStamp'][0])
+    placements = [] 
+    pos = 0
+    for ncs in parts:
+        for seg in ncs['segments']:
+            if gap_policy in ['nan', 'zero']:
+                target = int(np.round((int(seg['TimeStamp']) - t0) / sample_period))
+                if (max_gap is not None) and ((target - pos) * sample_period / 1e6 > max_gap):
+                    raise ValueError(f'Gap of {(target - pos) * sample_period / 1e6:.1f} s before a segment of {ncs["file_path"]} '
+                                     f'exceeds max_gap={max_gap} s - check the timestamps, or use gap_policy="drop" or a larger max_gap')
+                if target < pos:
+                    warnings.warn(f'Overlapping records in {ncs["file_path"]} - appending them after the previous segment')
+                    target = pos
+                pos = target
+            placements.append((ncs, int(seg['start_sample']), int(seg['n_samples']), pos, seg['TimeStamp']))
+            pos += int(seg['n_samples'])
+
+    out_dtype = dtype if rescale_data else np.int16
+    data = np.memmap(save_path, dtype=out_dtype, mode='w+', shape=(pos,))
+
+    segments = np.zeros(len(placements), dtype=NCS_SEGMENT)
+    block_samples = block_records * NCS_SAMPLES_PER_RECORD
+    end = 0
+    for ix, (ncs, src_start, n_samples, out_start, timestamp) in enumerate(placements):
+        # fill the gap before this segment
+        data[end:out_start] = np.nan if gap_policy == 'nan' else 0
+        for offset in range(0, n_samples, block_samples):
+            stop = min(n_samples, offset + block_samples)
+            data[out_start + offset:out_start + stop] = read_ncs_samples(ncs, src_start + offset, src_start + stop, dtype=dtype)
+        end = out_start + n_samples
+        segments[ix] = (out_start, n_samples, timestamp, sample_period)
+    data.flush()
+
+    merged_ncs_dict['file_path'] = save_path
+    merged_ncs_dict['raw_header'] = parts[0]['raw_header']
+    merged_ncs_dict['header'] = parts[0]['header']
+    merged_ncs_dict['data'] = data
+    merged_ncs_dict['data_units'] = parts[0]['data_units']
+    merged_ncs_dict['sampling_rate'] = parts[0]['sampling_rate']
+    merged_ncs_dict['channel_number'] = parts[0]['channel_number']
+    merged_ncs_dict['timestamp'] = ncs_sample_times(segments, np.arange(0, pos, NCS_SAMPLES_PER_RECORD)).astype(np.uint64)
+    merged_ncs_dict['segments'] = segments
+    merged_ncs_dict['mmap'] = True
+    # int16 counts still need the ADBitVolts scaling (read_ncs_samples applies it)
+    merged_ncs_dict['scale'] = None if rescale_data else _ncs_scale(parts, signal_scaling)
+    merged_ncs_dict['source_files'] = [x['file_path'] for x in parts]
+
+    return merged_ncs_dict
@@ -4,6 +4,7 @@ import warnings
 from scipy.stats import spearmanr, pearsonr
 from collections import defaultdict 
 import matplotlib.pyplot as plt
+from LFPAnalysis import nlx_utils
 
 # Utility functions for synchronization
 
@@ -63,9 +64,11 @@ def get_neural_ts_photodiode(mne_sync, smoothSize=11, height=0.5):
 def get_neural_ts_ttl(nev_data):
     """
     get neural ts from ttl recording on nlx
+
+    nev_data can come from nlx_utils.load_nev or nlx_utils.load_nev_indexed (fast path for large event files)
     """
 
-    return nev_data['records']['TimeStamp'][nev_data['records']['ttl']==1] * 1e-6
+    return nlx_utils.nev_ttl_times(nev_data, ttl_value=1)
 
 def pulsealign(beh_ms=None,
                pulses=None, 
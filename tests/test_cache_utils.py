@@ -0,0 +1,56 @@
+import os
+import time
+from LFPAnalysis import cache_utils
+
+
+def test_stage_key_misses_on_changed_params(tmp_path):
+    data = tmp_path / 'data.csv'
+    data.write_text('a,b\n1,2\n')
+
+    key = cache_utils.stage_key('stage', [str(data)], {'thresh': 5})
+    assert cache_utils.stage_key('stage', [str(data)], {'thresh': 5}) == key
+    assert cache_utils.stage_key('stage', [str(data)], {'thresh': 6}) != key
+    assert cache_utils.stage_key('other_stage', [str(data)], {'thresh': 5}) != key
+
+
+def test_stage_key_misses_on_changed_input_file(tmp_path):
+    data = tmp_path / 'data.csv'
+    data.write_text('a,b\n1,2\n')
+    key = cache_utils.stage_key('stage', [str(data)], {'thresh': 5})
+
+    data.write_text('a,b\n1,2\n3,4\n')
+    os.utime(data, ns=(time.time_ns(), time.time_ns() + 10**9))
+    assert cache_utils.stage_key('stage', [str(data)], {'thresh': 5}) != key
+
+
+def test_stage_key_misses_on_changed_code(tmp_path, monkeypatch):
+    data = tmp_path / 'data.csv'
+    data.write_text('a,b\n1,2\n')
+    key = cache_utils.stage_key('stage', [str(data)], {'thresh': 5})
+
+    monkeypatch.setattr(cache_utils, '_CODE_FINGERPRINT', 'edited')
+    assert cache_utils.stage_key('stage', [str(data)], {'thresh': 5}) != key
+
+
+def test_code_fingerprint_tracks_the_sources(tmp_path, monkeypatch):
+    module = tmp_path / 'lfp_preprocess_utils.py'
+    module.write_text('def detect_IEDs():\n    return 1\n')
+    monkeypatch.setattr(cache_utils, '__file__', str(tmp_path / 'cache_utils.py'))
+
+    monkeypatch.setattr(cache_utils, '_CODE_FINGERPRINT', None)
+    fingerprint = cache_utils.code_fingerprint()
+    assert cache_utils.code_fingerprint() == fingerprint
+
+    module.write_text('def detect_IEDs():\n    return 2\n')
+    monkeypatch.setattr(cache_utils, '_CODE_FINGERPRINT', None)
+    assert cache_utils.code_fingerprint() != fingerprint
+
+
+def test_load_stage_misses_after_code_change(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    key = cache_utils.stage_key('stage', [], {'thresh': 5})
+    cache_utils.save_stage({'result': 1}, cache_dir, 'stage', key)
+    assert cache_utils.load_stage(cache_dir, 'stage', key) == {'result': 1}
+
+    monkeypatch.setattr(cache_utils, '_CODE_FINGERPRINT', 'edited')
+    assert cache_utils.load_stage(cache_dir, 'stage', cache_utils.stage_key('stage', [], {'thresh': 5})) is None